@@ -0,0 +1,195 @@
+"""
+Генератор синтетического корпуса для бенчмарков.
+
+Создаёт в папке файлы txt / md / html / docx / pdf заданного размера.
+Текст детерминирован (seed), слова берутся из небольшого словаря, поэтому
+у документов есть общие и уникальные темы — поиск по ним осмысленный.
+
+DOCX пишется через python-docx (если установлен), PDF — минимальным
+встроенным писателем (латиница, чтобы PyPDF2 извлекал текст без шрифтов).
+
+Использование:
+    python benchmarks/corpus.py <папка> --files 20 --size-kb 32 --formats txt,md,pdf
+"""
+
+import os
+import random
+import argparse
+
+ALL_FORMATS = ["txt", "md", "html", "docx", "pdf"]
+
+_RU_WORDS = (
+    "индекс документ поиск модель ответ вопрос файл папка текст фрагмент "
+    "настройка сервер запрос память процессор диск сеть пользователь отчёт "
+    "бюджет проект задача срок договор поставка оплата склад клиент заказ "
+    "анализ данные таблица график результат метрика скорость задержка нагрузка "
+    "инструкция установка обновление ошибка журнал доступ ключ пароль политика"
+).split()
+
+_TOPICS_RU = ["финансы", "логистика", "безопасность", "инфраструктура", "продажи", "кадры"]
+
+_LATIN_WORDS = (
+    "index document search model answer question file folder text fragment "
+    "setting server request memory processor disk network user report "
+    "budget project task deadline contract delivery payment warehouse client order "
+    "analysis data table chart result metric speed latency load "
+    "instruction install update error journal access key password policy"
+).split()
+
+_TOPICS_LATIN = ["finance", "logistics", "security", "infrastructure", "sales", "staff"]
+
+
+def _paragraphs(rng: random.Random, target_chars: int, words: list, topic: str) -> list:
+    paras = []
+    total = 0
+    while total < target_chars:
+        sentences = []
+        for _ in range(rng.randint(3, 7)):
+            n = rng.randint(6, 16)
+            sent = [rng.choice(words) for _ in range(n)]
+            sent.insert(rng.randrange(len(sent)), topic)
+            sentences.append(" ".join(sent).capitalize() + ".")
+        para = " ".join(sentences)
+        paras.append(para)
+        total += len(para) + 2
+    return paras
+
+
+def _write_txt(path, title, paras):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(title + "\n\n" + "\n\n".join(paras) + "\n")
+
+
+def _write_md(path, title, paras):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {title}\n\n")
+        for i, p in enumerate(paras):
+            if i and i % 4 == 0:
+                f.write(f"## Раздел {i // 4}\n\n")
+            f.write(p + "\n\n")
+
+
+def _write_html(path, title, paras):
+    import html
+    body = "\n".join(f"<p>{html.escape(p)}</p>" for p in paras)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"<html><head><title>{html.escape(title)}</title></head>"
+                f"<body><h1>{html.escape(title)}</h1>\n{body}\n</body></html>\n")
+
+
+def _write_docx(path, title, paras) -> bool:
+    try:
+        from docx import Document
+    except ImportError:
+        return False
+    doc = Document()
+    doc.add_heading(title, level=1)
+    for p in paras:
+        doc.add_paragraph(p)
+    doc.save(path)
+    return True
+
+
+def _pdf_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _write_pdf(path, title, paras, lines_per_page=50, width_chars=90):
+    """Минимальный PDF 1.4: Helvetica, по странице на lines_per_page строк."""
+    lines = [title, ""]
+    for p in paras:
+        words = p.split()
+        cur = ""
+        for w in words:
+            if len(cur) + len(w) + 1 > width_chars:
+                lines.append(cur)
+                cur = w
+            else:
+                cur = f"{cur} {w}".strip()
+        if cur:
+            lines.append(cur)
+        lines.append("")
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[""]]
+
+    objects = []  # содержимое объектов, номер = индекс + 1
+    objects.append("<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(None)  # Pages — заполним после страниц
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_ids = []
+    for page_lines in pages:
+        stream = "BT /F1 10 Tf 14 TL 40 800 Td\n" + "\n".join(
+            f"({_pdf_escape(line)}) '" for line in page_lines
+        ) + "\nET"
+        objects.append(f"<< /Length {len(stream.encode('latin-1'))} >>\nstream\n{stream}\nendstream")
+        content_id = len(objects)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for off in offsets:
+        out += f"{off:010d} 00000 n \n".encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def generate_corpus(folder: str, n_files: int = 20, size_kb: int = 16, formats=None, seed: int = 42) -> list:
+    """
+    Создаёт n_files документов по кругу из formats, каждый ~size_kb КБ текста.
+    Возвращает список путей созданных файлов.
+    """
+    formats = [f for f in (formats or ALL_FORMATS) if f in ALL_FORMATS]
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    created = []
+    for i in range(n_files):
+        ext = formats[i % len(formats)]
+        latin = ext == "pdf"
+        words = _LATIN_WORDS if latin else _RU_WORDS
+        topics = _TOPICS_LATIN if latin else _TOPICS_RU
+        topic = topics[i % len(topics)]
+        title = f"{'Document' if latin else 'Документ'} {i + 1}: {topic}"
+        paras = _paragraphs(rng, size_kb * 1024, words, topic)
+        path = os.path.join(folder, f"doc_{i + 1:04d}_{topic}.{ext}")
+        if ext == "txt":
+            _write_txt(path, title, paras)
+        elif ext == "md":
+            _write_md(path, title, paras)
+        elif ext == "html":
+            _write_html(path, title, paras)
+        elif ext == "docx":
+            if not _write_docx(path, title, paras):
+                # python-docx не установлен — подменяем на txt, чтобы размер корпуса не менялся
+                path = os.path.splitext(path)[0] + ".txt"
+                _write_txt(path, title, paras)
+        elif ext == "pdf":
+            _write_pdf(path, title, paras)
+        created.append(path)
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетический корпус для бенчмарков")
+    parser.add_argument("folder")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size-kb", type=int, default=16)
+    parser.add_argument("--formats", default=",".join(ALL_FORMATS))
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    files = generate_corpus(args.folder, args.files, args.size_kb, args.formats.split(","), args.seed)
+    print(f"Создано файлов: {len(files)} в {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Детерминированный фейковый Ollama-сервер для бенчмарков.
+
+Говорит на том же HTTP-протоколе, что и настоящий Ollama, поэтому приложение
+работает с ним без изменений (достаточно RAG_OLLAMA_URL=http://127.0.0.1:<port>):
+
+  GET  /api/tags, /api/version
+  POST /api/embed        — {"model", "input": str | [str]}  -> {"embeddings": [[...]]}
+  POST /api/embeddings   — {"model", "prompt": str}          -> {"embedding": [...]}
+  POST /api/chat         — стриминг NDJSON или один JSON
+  POST /api/generate     — стриминг NDJSON или один JSON (+ "context")
+
+Эмбеддинги — хешированный мешок слов (одинаковые слова → близкие векторы),
+поэтому поиск по индексу осмысленный и воспроизводимый.
+Латентность модели эмулируется: префилл пропорционален длине промпта,
+каждый токен ответа — фиксированная задержка. Переданный в /api/generate
+"context" (токены прошлой генерации) префилла не требует, как у настоящего
+Ollama при попадании в KV-кеш, и продолжается в возвращаемом "context".
+
+Использование:
+    python benchmarks/fake_ollama.py --port 11555
+"""
+
+import re
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBED_DIM = 256
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def fake_embedding(text: str, dim: int = EMBED_DIM) -> list:
+    """Хешированный bag-of-words, L2-нормированный."""
+    vec = [0.0] * dim
+    for word in _WORD_RE.findall(text.lower()):
+        h = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:4], "little")
+        vec[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def fake_answer(prompt: str, max_words: int = 40) -> str:
+    """Детерминированный «ответ»: первые слова контекста после маркера."""
+    marker = prompt.find("Контекст:")
+    body = prompt[marker + len("Контекст:"):] if marker != -1 else prompt
+    words = [w for w in body.split() if not w.startswith("[")]
+    if not words:
+        return "Информация отсутствует в доступных документах"
+    return " ".join(words[:max_words])
+
+
+def _tokens(text: str) -> list:
+    """Режет ответ на «токены» по словам, сохраняя пробелы."""
+    return re.findall(r"\S+\s*", text)
+
+
+class FakeOllamaConfig:
+    def __init__(self, prefill_ms_per_1k_chars=5.0, token_ms=2.0, embed_ms_per_input=0.5,
+                 answer_words=40, model="bench-llm"):
+        self.prefill_ms_per_1k_chars = prefill_ms_per_1k_chars
+        self.token_ms = token_ms
+        self.embed_ms_per_input = embed_ms_per_input
+        self.answer_words = answer_words
+        self.model = model
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOllama/1.0"
+
+    # ── служебное ────────────────────────────────────────────────────────
+
+    def log_message(self, fmt, *args):  # тишина в консоли
+        pass
+
+    @property
+    def cfg(self) -> FakeOllamaConfig:
+        return self.server.cfg
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        try:
+            return json.loads(raw.decode("utf-8") or "{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _send_json(self, obj, status=200):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _stream_line(self, obj):
+        data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now(timezone.utc).isoformat()
+
+    def _prefill(self, prompt_chars: int):
+        self.server.count("prefill_chars", prompt_chars)
+        time.sleep(self.cfg.prefill_ms_per_1k_chars * prompt_chars / 1000 / 1000)
+
+    # ── маршруты ─────────────────────────────────────────────────────────
+
+    def do_GET(self):
+        if self.path.startswith("/api/tags"):
+            self._send_json({"models": [{"name": self.cfg.model, "model": self.cfg.model, "size": 0}]})
+        elif self.path.startswith("/api/version"):
+            self._send_json({"version": "0.0.0-fake"})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        body = self._read_json()
+        self.server.count("requests")
+        if self.path.startswith("/api/embed") and not self.path.startswith("/api/embeddings"):
+            inputs = body.get("input", "")
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            time.sleep(self.cfg.embed_ms_per_input * len(inputs) / 1000)
+            self.server.count("embed_inputs", len(inputs))
+            self._send_json({"model": body.get("model", ""), "embeddings": [fake_embedding(t) for t in inputs]})
+        elif self.path.startswith("/api/embeddings"):
+            self.server.count("embed_inputs")
+            self._send_json({"embedding": fake_embedding(body.get("prompt", ""))})
+        elif self.path.startswith("/api/chat"):
+            prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+            self._generate(body, prompt, chat=True)
+        elif self.path.startswith("/api/generate"):
+            self._generate(body, body.get("prompt", ""), chat=False)
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _generate(self, body: dict, prompt: str, chat: bool):
+        model = body.get("model", self.cfg.model)
+        # Пустой промпт — это preload модели (keep_alive), ответ мгновенный
+        if not prompt.strip():
+            self._send_json({"model": model, "created_at": self._now(), "response": "", "done": True,
+                             "done_reason": "load"})
+            return
+
+        prev_context = body.get("context") if not chat else None
+        if not isinstance(prev_context, list):
+            prev_context = []
+        self.server.count("context_tokens_in", len(prev_context))
+        t_prefill = time.perf_counter()
+        self._prefill(len(prompt))
+        prefill_ns = int((time.perf_counter() - t_prefill) * 1e9)
+        answer = fake_answer(prompt, self.cfg.answer_words)
+        tokens = _tokens(answer)
+
+        def _chunk(text, done):
+            msg = {"model": model, "created_at": self._now(), "done": done}
+            if chat:
+                msg["message"] = {"role": "assistant", "content": text}
+            else:
+                msg["response"] = text
+            if done:
+                msg["done_reason"] = "stop"
+                msg["eval_count"] = len(tokens)
+                msg["prompt_eval_count"] = len(prompt) // 4
+                msg["prompt_eval_duration"] = prefill_ns
+                if not chat:
+                    msg["context"] = prev_context + list(range(len(prompt) // 4 + len(tokens)))
+            return msg
+
+        if body.get("stream", True):
+            self._start_stream()
+            for tok in tokens:
+                time.sleep(self.cfg.token_ms / 1000)
+                self._stream_line(_chunk(tok, False))
+            self._stream_line(_chunk("", True))
+            self._end_stream()
+        else:
+            time.sleep(self.cfg.token_ms * len(tokens) / 1000)
+            self._send_json(_chunk(answer, True))
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, cfg: FakeOllamaConfig = None):
+        super().__init__((host, port), _Handler)
+        self.cfg = cfg or FakeOllamaConfig()
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start_background(self) -> "FakeOllamaServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Ollama-сервер для бенчмарков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11555)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=5.0)
+    parser.add_argument("--token-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    cfg = FakeOllamaConfig(prefill_ms_per_1k_chars=args.prefill_ms_per_1k, token_ms=args.token_ms)
+    server = FakeOllamaServer(args.host, args.port, cfg)
+    print(f"Fake Ollama: {server.base_url}  (RAG_OLLAMA_URL={server.base_url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
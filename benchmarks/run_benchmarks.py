@@ -0,0 +1,477 @@
+"""
+Воспроизводимые бенчмарки индексации и ответов без живого Ollama.
+
+Поднимает фейковый Ollama (fake_ollama.py), генерирует синтетический корпус
+(corpus.py) во временной папке, изолирует кеш приложения (LOCALAPPDATA) и
+меряет:
+  - build_index       — холодная индексация и загрузка из кеша
+  - qa_chain          — все ветки wrapped_qa_chain (общая/файловая сводка,
+                        обычный вопрос, вопрос по файлу), включая TTFT стрима
+  - prefix_reuse      — TTFT повторных вопросов по одному файлу с переиспользованием
+                        context-токенов Ollama и без него
+  - rerank            — rerank_chunks на найденных чанках (если есть модель)
+  - rerank_backends   — бэкенды reranker (torch / int8 / onnx): латентность и
+                        согласие ранжирования с torch на фиксированном наборе вопросов
+  - autocomplete      — обучение StatLanguageModel и латентность подсказок
+
+Результат — JSON (по умолчанию benchmarks/results/bench_<время>.json) плюс
+строка в benchmarks/results/history.jsonl для отслеживания трендов.
+
+Использование:
+    python benchmarks/run_benchmarks.py --files 30 --size-kb 16 --reps 5
+    python benchmarks/run_benchmarks.py --only build_index,qa_chain
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+SRC_DIR = os.path.join(REPO_ROOT, "src")
+RESULTS_DIR = os.path.join(HERE, "results")
+
+sys.path.insert(0, SRC_DIR)
+sys.path.insert(0, HERE)
+
+from corpus import generate_corpus, ALL_FORMATS  # noqa: E402
+from fake_ollama import FakeOllamaServer, FakeOllamaConfig  # noqa: E402
+
+BENCH_MODEL = "bench-llm"
+BENCH_EMBEDDING_MODEL = "bench-embed"
+ALL_BENCHMARKS = ["build_index", "qa_chain", "prefix_reuse", "rerank", "rerank_backends", "autocomplete"]
+
+_QUESTIONS = [
+    "Что сказано про бюджет и сроки?",
+    "Какие ошибки встречаются в журнале?",
+    "Расскажи про политику доступа и пароли",
+    "Какая задержка и нагрузка на сервер?",
+    "Что известно о поставках на склад?",
+]
+
+
+# ── утилиты ─────────────────────────────────────────────────────────────
+
+def _stats(samples_ms: list) -> dict:
+    if not samples_ms:
+        return {"n": 0}
+    ordered = sorted(samples_ms)
+
+    def pct(p):
+        idx = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+        return round(ordered[idx], 3)
+
+    return {
+        "n": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered), 3),
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "min_ms": round(ordered[0], 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+def _ms(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return ""
+
+
+def _drain(resp) -> tuple:
+    """Дочитывает ответ цепочки. Возвращает (final_dict, ttft_ms | None) относительно вызова."""
+    if isinstance(resp, dict):
+        return resp, None
+    start = time.perf_counter()
+    ttft = None
+    final = {}
+    for item in resp:
+        if isinstance(item, dict) and item.get("delta") and ttft is None:
+            ttft = _ms(start)
+        if isinstance(item, dict) and item.get("final"):
+            final = item
+    return final, ttft
+
+
+# ── бенчмарки ───────────────────────────────────────────────────────────
+
+def bench_build_index(corpus_dir: str, files: list, reps: int) -> tuple:
+    from indexer import build_index
+    from cache import clear_folder_cache
+    from metrics import IndexingMetrics
+
+    corpus_bytes = sum(os.path.getsize(p) for p in files)
+    cold, warm = [], []
+    vectorstore = None
+    metrics = None
+    for _ in range(reps):
+        clear_folder_cache(corpus_dir)
+        metrics = IndexingMetrics(corpus_dir)
+        t0 = time.perf_counter()
+        vectorstore = build_index(corpus_dir, BENCH_EMBEDDING_MODEL, metrics=metrics)
+        cold.append(_ms(t0))
+        t0 = time.perf_counter()
+        vectorstore = build_index(corpus_dir, BENCH_EMBEDDING_MODEL)
+        warm.append(_ms(t0))
+
+    chunks = int(vectorstore.index.ntotal) if vectorstore is not None else 0
+    cold_s = (sorted(cold)[len(cold) // 2]) / 1000 if cold else 0
+    result = {
+        "files": len(files),
+        "bytes": corpus_bytes,
+        "chunks": chunks,
+        "cold": _stats(cold),
+        "warm": _stats(warm),
+        "files_per_s": round(len(files) / cold_s, 2) if cold_s else None,
+        "chunks_per_s": round(chunks / cold_s, 2) if cold_s else None,
+        "mb_per_s": round(corpus_bytes / 1024 / 1024 / cold_s, 3) if cold_s else None,
+    }
+    if metrics is not None:
+        # Разбивка последнего холодного прогона по этапам (scan/extract/chunk/embed/faiss_insert/save)
+        snap = metrics.snapshot()
+        result["stages"] = {
+            name: {k: st[k] for k in ("seconds", "items_per_s", "chunks_per_s", "bytes_per_s")}
+            for name, st in snap["stages"].items()
+        }
+        result["extract_by_type"] = {
+            ext: {k: st[k] for k in ("count", "seconds", "max_ms")}
+            for ext, st in snap["extract_by_type"].items()
+        }
+    return result, vectorstore
+
+
+def bench_qa_chain(vectorstore, corpus_dir: str, files: list, reps: int) -> dict:
+    from rag import get_rag_chain, clear_summary_cache
+
+    chain = get_rag_chain(vectorstore, BENCH_MODEL, use_gpu=False, folder_path=corpus_dir)
+    target = files[0]
+
+    branches = {
+        "general_summary": lambda i: ("О чём файлы?", None),
+        "file_summary": lambda i: (f"О чём файл {os.path.basename(target)}?", target),
+        "question": lambda i: (_QUESTIONS[i % len(_QUESTIONS)], None),
+        "question_file": lambda i: (_QUESTIONS[i % len(_QUESTIONS)], target),
+    }
+
+    results = {}
+    for name, make in branches.items():
+        latencies, ttfts, stage_samples = [], [], {}
+        for i in range(reps):
+            query, file_filter = make(i)
+            # Сводки кешируются на диске — сбрасываем, чтобы мерить реальную генерацию
+            if name == "general_summary":
+                clear_summary_cache(corpus_dir)
+            elif name == "file_summary":
+                clear_summary_cache(corpus_dir, file_filter)
+            t0 = time.perf_counter()
+            final, ttft = _drain(chain(query, file_filter=file_filter))
+            latencies.append(_ms(t0))
+            if ttft is not None:
+                ttfts.append(ttft)
+            for stage, value in (final.get("timings") or {}).items():
+                stage_samples.setdefault(stage, []).append(value)
+        results[name] = {
+            "latency": _stats(latencies),
+            "ttft": _stats(ttfts),
+            "stages_p50_ms": {k: _stats(v)["p50_ms"] for k, v in stage_samples.items()},
+        }
+    return results
+
+
+def bench_prefix_reuse(vectorstore, corpus_dir: str, files: list, reps: int, server) -> dict:
+    """
+    Серия вопросов по одному файлу: первый — холодный (полный промпт), дальше
+    при включённом переиспользовании отправляется только вопрос + context.
+    Сравниваются TTFT и объём префилла на фейковом сервере.
+    """
+    from rag import get_rag_chain
+    from conversation import Conversation
+
+    results = {}
+    for label, reuse in (("no_reuse", False), ("reuse", True)):
+        chain = get_rag_chain(vectorstore, BENCH_MODEL, use_gpu=False, folder_path=corpus_dir,
+                              ollama_prefix_reuse=reuse)
+        ttft_cold, ttft_warm, reused = [], [], 0
+        prefill_before = server.counters.get("prefill_chars", 0)
+        # Разные файлы — разные области; первый вопрос по каждой холодный.
+        # Переиспользование — только внутри диалога, поэтому на файл — свой чат
+        for target in files[:max(1, min(3, len(files)))]:
+            query = f"{_QUESTIONS[0]} ({os.path.basename(target)})"
+            conversation = Conversation()
+            for i in range(reps + 1):
+                final, ttft = _drain(chain(query, file_filter=target, conversation=conversation))
+                if ttft is not None:
+                    (ttft_cold if i == 0 else ttft_warm).append(ttft)
+                for span in (final.get("trace") or {}).get("spans", []):
+                    if span["name"] == "llm_generate" and (span.get("attrs") or {}).get("prefix_reused"):
+                        reused += 1
+        results[label] = {
+            "ttft_first": _stats(ttft_cold),
+            "ttft_repeat": _stats(ttft_warm),
+            "prefix_reused": reused,
+            "prefill_chars": server.counters.get("prefill_chars", 0) - prefill_before,
+        }
+    base = results["no_reuse"]["ttft_repeat"].get("p50_ms")
+    warm = results["reuse"]["ttft_repeat"].get("p50_ms")
+    if base and warm:
+        results["ttft_repeat_speedup"] = round(base / warm, 2)
+    return results
+
+
+def bench_rerank(vectorstore, reps: int) -> dict:
+    try:
+        from reranker import is_available, _get_reranker, rerank_chunks, clear_score_cache, score_cache_stats
+    except Exception as e:
+        return {"skipped": f"reranker import failed: {e}"}
+    if not is_available():
+        return {"skipped": "sentence-transformers не установлен"}
+
+    t0 = time.perf_counter()
+    model = _get_reranker()
+    load_ms = _ms(t0)
+    if model is None:
+        return {"skipped": "ни одна модель reranker не загрузилась"}
+
+    # Первый проход по вопросам — с пустым кешем scores, повторы вопросов — из кеша
+    clear_score_cache()
+    cold, warm = [], []
+    seen = set()
+    n_docs = 0
+    for i in range(reps):
+        query = _QUESTIONS[i % len(_QUESTIONS)]
+        docs = vectorstore.similarity_search(query, k=8)
+        n_docs = len(docs)
+        t0 = time.perf_counter()
+        rerank_chunks(query, docs)
+        (warm if query in seen else cold).append(_ms(t0))
+        seen.add(query)
+    return {"load_ms": round(load_ms, 1), "docs_per_query": n_docs, "latency": _stats(cold + warm),
+            "latency_cold": _stats(cold), "latency_cached": _stats(warm), "score_cache": score_cache_stats()}
+
+
+def _ranks(scores: list) -> list:
+    order = sorted(range(len(scores)), key=lambda i: scores[i])
+    ranks = [0] * len(scores)
+    for rank, i in enumerate(order):
+        ranks[i] = rank
+    return ranks
+
+
+def _spearman(a: list, b: list) -> float:
+    n = len(a)
+    if n < 2:
+        return 1.0
+    ra, rb = _ranks(a), _ranks(b)
+    d2 = sum((x - y) ** 2 for x, y in zip(ra, rb))
+    return 1 - 6 * d2 / (n * (n * n - 1))
+
+
+def _top_overlap(a: list, b: list, k: int = 3) -> float:
+    k = min(k, len(a))
+    if k == 0:
+        return 1.0
+    top_a = set(sorted(range(len(a)), key=lambda i: -a[i])[:k])
+    top_b = set(sorted(range(len(b)), key=lambda i: -b[i])[:k])
+    return len(top_a & top_b) / k
+
+
+def bench_reranker_backends(vectorstore, reps: int) -> dict:
+    """Каждый бэкенд скорит одни и те же (вопрос, span); torch — эталон для согласия ранжирования."""
+    try:
+        from reranker import BACKENDS, load_backend, to_scores, _doc_spans
+    except Exception as e:
+        return {"skipped": f"reranker import failed: {e}"}
+
+    query_set = []
+    for query in _QUESTIONS:
+        spans = [span[2] for doc in vectorstore.similarity_search(query, k=8) for span in _doc_spans(doc)]
+        if spans:
+            query_set.append((query, spans))
+    if not query_set:
+        return {"skipped": "нет spans для сравнения"}
+
+    results = {"queries": len(query_set), "pairs_per_query": round(sum(len(s) for _, s in query_set) / len(query_set), 1)}
+    reference = None
+    for backend in BACKENDS:
+        t0 = time.perf_counter()
+        loaded = load_backend(backend)
+        load_ms = _ms(t0)
+        if loaded is None:
+            results[backend] = {"skipped": "бэкенд не загрузился"}
+            continue
+        model_name, model = loaded
+        latencies = []
+        scores = []
+        for rep in range(max(1, reps)):
+            for query, spans in query_set:
+                t0 = time.perf_counter()
+                out = to_scores(model.predict([(query, span) for span in spans]))
+                latencies.append(_ms(t0))
+                if rep == 0:
+                    scores.append(out)
+        entry = {"model": model_name, "load_ms": round(load_ms, 1), "latency": _stats(latencies)}
+        if backend == "torch":
+            reference = scores
+        elif reference is not None:
+            entry["spearman"] = round(sum(_spearman(a, b) for a, b in zip(reference, scores)) / len(scores), 4)
+            entry["top3_overlap"] = round(sum(_top_overlap(a, b) for a, b in zip(reference, scores)) / len(scores), 4)
+        results[backend] = entry
+    base = results.get("torch", {}).get("latency", {}).get("p50_ms")
+    for backend in BACKENDS:
+        p50 = results[backend].get("latency", {}).get("p50_ms")
+        if base and p50 and backend != "torch":
+            results[backend]["speedup_p50"] = round(base / p50, 2)
+    return results
+
+
+def bench_autocomplete(files: list, reps: int) -> dict:
+    try:
+        from ui.autocomplete_input import StatLanguageModel, _read_file_text
+    except Exception as e:
+        return {"skipped": f"autocomplete import failed: {e}"}
+
+    texts = [_read_file_text(p) for p in files]
+    train_ms = []
+    model = None
+    for _ in range(max(1, reps // 2)):
+        model = StatLanguageModel()
+        t0 = time.perf_counter()
+        for text in texts:
+            model.train(text)
+        train_ms.append(_ms(t0))
+
+    prefixes = ["д", "по", "инд", "за", "се", "бю"]
+    contexts = [[], ["поиск"], ["модель", "ответ"], ["бюджет", "проект"]]
+    complete_ms, predict_ms = [], []
+    for _ in range(reps):
+        for prefix in prefixes:
+            for ctx in contexts:
+                t0 = time.perf_counter()
+                model.complete_word(prefix, ctx)
+                complete_ms.append(_ms(t0))
+                t0 = time.perf_counter()
+                model.predict_next(ctx, prefix=prefix)
+                predict_ms.append(_ms(t0))
+
+    return {
+        "vocab": model.trie.size,
+        "train": _stats(train_ms),
+        "complete_word": _stats(complete_ms),
+        "predict_next": _stats(predict_ms),
+    }
+
+
+# ── запуск ──────────────────────────────────────────────────────────────
+
+def run(args) -> dict:
+    only = [b for b in (args.only.split(",") if args.only else ALL_BENCHMARKS) if b in ALL_BENCHMARKS]
+    work_dir = tempfile.mkdtemp(prefix="rag_bench_")
+    corpus_dir = os.path.join(work_dir, "corpus")
+    cfg = FakeOllamaConfig(
+        prefill_ms_per_1k_chars=args.prefill_ms_per_1k,
+        token_ms=args.token_ms,
+        model=BENCH_MODEL,
+    )
+    server = FakeOllamaServer(cfg=cfg).start_background()
+
+    # Изолируем приложение: свой Ollama и свой кеш, реальные данные пользователя не трогаем
+    os.environ["RAG_OLLAMA_URL"] = server.base_url
+    os.environ["LOCALAPPDATA"] = os.path.join(work_dir, "appdata")
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "files": args.files,
+            "size_kb": args.size_kb,
+            "formats": args.formats,
+            "reps": args.reps,
+            "prefill_ms_per_1k": args.prefill_ms_per_1k,
+            "token_ms": args.token_ms,
+        },
+        "results": {},
+    }
+    try:
+        files = generate_corpus(corpus_dir, args.files, args.size_kb, args.formats.split(","), args.seed)
+        print(f"[BENCH] Корпус: {len(files)} файлов в {corpus_dir}")
+
+        vectorstore = None
+        if any(b in only for b in ("build_index", "qa_chain", "prefix_reuse", "rerank", "rerank_backends")):
+            print("[BENCH] build_index...")
+            result, vectorstore = bench_build_index(corpus_dir, files, args.reps if "build_index" in only else 1)
+            if "build_index" in only:
+                report["results"]["build_index"] = result
+
+        if "qa_chain" in only and vectorstore is not None:
+            print("[BENCH] qa_chain...")
+            report["results"]["qa_chain"] = bench_qa_chain(vectorstore, corpus_dir, files, args.reps)
+
+        if "prefix_reuse" in only and vectorstore is not None:
+            print("[BENCH] prefix_reuse...")
+            report["results"]["prefix_reuse"] = bench_prefix_reuse(vectorstore, corpus_dir, files, args.reps, server)
+
+        if "rerank" in only and vectorstore is not None:
+            print("[BENCH] rerank...")
+            report["results"]["rerank"] = bench_rerank(vectorstore, args.reps)
+
+        if "rerank_backends" in only and vectorstore is not None:
+            print("[BENCH] rerank_backends...")
+            report["results"]["rerank_backends"] = bench_reranker_backends(vectorstore, args.reps)
+
+        if "autocomplete" in only:
+            print("[BENCH] autocomplete...")
+            report["results"]["autocomplete"] = bench_autocomplete(files, args.reps)
+
+        report["fake_ollama"] = dict(server.counters)
+    finally:
+        server.stop()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки RAG Assistant с фейковым Ollama")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size-kb", type=int, default=16)
+    parser.add_argument("--formats", default=",".join(ALL_FORMATS))
+    parser.add_argument("--reps", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=5.0)
+    parser.add_argument("--token-ms", type=float, default=2.0)
+    parser.add_argument("--only", help=f"через запятую: {','.join(ALL_BENCHMARKS)}")
+    parser.add_argument("--out", help="путь к JSON с результатом")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку с корпусом и кешем")
+    args = parser.parse_args()
+
+    report = run(args)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_path = args.out or os.path.join(RESULTS_DIR, f"bench_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(RESULTS_DIR, "history.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(report, ensure_ascii=False) + "\n")
+
+    print(json.dumps(report["results"], ensure_ascii=False, indent=2))
+    print(f"[BENCH] Результат: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
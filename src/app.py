@@ -5,8 +5,10 @@ import os
 import logging
 from logging.handlers import RotatingFileHandler
 from cache import get_cache_root, prepare_virtual_folder_for_file
+from indexer import find_covering_index
 from PyQt6.QtWidgets import QApplication
 from ui.main_window import MainWindow
+from coordinator import get_coordinator_pool
 
 
 def main():
@@ -16,8 +18,10 @@ def main():
 
     - <path> can be a file or a directory. If it's a file, the parent directory
       will be used for indexing and the file path will be passed as a file filter
-      to the assistant. NEW: if launched with --tell or --ask, single file will be
-      indexed only (via virtual folder in cache) instead of scanning parent folder.
+      to the assistant. NEW: if launched with --tell or --ask, the file is answered
+      from an existing index that already covers it (parent folder or an ancestor,
+      queries filtered to the file); only if there is none, the single file is
+      indexed on its own (via virtual folder in cache).
     - --tell : index and immediately ask the canned question "О чем файлы"
     - --ask  : index and open UI so user can type their question
     """
@@ -44,7 +48,17 @@ def main():
         elif arg in ("--ask", "ask"):
             initial_mode = "ask"
 
+    scope_file = None
+    covering_folder = None
     if initial_file_filter and initial_mode in ("tell", "ask"):
+        covering_folder = find_covering_index(initial_file_filter)
+
+    if covering_folder:
+        # Индекс папки уже содержит файл — ответ без нового прохода эмбеддингов
+        logging.info(f"Single-file mode: reusing index of {covering_folder} for {initial_file_filter}")
+        folder_path = covering_folder
+        scope_file = initial_file_filter
+    elif initial_file_filter and initial_mode in ("tell", "ask"):
         try:
             logging.info(f"Single-file mode: preparing virtual folder for {initial_file_filter}")
             folder_path = prepare_virtual_folder_for_file(initial_file_filter)
@@ -127,11 +141,10 @@ def main():
     except Exception:
         pass
 
-    app.main_window = MainWindow(folder_path)
+    app.main_window = MainWindow(folder_path, scope_file=scope_file)
 
-    app.aboutToQuit.connect(
-        lambda: app.main_window.coordinator.close() if app.main_window.coordinator else None
-    )
+    # Закрываются все загруженные индексы папок, а не только текущей
+    app.aboutToQuit.connect(lambda: get_coordinator_pool().close_all())
 
     if folder_path and initial_mode:
 
@@ -0,0 +1,351 @@
+"""
+async_engine.py — asyncio-движок вопросов рядом с путём через QThreadPool.
+
+AskRunnable занимает поток пула на всё время вопроса, включая ожидание
+Ollama/OpenRouter, поэтому несколько параллельных вопросов из разных чатов
+быстро выбирают весь пул. Движок вместо этого:
+
+  * держит один поток с event loop на весь процесс;
+  * эмбеддинг вопроса и стрим ответа Ollama идут через aiohttp — ожидание
+    сети не занимает потоков;
+  * retrieval (FAISS, выбор файла, сборка контекста) и финализация ответа
+    выполняются цепочкой в небольшом ThreadPoolExecutor — это CPU-работа;
+  * результат уходит в on_result(payload) — координатор передаёт туда emit
+    Qt-сигнала, который сам доставляет его в GUI-поток.
+
+Десятки одновременных вопросов стоят loop-поток + CPU_WORKERS потоков.
+Ветки сводок и OpenRouter (ретраи, breakers, hedging — синхронный клиент)
+выполняются в том же executor, сеть там по-прежнему блокирующая.
+Без aiohttp движок недоступен, и координатор остаётся на QThreadPool.
+Слоты планировщика (scheduler.py) ждутся через acquire_async — тоже без потока.
+"""
+
+from __future__ import annotations
+
+import time
+import asyncio
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Optional
+
+try:
+    import aiohttp
+except ImportError:  # движок необязателен
+    aiohttp = None
+
+from config import OLLAMA_BASE_URL
+from tracing import QueryTrace
+from ollama_generate import OllamaGenerateLLM
+from scheduler import get_scheduler, Priority
+
+CPU_WORKERS = 4
+_HTTP_LIMIT = 32
+_EMBED_TIMEOUT_S = 30
+_GENERATE_READ_TIMEOUT_S = 120
+
+_engine: Optional["AsyncQueryEngine"] = None
+_engine_lock = threading.Lock()
+
+
+def is_available() -> bool:
+    return aiohttp is not None
+
+
+def ui_final_payload(item: dict, cum: str = "", trace: Optional[dict] = None) -> dict:
+    """Финальный ответ цепочки → формат, который ждёт MainWindow.on_answer."""
+    sources = item.get("sources") if isinstance(item.get("sources"), (str, list, set)) else ""
+    if isinstance(sources, set):
+        sources = ", ".join([s for s in sources if s])
+    return {
+        "result": item.get("result") or item.get("partial") or item.get("content") or cum,
+        "sources": sources,
+        "highlight_chunks": item.get("highlight_chunks", []),
+        "keywords": item.get("keywords", []),
+        "formatted_context": item.get("formatted_context", ""),
+        "model_used": item.get("model_used", ""),
+        "llm_provider": item.get("llm_provider", ""),
+        "trace": trace,
+        "final": True,
+    }
+
+
+def _query_rewritten(conversation, query: str) -> bool:
+    """Уточнение в диалоге ищется по переписанному запросу — вектор исходного не пригодится."""
+    if conversation is None:
+        return False
+    from rag import extract_keywords_from_query
+    return conversation.rewrite_query(query, extract_keywords_from_query) != query
+
+
+def _chunk_text(chunk) -> str:
+    if isinstance(chunk, str):
+        return chunk
+    text = getattr(chunk, "content", None)
+    return text if isinstance(text, str) else ""
+
+
+class AsyncQueryEngine:
+    """Один event loop в отдельном потоке + executor для CPU-этапов цепочки."""
+
+    def __init__(self, cpu_workers: int = CPU_WORKERS):
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="query-cpu")
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self.in_flight = 0
+        self._thread = threading.Thread(target=self._run, name="async-query-engine", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def _get_session(self) -> "aiohttp.ClientSession":
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=_HTTP_LIMIT))
+        return self._session
+
+    # ── API для координатора ─────────────────────────────────────────────
+
+    def submit(self, coordinator, query: str, file_filter: Optional[str], on_result: Callable[[dict], None],
+               conversation=None, chain=None) -> Future:
+        """
+        Ставит вопрос в loop и сразу возвращается. on_result вызывается из потока loop.
+        chain — своя цепочка (вопрос по нескольким папкам); None — coordinator.qa_chain.
+        """
+        trace = QueryTrace(query)
+        trace.attrs["engine"] = "async"
+        submitted_at = time.perf_counter()
+        return asyncio.run_coroutine_threadsafe(
+            self._ask(coordinator, query, file_filter, on_result, conversation, trace, submitted_at, chain),
+            self._loop,
+        )
+
+    def shutdown(self) -> None:
+        async def _close():
+            if self._session is not None:
+                await self._session.close()
+        try:
+            asyncio.run_coroutine_threadsafe(_close(), self._loop).result(timeout=2)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=False)
+
+    # ── этапы ────────────────────────────────────────────────────────────
+
+    async def embed_query(self, model: str, text: str) -> Optional[list]:
+        """Эмбеддинг вопроса через /api/embed (тот же эндпоинт, что у OllamaEmbeddings)."""
+        session = await self._get_session()
+        async with session.post(
+            f"{OLLAMA_BASE_URL}/api/embed",
+            json={"model": model, "input": text},
+            timeout=aiohttp.ClientTimeout(total=_EMBED_TIMEOUT_S),
+        ) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.json()
+        embeddings = data.get("embeddings") or []
+        return embeddings[0] if embeddings else None
+
+    async def _stream_ollama(self, llm: OllamaGenerateLLM, req: dict, stats: dict):
+        """Стрим /api/generate через aiohttp с тем же переиспользованием префикса, что и синхронный клиент."""
+        payload, reused = llm.begin_scoped(req["scope"], req["preamble"], req["context"], req["question"],
+                                           req["history"], stats)
+        done_event = None
+        try:
+            session = await self._get_session()
+            async with session.post(
+                llm.url, json=payload,
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=_GENERATE_READ_TIMEOUT_S),
+            ) as resp:
+                if resp.status != 200:
+                    raise RuntimeError(f"Ollama {resp.status}: {(await resp.text())[:200]}")
+                async for line in resp.content:
+                    event = llm.parse_event(line.strip())
+                    if event is None:
+                        continue
+                    if event.get("response"):
+                        yield event["response"], llm.model
+                    if event.get("done"):
+                        done_event = event
+                        break
+        finally:
+            llm.end_scoped(req["scope"], req["context"], reused, done_event, stats)
+
+    async def _stream_in_executor(self, llm, prompt_text: str):
+        """Синхронный стрим клиента (OpenRouter и т.п.): каждый next() — в executor."""
+        loop = asyncio.get_running_loop()
+        it = iter(llm.stream(prompt_text))
+        end = object()
+        while True:
+            chunk = await loop.run_in_executor(self._executor, next, it, end)
+            if chunk is end:
+                return
+            yield _chunk_text(chunk), getattr(chunk, "model_used", None)
+
+    @staticmethod
+    def _forward_highlights(coordinator, req: dict, trace: QueryTrace, on_result) -> None:
+        """Отдать подсветку, как только reranker её посчитает, не дожидаясь конца генерации."""
+        future = req.get("highlights")
+        if future is None:
+            return
+        from rag import highlights_event
+        t0 = time.perf_counter()
+
+        def _done(fut):
+            # После финального payload подсветка уже в нём — раннее событие не нужно
+            if req.get("finished"):
+                return
+            event = highlights_event(fut)
+            if event is not None and not getattr(coordinator, "closing", False):
+                trace.add_span("highlights_early", t0, chunks=len(event["highlights"]))
+                on_result(event)
+
+        # Callback — в потоке loop, как и остальные on_result
+        asyncio.wrap_future(future).add_done_callback(_done)
+
+    async def _generate(self, coordinator, req: dict, trace: QueryTrace, on_result) -> dict:
+        loop = asyncio.get_running_loop()
+        llm = req["llm"]
+        stats: dict = {}
+        cum = ""
+        model_used = None
+        error = None
+        t_llm = time.perf_counter()
+        local = isinstance(llm, OllamaGenerateLLM)
+        self._forward_highlights(coordinator, req, trace, on_result)
+        # Лимит "llm" — про локальный Ollama; OpenRouter ограничивает себя сам
+        slot = await get_scheduler().acquire_async("llm") if local else None
+        if slot is not None:
+            stats["queue_ms"] = round(slot.wait_ms, 1)
+        if local:
+            stream = self._stream_ollama(llm, req, stats)
+        else:
+            stream = self._stream_in_executor(llm, req["prompt_text"])
+        try:
+            async for text, model in stream:
+                if getattr(coordinator, "closing", False):
+                    break
+                model_used = model or model_used
+                text = text.replace("\r", "")
+                if not text.strip():
+                    continue
+                if not cum:
+                    trace.add_span("llm_first_token", t_llm)
+                cum += text
+                on_result({"delta": text, "final": False})
+        except Exception as e:
+            error = e
+        finally:
+            await stream.aclose()
+            if slot is not None:
+                slot.release()
+        trace.add_span("llm_generate", t_llm, streamed=True, chars=len(cum), **stats)
+
+        if error is not None and not cum:
+            # Стрим упал до первого токена — обычный вызов, как в синхронной цепочке
+            try:
+                with trace.span("llm_generate_fallback"):
+                    slot = await get_scheduler().acquire_async("llm") if local else None
+                    try:
+                        answer_obj = await loop.run_in_executor(self._executor, llm.invoke, req["prompt_text"])
+                    finally:
+                        if slot is not None:
+                            slot.release()
+                cum = answer_obj.content
+                model_used = getattr(answer_obj, "model_used", None) or model_used
+            except Exception as e:
+                cum = f"Ошибка при запросе к модели: {e}"
+        final = await loop.run_in_executor(self._executor, req["finish"], cum.strip(), model_used)
+        req["finished"] = True
+        return final
+
+    async def _ask(self, coordinator, query, file_filter, on_result, conversation, trace: QueryTrace,
+                   submitted_at: float, chain=None):
+        # Пока вопрос в работе, фоновые задачи не получают слотов (как у AskRunnable)
+        with get_scheduler().task(Priority.INTERACTIVE):
+            await self._ask_interactive(coordinator, query, file_filter, on_result, conversation, trace,
+                                        submitted_at, chain)
+
+    async def _ask_interactive(self, coordinator, query, file_filter, on_result, conversation, trace: QueryTrace,
+                               submitted_at: float, chain=None):
+        loop = asyncio.get_running_loop()
+        trace.add_span("loop_wait", submitted_at)
+        self.in_flight += 1
+        try:
+            if getattr(coordinator, "closing", False):
+                return
+            chain = chain or coordinator.qa_chain
+            if not chain:
+                on_result({"result": "Индексация не завершена.", "sources": ""})
+                return
+
+            # Эмбеддинг — асинхронно; цепочка получит готовый вектор и не будет эмбеддить в потоке
+            vector = None
+            embeddings = getattr(coordinator.vectorstore, "embeddings", None)
+            embed_model = getattr(embeddings, "model", None)
+            if embed_model and not _query_rewritten(conversation, query):
+                try:
+                    with trace.span("embed_query_async"):
+                        with await get_scheduler().acquire_async("embedder"):
+                            vector = await self.embed_query(embed_model, query)
+                except Exception as e:
+                    logging.info(f"[ASYNC] Эмбеддинг вопроса не получен, цепочка посчитает сама: {e}")
+
+            try:
+                with trace.span("qa_chain_call"):
+                    resp = await loop.run_in_executor(self._executor, functools.partial(
+                        chain, query, file_filter=file_filter, query_embedding=vector, trace=trace,
+                        conversation=conversation, defer_llm=True,
+                    ))
+            except Exception as e:
+                on_result({"result": f"Ошибка: {e}", "sources": ""})
+                return
+
+            if isinstance(resp, dict) and resp.get("deferred"):
+                final = await self._generate(coordinator, resp, trace, on_result)
+            elif isinstance(resp, dict):
+                final = resp
+            else:
+                # Цепочка вернула синхронный стрим — дочитываем его в executor
+                final, cum, end = {}, "", object()
+                it = iter(resp)
+                while True:
+                    item = await loop.run_in_executor(self._executor, next, it, end)
+                    if item is end:
+                        break
+                    if isinstance(item, dict) and item.get("delta"):
+                        cum += item["delta"]
+                        on_result({"delta": item["delta"], "final": False})
+                    elif isinstance(item, dict) and item.get("highlights") and not item.get("final"):
+                        on_result({"highlights": item["highlights"], "final": False})
+                    elif isinstance(item, dict) and item.get("final"):
+                        final = item
+                final = final or {"result": cum}
+
+            if not getattr(coordinator, "closing", False):
+                on_result(ui_final_payload(final, trace=trace.finish()))
+        except Exception as e:
+            logging.error(f"[ASYNC] Ошибка вопроса: {e}")
+            try:
+                on_result({"result": f"Ошибка: {e}", "sources": ""})
+            except Exception:
+                pass
+        finally:
+            self.in_flight -= 1
+            trace.finish()
+
+
+def get_async_engine() -> Optional[AsyncQueryEngine]:
+    """Движок на весь процесс (создаётся при первом обращении); None без aiohttp."""
+    global _engine
+    if not is_available():
+        return None
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = AsyncQueryEngine()
+                logging.info(f"[ASYNC] Движок запросов запущен (loop + {CPU_WORKERS} CPU-потоков)")
+    return _engine
@@ -13,13 +13,14 @@ def get_cache_root():
     return base
 
 
-def get_folder_cache_dir(folder_path: str) -> str:
+def get_folder_cache_dir(folder_path: str, create: bool = True) -> str:
     folder_path = os.path.abspath(folder_path)
     name = os.path.basename(folder_path.rstrip(os.sep)) or 'root'
     h = hashlib.sha256(folder_path.encode('utf-8')).hexdigest()[:16]
     cache_root = get_cache_root()
     folder_cache = os.path.join(cache_root, f"{name}_{h}")
-    os.makedirs(folder_cache, exist_ok=True)
+    if create:
+        os.makedirs(folder_cache, exist_ok=True)
     return folder_cache
 
 
@@ -5,10 +5,47 @@ MODEL_NAME = "gemma3:4b"
 EMBEDDING_MODEL = "embeddinggemma"
 SUPPORTED_FORMATS = ["pdf", "txt", "docx", "html", "md", "png", "jpg", "jpeg"]
 
+_OLLAMA_DEFAULT_PORT = 11434
+
+
+def _ollama_base_url() -> str:
+    """
+    Адрес Ollama для клиента. RAG_OLLAMA_URL — адрес целиком (например,
+    фейковый сервер из benchmarks/fake_ollama.py). OLLAMA_HOST — переменная
+    самого сервера, там бывает адрес привязки ("0.0.0.0", ":11434"): без
+    порта подставляется 11434 (443 для https), 0.0.0.0 и пустой хост — 127.0.0.1.
+    """
+    url = os.getenv("RAG_OLLAMA_URL", "").strip().rstrip("/")
+    if url:
+        return url if "://" in url else "http://" + url
+    host = os.getenv("OLLAMA_HOST", "").strip().rstrip("/")
+    if not host:
+        return f"http://127.0.0.1:{_OLLAMA_DEFAULT_PORT}"
+    scheme, _, rest = host.rpartition("://")
+    netloc, slash, path = rest.partition("/")
+    hostname, colon, port = netloc.rpartition(":")
+    if not colon or netloc.endswith("]"):
+        hostname, port = netloc, ""   # порта нет (в том числе голый IPv6 в скобках)
+    if hostname in ("", "0.0.0.0", "[::]"):
+        hostname = "127.0.0.1"
+    scheme = scheme or "http"
+    port = port or ("443" if scheme == "https" else str(_OLLAMA_DEFAULT_PORT))
+    return f"{scheme}://{hostname}:{port}{slash}{path}".rstrip("/")
+
+
+OLLAMA_BASE_URL = _ollama_base_url()
+
 # LLM provider: "ollama" or "openrouter"
 LLM_PROVIDER = "ollama"
 OPENROUTER_API_KEY = ""
 OPENROUTER_MODEL = "openrouter/elephant-alpha"
+# При ошибке выбранной модели пробовать другие бесплатные (см. openrouter.py)
+OPENROUTER_FALLBACK = True
+# Hedging: через сколько мс без ответа запускать параллельно следующую модель (0 — выключено)
+OPENROUTER_HEDGE_MS = 0
+
+# Бюджет контекста (фрагменты документов) в токенах целевой модели
+CONTEXT_TOKENS = 3000
 
 # Бесплатные модели OpenRouter (без ограничений, суффикс :free)
 OPENROUTER_FREE_MODELS = [
@@ -25,6 +62,33 @@ OPENROUTER_FREE_MODELS = [
     "google/gemma-4-31b-it:free",
 ]
 
+# Вопросы через asyncio-движок (async_engine.py) вместо потока QThreadPool на вопрос
+ASYNC_ENGINE = True
+
+# Бэкенд reranker (reranker.BACKENDS): torch — полная точность, int8 — динамическая
+# квантизация torch, onnx — экспорт в ONNX Runtime с int8 (нужны optimum и onnxruntime)
+RERANKER_BACKEND = "torch"
+# Пар в одном батче reranker и длина фрагмента (символы), до которой он обрезается вокруг слов вопроса
+RERANKER_BATCH_SIZE = 16
+RERANKER_MAX_CHARS = 1000
+
+# Второй этап поиска: MMR набирает candidates кандидатов, cross-encoder
+# переранжирует их за budget_ms (что не успел — остаётся в порядке MMR),
+# в контекст LLM идут top_k лучших. Профиль "auto" — по бэкенду reranker
+# и наличию CUDA (reranker.hardware_profile)
+RETRIEVAL_RERANK = False
+RETRIEVAL_RERANK_PROFILE = "auto"
+RETRIEVAL_RERANK_PROFILES = {
+    "cpu": {"candidates": 16, "top_k": 6, "budget_ms": 150},
+    "gpu": {"candidates": 40, "top_k": 6, "budget_ms": 80},
+}
+
+# Сколько памяти могут занимать загруженные индексы папок (CoordinatorPool, LRU)
+INDEX_MEMORY_BUDGET_MB = 1024
+
+# Отладка: сохранять найденные чанки каждого ответа в <кеш папки>/retrieval_traces/
+RETRIEVAL_TRACES = False
+
 _SETTINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache", "settings.json")
 
 
@@ -63,4 +127,48 @@ def get_llm_settings() -> dict:
         "ollama_model":     s.get("ollama_model", MODEL_NAME),
         "openrouter_key":   s.get("openrouter_key", OPENROUTER_API_KEY),
         "openrouter_model": s.get("openrouter_model", OPENROUTER_MODEL),
+        "openrouter_fallback": bool(s.get("openrouter_fallback", OPENROUTER_FALLBACK)),
+        "openrouter_hedge_ms": int(s.get("openrouter_hedge_ms", OPENROUTER_HEDGE_MS) or 0),
+        "context_tokens":   int(s.get("context_tokens", CONTEXT_TOKENS) or CONTEXT_TOKENS),
+        "async_engine":     bool(s.get("async_engine", ASYNC_ENGINE)),
+    }
+
+
+def get_reranker_settings() -> dict:
+    """Настройки reranker (из файла или дефолты)."""
+    s = load_settings()
+    return {
+        "backend": s.get("reranker_backend", RERANKER_BACKEND),
+        "batch_size": int(s.get("reranker_batch_size", RERANKER_BATCH_SIZE) or RERANKER_BATCH_SIZE),
+        "max_chars": int(s.get("reranker_max_chars", RERANKER_MAX_CHARS) or RERANKER_MAX_CHARS),
+    }
+
+
+def get_retrieval_settings(hardware: str = "cpu") -> dict:
+    """
+    Настройки второго этапа поиска. Профиль "auto" разрешается в hardware
+    ("cpu"/"gpu"); отдельные числа можно переопределить ключами
+    retrieval_rerank_candidates / _top_k / _budget_ms в settings.json.
+    """
+    s = load_settings()
+    profile = s.get("retrieval_rerank_profile", RETRIEVAL_RERANK_PROFILE)
+    if profile not in RETRIEVAL_RERANK_PROFILES:
+        profile = hardware if hardware in RETRIEVAL_RERANK_PROFILES else "cpu"
+    params = dict(RETRIEVAL_RERANK_PROFILES[profile])
+    for name in params:
+        value = s.get(f"retrieval_rerank_{name}")
+        if value:
+            params[name] = int(value)
+    return {
+        "rerank": bool(s.get("retrieval_rerank", RETRIEVAL_RERANK)),
+        "profile": profile,
+        **params,
+    }
+
+
+def get_debug_settings() -> dict:
+    """Отладочные флаги (из файла или дефолты)."""
+    s = load_settings()
+    return {
+        "retrieval_traces": bool(s.get("retrieval_traces", RETRIEVAL_TRACES)),
     }
@@ -0,0 +1,249 @@
+"""
+context_builder.py — сборка контекста для LLM в бюджет токенов.
+
+Вместо склейки всех найденных чанков и обрезки промпта по символам:
+
+  * токены считаются токенизатором целевой модели, если он есть в локальном
+    кеше HuggingFace (без сети), иначе — эвристикой по символам;
+    подсчёты кешируются по тексту чанка;
+  * чанки берутся в порядке релевантности, пока помещаются в бюджет;
+  * соседние/перекрывающиеся чанки одного файла (по start_char/end_char)
+    склеиваются в один фрагмент, а 80-символьное перекрытие сплиттера
+    не повторяется дважды.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Бюджет контекста по умолчанию (токены только на фрагменты документов)
+DEFAULT_CONTEXT_TOKENS = 3000
+
+_COUNT_CACHE_SIZE = 8192
+
+# Семейство модели Ollama / OpenRouter → репозиторий HF с tokenizer.json
+_HF_TOKENIZER_REPOS = [
+    (re.compile(r"gemma-?3|gemma3"), "google/gemma-3-4b-it"),
+    (re.compile(r"gemma-?2|gemma2"), "google/gemma-2-2b-it"),
+    (re.compile(r"gemma"), "google/gemma-3-4b-it"),
+    (re.compile(r"qwen"), "Qwen/Qwen2.5-7B-Instruct"),
+    (re.compile(r"llama-?3|llama3"), "meta-llama/Llama-3.1-8B-Instruct"),
+    (re.compile(r"mistral"), "mistralai/Mistral-7B-Instruct-v0.3"),
+]
+
+_CYRILLIC_RE = re.compile(r"[Ѐ-ӿ]")
+
+
+class TokenCounter:
+    """Счётчик токенов с LRU-кешем; tokenizer=None — эвристика."""
+
+    def __init__(self, name: str, tokenizer=None):
+        self.name = name
+        self._tokenizer = tokenizer
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def exact(self) -> bool:
+        return self._tokenizer is not None
+
+    def _count_uncached(self, text: str) -> int:
+        if self._tokenizer is not None:
+            try:
+                return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+            except Exception:
+                pass
+        # Эвристика: кириллица ~2.8 символа на токен, латиница/цифры ~3.8
+        cyr = len(_CYRILLIC_RE.findall(text))
+        return int(cyr / 2.8 + (len(text) - cyr) / 3.8) + 1
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        with self._lock:
+            n = self._cache.get(text)
+            if n is not None:
+                self._cache.move_to_end(text)
+                return n
+        n = self._count_uncached(text)
+        with self._lock:
+            self._cache[text] = n
+            if len(self._cache) > _COUNT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return n
+
+
+_counters: dict = {}
+_counters_lock = threading.Lock()
+
+
+def _hf_repo_for(model_name: str) -> Optional[str]:
+    name = (model_name or "").lower().split(":")[0]
+    if "/" in name:
+        # Модель OpenRouter: сначала пробуем репозиторий с тем же именем
+        return (model_name or "").split(":")[0]
+    for pattern, repo in _HF_TOKENIZER_REPOS:
+        if pattern.search(name):
+            return repo
+    return None
+
+
+def _load_hf_tokenizer(repo: str):
+    """tokenizer.json только из локального кеша HF — без сетевых запросов."""
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        from tokenizers import Tokenizer
+    except ImportError:
+        return None
+    try:
+        path = try_to_load_from_cache(repo, "tokenizer.json")
+        if isinstance(path, str) and os.path.exists(path):
+            return Tokenizer.from_file(path)
+    except Exception as e:
+        logging.info(f"[CONTEXT] Токенизатор {repo} не загружен: {e}")
+    return None
+
+
+def get_token_counter(model_name: str) -> TokenCounter:
+    """Счётчик для модели (один на процесс); при отсутствии токенизатора — эвристика."""
+    key = (model_name or "").lower()
+    counter = _counters.get(key)
+    if counter is not None:
+        return counter
+    with _counters_lock:
+        counter = _counters.get(key)
+        if counter is None:
+            repo = _hf_repo_for(model_name)
+            tokenizer = _load_hf_tokenizer(repo) if repo else None
+            counter = TokenCounter(repo if tokenizer is not None else "heuristic", tokenizer)
+            logging.info(f"[CONTEXT] Подсчёт токенов для {model_name}: {counter.name}")
+            _counters[key] = counter
+    return counter
+
+
+def warm_token_counter(model_name: str) -> None:
+    """Загрузить токенизатор в фоне, чтобы первый вопрос не ждал."""
+    threading.Thread(target=get_token_counter, args=(model_name,), name="tokenizer-warmup", daemon=True).start()
+
+
+# ── Упаковка ─────────────────────────────────────────────────────────────
+
+def _span(doc):
+    start = doc.metadata.get("start_char")
+    end = doc.metadata.get("end_char")
+    if isinstance(start, int) and isinstance(end, int) and end > start:
+        return start, end
+    return None
+
+
+def _uncovered_fraction(span, covered: list) -> float:
+    """Доля диапазона span, не покрытая уже выбранными диапазонами того же файла."""
+    start, end = span
+    total = end - start
+    free = total
+    for s, e in covered:
+        overlap = min(end, e) - max(start, s)
+        if overlap > 0:
+            free -= overlap
+    return max(0.0, free / total) if total else 0.0
+
+
+def _merge_file_chunks(items: list) -> list:
+    """
+    items — [(rank, doc)] одного файла. Возвращает [(rank, text)] в порядке
+    позиции в файле; перекрывающиеся и смежные чанки склеены без повторов.
+    """
+    with_span = sorted((it for it in items if _span(it[1])), key=lambda it: _span(it[1]))
+    blocks = []  # [rank, start, end, text]
+    for rank, doc in with_span:
+        start, end = _span(doc)
+        text = doc.page_content
+        if blocks and start <= blocks[-1][2]:
+            last = blocks[-1]
+            if end > last[2]:
+                # Отрезаем перекрытие: в тексте чанка оно занимает первые (last_end - start) символов
+                last[3] += text[last[2] - start:]
+                last[2] = end
+            last[0] = min(last[0], rank)
+        else:
+            blocks.append([rank, start, end, text])
+    merged = [(b[0], b[3]) for b in blocks]
+    merged += [(rank, doc.page_content) for rank, doc in items if not _span(doc)]
+    return merged
+
+
+def build_context(docs: list, budget_tokens: int = DEFAULT_CONTEXT_TOKENS, model_name: str = "",
+                  counter: Optional[TokenCounter] = None) -> tuple:
+    """
+    Собирает контекст из docs (в порядке убывания релевантности) в пределах
+    budget_tokens. Возвращает (текст контекста, статистика).
+    """
+    if not docs:
+        return "Нет релевантного контекста", {"tokens": 0, "chunks_in": 0, "chunks_used": 0}
+    counter = counter or get_token_counter(model_name)
+
+    selected = []          # [(rank, doc)]
+    covered: dict = {}     # source -> [(start, end)]
+    used_tokens = 0
+    header_tokens = counter.count("[Источник: ]\n\n\n")
+    sources_seen = set()
+    dropped = 0
+    for rank, doc in enumerate(docs):
+        source = doc.metadata.get("source", "")
+        span = _span(doc)
+        chunk_tokens = counter.count(doc.page_content)
+        cost = chunk_tokens
+        if span is not None:
+            cost = int(chunk_tokens * _uncovered_fraction(span, covered.get(source, [])) + 0.5)
+            if cost == 0:
+                continue  # полностью покрыт уже выбранными чанками
+        if source not in sources_seen:
+            cost += counter.count(os.path.basename(source)) + header_tokens
+        if used_tokens + cost > budget_tokens:
+            dropped += 1
+            continue
+        selected.append((rank, doc))
+        used_tokens += cost
+        sources_seen.add(source)
+        if span is not None:
+            covered.setdefault(source, []).append(span)
+
+    if not selected:
+        # Даже лучший чанк не влезает — берём его, обрезав по границе слова
+        doc = docs[0]
+        text = doc.page_content
+        ratio = budget_tokens / max(1, counter.count(text))
+        cut = text[:max(1, int(len(text) * ratio))]
+        cut = cut.rsplit(" ", 1)[0] if " " in cut else cut
+        selected_blocks = {doc.metadata.get("source", ""): [(0, cut)]}
+    else:
+        by_source: dict = {}
+        for rank, doc in selected:
+            by_source.setdefault(doc.metadata.get("source", ""), []).append((rank, doc))
+        selected_blocks = {src: _merge_file_chunks(items) for src, items in by_source.items()}
+
+    # Файлы — по лучшему рангу, фрагменты внутри файла — по позиции
+    ordered_sources = sorted(selected_blocks, key=lambda src: min(r for r, _ in selected_blocks[src]))
+    parts = []
+    n_blocks = 0
+    for src in ordered_sources:
+        name = os.path.basename(src) or "Неизвестный"
+        for _, text in selected_blocks[src]:
+            parts.append(f"[Источник: {name}]\n{text}\n")
+            n_blocks += 1
+    context = "\n\n".join(parts)
+    stats = {
+        "tokens": counter.count(context),
+        "budget": budget_tokens,
+        "chunks_in": len(docs),
+        "chunks_used": len(selected) or 1,
+        "blocks": n_blocks,
+        "dropped": dropped,
+        "tokenizer": counter.name,
+    }
+    return context, stats
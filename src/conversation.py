@@ -0,0 +1,206 @@
+"""
+conversation.py — состояние диалога для уточняющих вопросов.
+
+wrapped_qa_chain сам по себе не знает о прошлых репликах, поэтому «а подробнее?»
+искал по индексу бессмысленную строку. Conversation хранит:
+
+  * историю реплик (синхронизируется из MainWindow.conversations перед вопросом);
+  * что нашёл retrieval на прошлом ходу — область (файл) и чанки.
+
+Для уточняющего вопроса:
+  * запрос для поиска переписывается без LLM: к нему добавляются ключевые
+    слова предыдущего самостоятельного вопроса;
+  * если область не сменилась, переиспользуются чанки прошлого хода
+    (ни эмбеддинга, ни MMR);
+  * история попадает в промпт в пределах бюджета токенов: последние ходы —
+    как есть, более старые — сжатыми до «вопрос — первая фраза ответа».
+"""
+
+from __future__ import annotations
+
+import re
+import threading
+import uuid
+from typing import Optional
+
+# Бюджет токенов на историю в промпте (вычитается из бюджета контекста)
+DEFAULT_HISTORY_TOKENS = 600
+# Сколько последних ходов идут в промпт без сжатия
+_RECENT_TURNS = 2
+# Длина ответа в несжатом ходе
+_RECENT_ANSWER_CHARS = 600
+_COMPRESSED_ANSWER_CHARS = 160
+# Сколько ходов вообще храним
+_MAX_TURNS = 30
+
+_SOURCE_PREFIX = "Источник: "
+
+_FOLLOW_UP_STARTS = (
+    "а ", "и ", "но ", "ещё", "еще", "подробнее", "детальнее", "поподробнее",
+    "почему", "зачем", "как именно", "а что", "а как", "а где", "а когда",
+    "что ещё", "что еще", "продолж", "дальше", "то есть", "в смысле",
+)
+_FOLLOW_UP_WORDS = {
+    "это", "этого", "этом", "этот", "эта", "эти", "этих", "тот", "того", "там",
+    "он", "она", "оно", "они", "его", "её", "ее", "их", "ему", "ей", "им",
+    "него", "неё", "нее", "них", "выше",
+}
+# Слова-связки уточнений: сами по себе новую тему не задают
+_FOLLOW_UP_FILLER = {
+    "подробнее", "поподробнее", "детальнее", "почему", "зачем", "именно", "расскажи",
+    "объясни", "поясни", "продолжи", "дальше", "смысле", "конкретнее", "пример", "примеры",
+    "например", "также", "тоже", "какие", "какой", "какая", "каких", "сколько",
+}
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+
+
+def is_follow_up(query: str, previous: str, keywords_fn) -> bool:
+    """
+    Похоже ли на уточнение к прошлому вопросу previous (дёшево, по форме
+    вопроса). Короткий вопрос — уточнение, только если в нём нет новой темы:
+    «Бюджет проекта» — самостоятельный вопрос, «А сроки?» — нет.
+    """
+    q = query.lower().strip()
+    if not q:
+        return False
+    if q.startswith(_FOLLOW_UP_STARTS):
+        return True
+    words = _WORD_RE.findall(q)
+    if any(w in _FOLLOW_UP_WORDS for w in words):
+        return True
+    return len(words) <= 2 and not _new_topic_words(query, previous, keywords_fn)
+
+
+def _stem(word: str) -> str:
+    # Грубая основа: для сравнения «бюджет» / «бюджета» / «бюджетом»
+    return word[:5]
+
+
+def _new_topic_words(query: str, previous: str, keywords_fn) -> list:
+    """Ключевые слова вопроса, которых не было в прошлом вопросе (и не связки)."""
+    seen = {_stem(w) for w in _WORD_RE.findall(previous.lower())}
+    return [
+        w for w in keywords_fn(query, top_n=10)
+        if w not in _FOLLOW_UP_FILLER and w not in _FOLLOW_UP_WORDS and _stem(w) not in seen
+    ]
+
+
+def _first_sentence(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    head = _SENTENCE_END_RE.split(text, maxsplit=1)[0]
+    if len(head) > limit:
+        head = head[:limit].rsplit(" ", 1)[0] + "…"
+    return head
+
+
+def _clip(text: str, limit: int) -> str:
+    text = text.strip()
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+class Conversation:
+    """Диалог одного чата: история + память retrieval прошлого хода."""
+
+    def __init__(self):
+        # Стабильный ключ чата (id() объекта может достаться новому после сборки мусора)
+        self.id = uuid.uuid4().hex
+        self.turns: list = []   # [(вопрос, ответ)]
+        self.last_query = ""    # самостоятельная (переписанная) формулировка прошлого вопроса
+        self.last_scope: Optional[str] = None   # effective_file прошлого хода (None — вся папка)
+        self.last_best_file = ""
+        self.last_raw_docs: list = []
+        self.last_final_docs: list = []
+        self._lock = threading.Lock()
+
+    # ── история ──────────────────────────────────────────────────────────
+
+    def sync_history(self, messages: list) -> None:
+        """
+        messages — список (текст, is_user, время) из MainWindow.conversations.
+        Пары «вопрос → первый следующий ответ»; строки источников и служебные
+        сообщения без вопроса пропускаются.
+        """
+        turns = []
+        question = None
+        for content, is_user, _ts in messages:
+            if is_user:
+                question = content
+            elif question is not None and not content.startswith(_SOURCE_PREFIX):
+                turns.append((question, content))
+                question = None
+        with self._lock:
+            self.turns = turns[-_MAX_TURNS:]
+
+    def history_text(self, counter, budget_tokens: int = DEFAULT_HISTORY_TOKENS) -> tuple:
+        """
+        История для промпта в пределах budget_tokens. Возвращает (текст, токены).
+        Идём от свежих ходов к старым; последние _RECENT_TURNS — полнее, остальные сжаты.
+        """
+        with self._lock:
+            turns = list(self.turns)
+        if not turns or budget_tokens <= 0:
+            return "", 0
+        lines = []
+        used = 0
+        for age, (question, answer) in enumerate(reversed(turns)):
+            if age < _RECENT_TURNS:
+                line = f"Пользователь: {_clip(question, 300)}\nАссистент: {_clip(answer, _RECENT_ANSWER_CHARS)}"
+            else:
+                line = f"Пользователь: {_clip(question, 120)}\nАссистент: {_first_sentence(answer, _COMPRESSED_ANSWER_CHARS)}"
+            cost = counter.count(line)
+            if used + cost > budget_tokens:
+                break
+            lines.append(line)
+            used += cost
+        lines.reverse()
+        return "\n".join(lines), used
+
+    # ── retrieval ────────────────────────────────────────────────────────
+
+    def rewrite_query(self, query: str, keywords_fn) -> str:
+        """
+        Самостоятельная формулировка для поиска: к уточнению добавляются
+        ключевые слова прошлого вопроса. keywords_fn(text, top_n) -> [слова].
+        """
+        with self._lock:
+            previous = self.last_query
+        if not previous or not is_follow_up(query, previous, keywords_fn):
+            return query
+        own = set(_WORD_RE.findall(query.lower()))
+        extra = [w for w in keywords_fn(previous, top_n=6) if w not in own]
+        return f"{query} {' '.join(extra)}".strip() if extra else query
+
+    def reusable_docs(self, query: str, effective_file: Optional[str], keywords_fn) -> Optional[tuple]:
+        """
+        (raw_docs, final_docs, best_file, scope) прошлого хода, если вопрос —
+        уточнение без новой темы и область не сменилась; иначе None.
+        """
+        with self._lock:
+            if not self.last_final_docs or not is_follow_up(query, self.last_query, keywords_fn):
+                return None
+            if _new_topic_words(query, self.last_query, keywords_fn):
+                return None
+            if effective_file is not None and effective_file != self.last_scope:
+                return None
+            return list(self.last_raw_docs), list(self.last_final_docs), self.last_best_file, self.last_scope
+
+    def remember(self, standalone_query: str, scope: Optional[str], best_file: str,
+                 raw_docs: list, final_docs: list) -> None:
+        with self._lock:
+            self.last_query = standalone_query
+            self.last_scope = scope
+            self.last_best_file = best_file
+            self.last_raw_docs = list(raw_docs)
+            self.last_final_docs = list(final_docs)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.turns = []
+            self.last_query = ""
+            self.last_scope = None
+            self.last_best_file = ""
+            self.last_raw_docs = []
+            self.last_final_docs = []
@@ -1,13 +1,23 @@
 # src/coordinator.py
+import os
 import psutil
+import logging
 import traceback
+from collections import OrderedDict
 from typing import Optional, Dict, Any, Callable
-import re
 import time
 from PyQt6.QtCore import QObject, pyqtSignal, QRunnable, QThreadPool
-from indexer import build_index
+from indexer import build_index, load_index_for_file
 from rag import get_rag_chain, generate_suggested_questions
-from config import MODEL_NAME, EMBEDDING_MODEL, get_llm_settings
+from config import MODEL_NAME, EMBEDDING_MODEL, INDEX_MEMORY_BUDGET_MB, get_llm_settings
+from tracing import QueryTrace
+from metrics import IndexingMetrics, load_metrics
+from llm_clients import refresh_ollama_health, warm_up_ollama
+from reranker import warm_up_reranker
+from conversation import Conversation
+from async_engine import get_async_engine, ui_final_payload
+from scheduler import get_scheduler, Priority
+from multi_index import FanOutVectorStore, estimate_index_bytes
 
 
 class IndexingSignals(QObject):
@@ -38,15 +48,35 @@ class IndexingRunnable(QRunnable):
                 except Exception:
                     pass
 
-            vectorstore = build_index(
-                self.coordinator.folder_path,
-                EMBEDDING_MODEL,
-                progress_callback=_progress_callback,
-            )
+            metrics = IndexingMetrics(self.coordinator.folder_path)
+            self.coordinator.indexing_metrics = metrics
+            # Индексация — фоновый класс: уступает эмбеддер и OCR вопросам пользователя
+            with get_scheduler().task(Priority.INDEXING):
+                vectorstore = None
+                scope_file = self.coordinator.scope_file
+                if scope_file:
+                    # Вопрос по одному файлу: индекс папки берётся из кеша как есть
+                    try:
+                        vectorstore = load_index_for_file(
+                            self.coordinator.folder_path, scope_file, EMBEDDING_MODEL,
+                            progress_callback=_progress_callback, metrics=metrics,
+                        )
+                    except Exception as e:
+                        logging.warning(f"[COORD] Кеш папки не загрузился для {scope_file}: {e}")
+                if vectorstore is None:
+                    vectorstore = build_index(
+                        self.coordinator.folder_path,
+                        EMBEDDING_MODEL,
+                        progress_callback=_progress_callback,
+                        metrics=metrics,
+                    )
 
             if vectorstore:
                 self.coordinator.vectorstore = vectorstore
                 self.coordinator._rebuild_qa_chain()
+                # Индекс готов — загружаем модели в память, пока пользователь читает подсказки
+                self.coordinator.warm_up_llm()
+                warm_up_reranker()
 
                 # Generate suggested questions for the folder (non-blocking within this background runnable)
                 try:
@@ -56,6 +86,7 @@ class IndexingRunnable(QRunnable):
                         use_gpu=self.coordinator.use_gpu,
                         folder_path=self.coordinator.folder_path,
                         max_q=6,
+                        sources={scope_file} if scope_file else None,
                     )
                     self.coordinator.suggested_questions = suggestions or []
                 except Exception:
@@ -82,19 +113,36 @@ class IndexingRunnable(QRunnable):
 
 
 class AskRunnable(QRunnable):
-    def __init__(self, coordinator, query, file_filter):
+    def __init__(self, coordinator, query, file_filter, conversation=None, chain=None):
         super().__init__()
         self.coordinator = coordinator
         self.query = query
         self.file_filter = file_filter
+        self.conversation = conversation
+        # Своя цепочка (вопрос по нескольким папкам); None — цепочка координатора
+        self.chain = chain
         self.signals = AskSignals()
         self.setAutoDelete(False)
+        # Trace создаётся при постановке в очередь — первым span будет ожидание пула
+        self.trace = QueryTrace(query)
+        self._submitted_at = time.perf_counter()
+
+    def _final_trace(self) -> dict:
+        return self.trace.finish()
 
     def run(self):
+        # Пока идёт вопрос, фоновые задачи не получают слотов, а их текущие слоты вытесняются
+        with get_scheduler().task(Priority.INTERACTIVE):
+            self._run()
+
+    def _run(self):
+        trace = self.trace
+        trace.add_span("threadpool_wait", self._submitted_at)
         try:
             if getattr(self.coordinator, "closing", False):
                 return
-            if not self.coordinator.qa_chain:
+            chain = self.chain or self.coordinator.qa_chain
+            if not chain:
                 try:
                     self.signals.result.emit({"result": "Индексация не завершена.", "sources": ""})
                 except RuntimeError:
@@ -103,7 +151,9 @@ class AskRunnable(QRunnable):
 
             # Вызываем цепочку — она может вернуть dict (синхронно) или iterable (streaming)
             try:
-                resp = self.coordinator.qa_chain(self.query, file_filter=self.file_filter)
+                with trace.span("qa_chain_call"):
+                    resp = chain(self.query, file_filter=self.file_filter, trace=trace,
+                                 conversation=self.conversation)
             except Exception as e:
                 try:
                     self.signals.result.emit({"result": f"Ошибка: {e}", "sources": ""})
@@ -115,6 +165,8 @@ class AskRunnable(QRunnable):
             if hasattr(resp, "__iter__") and not isinstance(resp, dict) and not isinstance(resp, str):
                 try:
                     cum = ""
+                    t_stream = time.perf_counter()
+                    first_delta_emitted = False
                     for item in resp:
                         if getattr(self.coordinator, "closing", False):
                             return
@@ -130,6 +182,18 @@ class AskRunnable(QRunnable):
                                         self.signals.result.emit({"delta": delta, "final": False})
                                 except RuntimeError:
                                     pass
+                                if not first_delta_emitted:
+                                    first_delta_emitted = True
+                                    trace.add_span("stream_first_delta", t_stream)
+                                continue
+
+                            # Подсветка, посчитанная параллельно с генерацией, — раньше ответа
+                            if item.get("highlights") and not item.get("final"):
+                                try:
+                                    if not getattr(self.coordinator, "closing", False):
+                                        self.signals.result.emit({"highlights": item["highlights"], "final": False})
+                                except RuntimeError:
+                                    pass
                                 continue
 
                             # If it's a partial cumulative (legacy), handle gracefully
@@ -145,23 +209,10 @@ class AskRunnable(QRunnable):
 
                             # If item indicates final result
                             if item.get("final") or item.get("done") or item.get("is_final"):
-                                final_text = item.get("result") or item.get("partial") or item.get("content") or ""
-                                sources = item.get("sources") if isinstance(item.get("sources"), (str, list, set)) else ""
-                                highlight_chunks = item.get("highlight_chunks", [])
-                                keywords = item.get("keywords", [])
-                                formatted_context = item.get("formatted_context", "")
-                                if isinstance(sources, set):
-                                    sources = ", ".join([s for s in sources if s])
+                                trace.add_span("stream_consume", t_stream)
                                 try:
                                     if not getattr(self.coordinator, "closing", False):
-                                        self.signals.result.emit({
-                                            "result": final_text or cum,
-                                            "sources": sources,
-                                            "highlight_chunks": highlight_chunks,
-                                            "keywords": keywords,
-                                            "formatted_context": formatted_context,
-                                            "final": True,
-                                        })
+                                        self.signals.result.emit(ui_final_payload(item, cum, self._final_trace()))
                                 except RuntimeError:
                                     pass
                                 return
@@ -209,43 +260,21 @@ class AskRunnable(QRunnable):
             elif not sources:
                 sources = "Неизвестно"
 
-            final_text = response.get("result", "") or ""
-            highlight_chunks = response.get("highlight_chunks", [])
-
-            # Разбиваем ответ на предложения для имитации поточной генерации
-            parts = [p.strip() for p in re.split(r'(?<=[\.!\?])\s+', final_text) if p.strip()]
-            if not parts and final_text:
-                parts = [final_text]
-
-            cum = ""
+            # Ответ уже готов целиком — отдаём его сразу, без имитации стриминга
+            final_payload = {
+                "result": response.get("result", "") or "",
+                "sources": sources,
+                "highlight_chunks": response.get("highlight_chunks", []),
+                "keywords": response.get("keywords", []),
+                "formatted_context": response.get("formatted_context", ""),
+                "model_used": response.get("model_used", ""),
+                "llm_provider": response.get("llm_provider", ""),
+                "trace": self._final_trace(),
+                "final": True,
+            }
             try:
-                for i, part in enumerate(parts):
-                    if getattr(self.coordinator, "closing", False):
-                        return
-                    if cum:
-                        cum = f"{cum} {part}"
-                    else:
-                        cum = part
-                    partial_payload = {"partial": cum, "final": False}
-                    try:
-                        self.signals.result.emit(partial_payload)
-                    except RuntimeError:
-                        pass
-                    time.sleep(0.05)
-
-                final_payload = {
-                    "result": final_text,
-                    "sources": sources,
-                    "highlight_chunks": highlight_chunks,
-                    "keywords": response.get("keywords", []),
-                    "formatted_context": response.get("formatted_context", ""),
-                    "final": True,
-                }
-                try:
-                    if not getattr(self.coordinator, "closing", False):
-                        self.signals.result.emit(final_payload)
-                except RuntimeError:
-                    pass
+                if not getattr(self.coordinator, "closing", False):
+                    self.signals.result.emit(final_payload)
             except RuntimeError:
                 pass
 
@@ -257,6 +286,8 @@ class AskRunnable(QRunnable):
                 pass
 
         finally:
+            # Trace пишется в лог в любом случае, даже при ошибке или отмене
+            self.trace.finish()
             if hasattr(self.coordinator, "active_runnables"):
                 self.coordinator.active_runnables = [
                     r for r in self.coordinator.active_runnables if r != self
@@ -269,22 +300,25 @@ class RAGCoordinator(QObject):
     indexing_error = pyqtSignal(str)
     indexing_progress = pyqtSignal(int, int, int)
 
-    _instance = None
-
     @staticmethod
     def instance(folder_path=None):
-        if not RAGCoordinator._instance:
-            if folder_path is None:
+        """Координатор папки из общего пула (без папки — активный)."""
+        pool = get_coordinator_pool()
+        if folder_path is None:
+            coordinator = pool.active()
+            if coordinator is None:
                 raise ValueError("folder_path required")
-            RAGCoordinator._instance = RAGCoordinator(folder_path)
-        return RAGCoordinator._instance
+            return coordinator
+        return pool.open(folder_path)
 
-    def __init__(self, folder_path: str):
+    def __init__(self, folder_path: str, scope_file: Optional[str] = None):
         super().__init__()
         if hasattr(self, "initialized"):
             return
 
         self.folder_path = folder_path
+        # Запуск по одному файлу (--tell/--ask): индекс папки, вопросы — с фильтром по этому файлу
+        self.scope_file = os.path.abspath(scope_file) if scope_file else None
         self.vectorstore = None
         self.qa_chain = None
         self.is_indexing = False
@@ -292,7 +326,13 @@ class RAGCoordinator(QObject):
         self.use_gpu = self._detect_gpu()
         self.threadpool = QThreadPool.globalInstance()
         self.active_runnables = []
+        # Сигналы вопросов, идущих через async_engine (держим ссылки до завершения)
+        self._engine_signals = set()
+        self.indexing_metrics: Optional[IndexingMetrics] = None
+        self.scheduler = get_scheduler()
 
+        # Состояние Ollama проверяется в фоне, пока идёт индексация
+        refresh_ollama_health()
         self.start_indexing()
         self.initialized = True
 
@@ -303,24 +343,59 @@ class RAGCoordinator(QObject):
         except Exception:
             return True
 
-    def _rebuild_qa_chain(self):
-        """Пересоздаёт qa_chain с актуальными настройками LLM из config."""
-        if not self.vectorstore:
-            return
+    def build_chain(self, vectorstore, folder_path: Optional[str]):
+        """Цепочка над vectorstore с актуальными настройками LLM из config."""
         s = get_llm_settings()
-        self.qa_chain = get_rag_chain(
-            self.vectorstore,
+        return get_rag_chain(
+            vectorstore,
             model_name=s["ollama_model"],
             use_gpu=self.use_gpu,
-            folder_path=self.folder_path,
+            folder_path=folder_path,
             llm_provider=s["provider"],
             openrouter_api_key=s["openrouter_key"],
             openrouter_model=s["openrouter_model"],
+            openrouter_fallback=s["openrouter_fallback"],
+            openrouter_hedge_ms=s["openrouter_hedge_ms"],
+            context_tokens=s["context_tokens"],
         )
 
+    def _rebuild_qa_chain(self):
+        """Пересоздаёт qa_chain с актуальными настройками LLM из config."""
+        if not self.vectorstore:
+            return
+        self.qa_chain = self.build_chain(self.vectorstore, self.folder_path)
+
     def apply_llm_settings(self):
         """Вызывается из UI после сохранения настроек — перезапускает LLM без переиндексации."""
         self._rebuild_qa_chain()
+        if self.vectorstore:
+            self.warm_up_llm()
+            # Бэкенд reranker мог смениться — новая модель грузится в фоне, не на первом ответе
+            warm_up_reranker()
+
+    def warm_up_llm(self):
+        """Фоновая загрузка локальной модели (keep_alive), чтобы первый вопрос не ждал загрузки."""
+        s = get_llm_settings()
+        if s["provider"] == "openrouter" and s["openrouter_key"]:
+            return
+        warm_up_ollama(s["ollama_model"], self.use_gpu)
+
+    def metrics_snapshot(self) -> Optional[Dict[str, Any]]:
+        """
+        Метрики текущей (или последней) индексации; без прогона или при загрузке
+        индекса из кеша (там ничего не мерилось) — из indexing_metrics.json.
+        """
+        metrics = self.indexing_metrics
+        if metrics is not None and metrics.status != "cached":
+            return metrics.snapshot()
+        saved = load_metrics(self.folder_path)
+        if saved is None and metrics is not None:
+            return metrics.snapshot()
+        return saved
+
+    def scheduler_snapshot(self) -> Dict[str, Any]:
+        """Занятость слотов и очереди планировщика (для диагностики)."""
+        return self.scheduler.snapshot()
 
     def start_indexing(self):
         if self.is_indexing:
@@ -334,13 +409,23 @@ class RAGCoordinator(QObject):
         self.active_runnables.append(runnable)
         self.threadpool.start(runnable)
 
+    @property
+    def busy(self) -> bool:
+        """Идёт индексация или есть вопросы в работе — такой индекс пул не вытесняет."""
+        return self.is_indexing or bool(self.active_runnables) or bool(self._engine_signals)
+
+    def unload(self):
+        """Отпускает индекс папки, не трогая общий пул потоков (вытеснение из CoordinatorPool)."""
+        self.closing = True
+        self.is_indexing = False
+        self.active_runnables = []
+        self._engine_signals.clear()
+        self.qa_chain = None
+        self.vectorstore = None
+
     def close(self):
         try:
-            self.closing = True
-            self.is_indexing = False
-            self.active_runnables = []
-            self.qa_chain = None
-            self.vectorstore = None
+            self.unload()
             try:
                 self.threadpool.clear()
             except Exception:
@@ -360,15 +445,196 @@ class RAGCoordinator(QObject):
         self.is_indexing = False
         self.indexing_error.emit(msg)
 
-    def ask_async(self, query: str, file_filter: Optional[str], callback: Callable[[Dict], None]):
+    def ask_async(self, query: str, file_filter: Optional[str], callback: Callable[[Dict], None],
+                  conversation: Optional[Conversation] = None, chain=None):
+        """
+        conversation — состояние чата (conversation.py) для уточняющих вопросов; None — вопрос без истории.
+        chain — другая цепочка (вопрос по нескольким папкам, см. CoordinatorPool.ask_async).
+        """
         if self.is_indexing:
             callback({"result": "Индексация в процессе...", "sources": ""})
             return
-        if not self.qa_chain:
+        if not (chain or self.qa_chain):
             callback({"result": "Модель не загружена.", "sources": ""})
             return
+        if file_filter is None and chain is None:
+            file_filter = self.scope_file
 
-        runnable = AskRunnable(self, query, file_filter)
+        engine = get_async_engine() if get_llm_settings()["async_engine"] else None
+        if engine is not None:
+            self._ask_via_engine(engine, query, file_filter, callback, conversation, chain)
+            return
+
+        runnable = AskRunnable(self, query, file_filter, conversation, chain)
         runnable.signals.result.connect(callback)
         self.active_runnables.append(runnable)
         self.threadpool.start(runnable)
+
+    def _ask_via_engine(self, engine, query, file_filter, callback, conversation, chain=None):
+        """Вопрос через asyncio-движок: поток пула не занимается, результат приходит Qt-сигналом."""
+        signals = AskSignals()
+        signals.result.connect(callback)
+        # Отпускаем сигналы в GUI-потоке, когда пришёл последний payload (финальный
+        # ответ или ошибка с "result"): иначе QObject мог бы удалиться раньше, чем
+        # доставлен ответ из очереди. Ранняя подсветка и delta — не последние
+        signals.result.connect(lambda payload, s=signals: self._engine_signals.discard(s)
+                               if payload.get("final") or "result" in payload else None)
+        self._engine_signals.add(signals)
+
+        def emit(payload: dict):
+            if self.closing:
+                return
+            try:
+                signals.result.emit(payload)
+            except RuntimeError:
+                pass
+
+        engine.submit(self, query, file_filter, emit, conversation, chain)
+
+
+class CoordinatorPool:
+    """
+    Загруженные индексы нескольких папок: координатор на папку в LRU с
+    бюджетом памяти. Возврат к уже открытой папке не перечитывает индекс;
+    вопрос можно задать одной папке или сразу нескольким (FanOutVectorStore).
+    """
+
+    def __init__(self, budget_mb: int = INDEX_MEMORY_BUDGET_MB):
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self._coordinators: "OrderedDict[str, RAGCoordinator]" = OrderedDict()
+        self._active: Optional[str] = None
+        self._sizes: Dict[str, tuple] = {}      # папка -> (id(vectorstore), оценка памяти)
+        self._fan_out_chains: Dict[tuple, Any] = {}
+
+    def active(self) -> Optional[RAGCoordinator]:
+        return self._coordinators.get(self._active) if self._active else None
+
+    def get(self, folder_path: str) -> Optional[RAGCoordinator]:
+        coordinator = self._coordinators.get(os.path.abspath(folder_path))
+        return None if coordinator is None or coordinator.closing else coordinator
+
+    def open(self, folder_path: str, scope_file: Optional[str] = None) -> RAGCoordinator:
+        """
+        Координатор папки: уже загруженный (LRU обновляется) или новый с индексацией.
+        scope_file — вопросы только по этому файлу папки (индекс папки переиспользуется).
+        """
+        folder = os.path.abspath(folder_path)
+        coordinator = self.get(folder)
+        if coordinator is not None:
+            self._coordinators.move_to_end(folder)
+            logging.info(f"[POOL] Индекс папки уже загружен: {folder}")
+            if coordinator.scope_file and not scope_file:
+                # Папку открыли целиком: снимаем фильтр и проверяем остальные файлы
+                coordinator.scope_file = None
+                coordinator.start_indexing()
+        else:
+            coordinator = RAGCoordinator(folder, scope_file)
+            coordinator.indexing_finished.connect(self.enforce_budget)
+            self._coordinators[folder] = coordinator
+        self._active = folder
+        self.enforce_budget()
+        return coordinator
+
+    def loaded_folders(self) -> list:
+        """Папки с готовым индексом, от недавно использованных к давним."""
+        return [f for f, c in reversed(self._coordinators.items()) if c.vectorstore is not None and not c.closing]
+
+    def _index_bytes(self, coordinator: RAGCoordinator) -> int:
+        vs = coordinator.vectorstore
+        if vs is None:
+            return 0
+        cached = self._sizes.get(coordinator.folder_path)
+        if cached is None or cached[0] != id(vs):
+            # Оценка пересчитывается только после переиндексации (новый vectorstore)
+            cached = (id(vs), estimate_index_bytes(vs))
+            self._sizes[coordinator.folder_path] = cached
+        return cached[1]
+
+    def memory_bytes(self) -> int:
+        return sum(self._index_bytes(c) for c in self._coordinators.values())
+
+    def enforce_budget(self):
+        """Выгружает давно не использованные индексы, пока сумма не уложится в бюджет."""
+        total = self.memory_bytes()
+        for folder in list(self._coordinators):
+            if total <= self.budget_bytes:
+                break
+            coordinator = self._coordinators[folder]
+            if folder == self._active or coordinator.busy:
+                continue
+            size = self._index_bytes(coordinator)
+            self._drop(folder)
+            total -= size
+            logging.info(f"[POOL] Выгружен индекс {folder} ({size / 1024 / 1024:.0f} МБ): "
+                         f"бюджет {self.budget_bytes / 1024 / 1024:.0f} МБ")
+
+    def _drop(self, folder: str):
+        coordinator = self._coordinators.pop(folder)
+        self._sizes.pop(folder, None)
+        self._fan_out_chains = {k: v for k, v in self._fan_out_chains.items() if folder not in k[0]}
+        coordinator.unload()
+
+    def _fan_out_chain(self, folders: list):
+        stores = []
+        for folder in folders:
+            coordinator = self.get(folder)
+            if coordinator is not None and coordinator.vectorstore is not None:
+                stores.append((coordinator.folder_path, coordinator.vectorstore))
+        if len(stores) < 2:
+            return None
+        # Цепочка пересобирается, если сменился индекс какой-то папки или настройки LLM
+        key = (tuple(f for f, _vs in stores), tuple(id(vs) for _f, vs in stores),
+               tuple(sorted(get_llm_settings().items())))
+        chain = self._fan_out_chains.get(key)
+        if chain is None:
+            self._fan_out_chains = {k: v for k, v in self._fan_out_chains.items() if k[0] != key[0]}
+            chain = self.active().build_chain(FanOutVectorStore(stores), folder_path=None)
+            self._fan_out_chains[key] = chain
+        return chain
+
+    def ask_async(self, query: str, folders: Optional[list], callback: Callable[[Dict], None],
+                  file_filter: Optional[str] = None, conversation: Optional[Conversation] = None):
+        """
+        Вопрос к одной папке (folders=None — активная) или к нескольким: кандидаты
+        ищутся в каждом индексе и сливаются по расстоянию. Выполняет активный координатор.
+        """
+        coordinator = self.active()
+        if coordinator is None:
+            callback({"result": "Папка не выбрана.", "sources": ""})
+            return
+        chain = self._fan_out_chain(folders) if folders and len(folders) > 1 else None
+        if chain is not None:
+            logging.info(f"[POOL] Вопрос по {len(folders)} папкам")
+        coordinator.ask_async(query, file_filter, callback, conversation=conversation, chain=chain)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "active": self._active,
+            "budget_mb": round(self.budget_bytes / 1024 / 1024),
+            "folders": {
+                f: {"memory_mb": round(self._index_bytes(c) / 1024 / 1024, 1), "indexing": c.is_indexing}
+                for f, c in self._coordinators.items()
+            },
+        }
+
+    def close_all(self):
+        for folder in list(self._coordinators):
+            self._drop(folder)
+        self._active = None
+        try:
+            threadpool = QThreadPool.globalInstance()
+            threadpool.clear()
+            threadpool.waitForDone(1000)
+        except Exception:
+            pass
+
+
+_pool: Optional[CoordinatorPool] = None
+
+
+def get_coordinator_pool() -> CoordinatorPool:
+    """Пул на процесс; живёт в GUI-потоке, как и сами координаторы."""
+    global _pool
+    if _pool is None:
+        _pool = CoordinatorPool()
+    return _pool
@@ -1,21 +1,30 @@
 # src/indexer.py
 import easyocr
 import os
+import time
 import pickle
-import logging
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_ollama.embeddings import OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
-from config import SUPPORTED_FORMATS, EMBEDDING_MODEL
+from config import SUPPORTED_FORMATS, EMBEDDING_MODEL, OLLAMA_BASE_URL
 from cache import get_folder_cache_dir
-import PyPDF2
-from docx import Document as DocxDocument
-import bs4
+from metrics import IndexingMetrics, METRICS_FILE_NAME
+from scheduler import get_scheduler
+from reranker import compute_spans
+import text_store
 
 
 # Глобальный OCR reader
 ocr_reader = None
 
+# Размер пачки текстов на один запрос эмбеддингов (метрики считаются по пачкам)
+EMBED_BATCH_SIZE = 64
+
+# Версия метаданных чанков: при несовпадении индекс папки перестраивается, даже
+# если файлы не менялись. 2 — смещения по тексту text_store.extract_document
+# (страницы PDF через "\n") и номер страницы "page"
+INDEX_VERSION = 2
+
 
 def get_ocr_reader():
     global ocr_reader
@@ -25,68 +34,147 @@ def get_ocr_reader():
     return ocr_reader
 
 
-def extract_text(file_path):
+def _ocr_image(file_path):
+    reader = get_ocr_reader()
+    with get_scheduler().slot("ocr"):
+        result = reader.readtext(file_path, detail=0, paragraph=True)
+    return "\n".join(result) if result else "Текст не распознан"
+
+
+def extract_document(file_path):
+    """(текст, TextLayout) файла; см. text_store.extract_document."""
     ext = os.path.splitext(file_path)[1].lower().lstrip(".")
     print(f"  → extract_text: {os.path.basename(file_path)} [{ext}]")
     if ext not in SUPPORTED_FORMATS:
-        return ""
+        return "", text_store.TextLayout.build("")
+    # Разбор форматов — общий с превью и подсветкой (text_store.py); OCR — только здесь
+    return text_store.extract_document(file_path, ocr=_ocr_image)
+
+
+def extract_text(file_path):
+    return extract_document(file_path)[0]
 
+
+def _index_paths(folder_path, create=True):
+    cache_dir = get_folder_cache_dir(folder_path, create=create)
+    return os.path.join(cache_dir, "faiss_index"), os.path.join(cache_dir, "file_timestamps.pkl")
+
+
+def _version_path(index_path):
+    return os.path.join(os.path.dirname(index_path), "index_version")
+
+
+def _index_version_ok(index_path):
     try:
-        # === OCR для изображений ===
-        if ext in ["png", "jpg", "jpeg"]:
-            reader = get_ocr_reader()
-            result = reader.readtext(file_path, detail=0, paragraph=True)
-            text = "\n".join(result) if result else "Текст не распознан"
-            return text
-
-        # === PDF ===
-        elif ext == "pdf":
-            with open(file_path, "rb") as f:
-                reader = PyPDF2.PdfReader(f)
-                return "".join(page.extract_text() or "" for page in reader.pages)
-
-        # === TXT / MD ===
-        elif ext in ["txt", "md"]:
-            with open(file_path, "r", encoding="utf-8") as f:
-                return f.read()
-
-        # === DOCX ===
-        elif ext == "docx":
-            doc = DocxDocument(file_path)
-            return "\n".join(para.text for para in doc.paragraphs)
-
-        # === HTML ===
-        elif ext == "html":
-            with open(file_path, "r", encoding="utf-8") as f:
-                soup = bs4.BeautifulSoup(f.read(), "html.parser")
-                return soup.get_text()
-
-    except Exception as e:
-        logging.error(f"Ошибка извлечения текста из {file_path}: {e}")
-        return ""
-
-    return ""
-
-
-def build_index(folder_path, embedding_model, progress_callback=None):
+        with open(_version_path(index_path), "r", encoding="utf-8") as f:
+            return f.read().strip() == str(INDEX_VERSION)
+    except (OSError, ValueError):
+        return False
+
+
+def find_covering_index(file_path):
+    """
+    Ближайшая папка-предок файла, чей индекс в кеше уже содержит этот файл
+    в текущей версии (mtime совпадает). None — такого индекса нет.
+    """
+    file_path = os.path.abspath(file_path)
+    try:
+        mtime = os.stat(file_path).st_mtime
+    except OSError:
+        return None
+    folder = os.path.dirname(file_path)
+    while True:
+        index_path, timestamp_path = _index_paths(folder, create=False)
+        if os.path.exists(index_path) and _index_version_ok(index_path):
+            try:
+                with open(timestamp_path, "rb") as f:
+                    timestamps = pickle.load(f)
+                if timestamps.get(file_path) == mtime:
+                    return folder
+            except Exception:
+                pass
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+
+def load_index_for_file(folder_path, file_path, embedding_model, progress_callback=None, metrics=None):
+    """
+    Индекс папки из кеша без пересканирования остальных файлов — для вопросов
+    по одному её файлу (поиск ограничивается фильтром source). None, если
+    кеш не покрывает файл: тогда нужен обычный build_index.
+    """
+    if find_covering_index(file_path) != os.path.abspath(folder_path):
+        return None
+    index_path, _ = _index_paths(folder_path)
+    print(f"[INDEXER] Файл уже в индексе папки {folder_path}, загрузка кэша без сканирования...")
+    embeddings = OllamaEmbeddings(model=embedding_model, base_url=OLLAMA_BASE_URL)
+    vectorstore = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+    if metrics is not None:
+        metrics.info["scope_file"] = os.path.abspath(file_path)
+        metrics.finish("cached")
+    if progress_callback:
+        progress_callback(1, 1)
+    return vectorstore
+
+
+def build_index(folder_path, embedding_model, progress_callback=None, metrics=None):
+    """
+    metrics — IndexingMetrics, в который пишутся счётчики по этапам; если не
+    передан, создаётся свой. Снимок сохраняется в <кеш папки>/indexing_metrics.json.
+    """
     cache_dir = get_folder_cache_dir(folder_path)
-    index_path = os.path.join(cache_dir, "faiss_index")
-    timestamp_path = os.path.join(cache_dir, "file_timestamps.pkl")
+    index_path, timestamp_path = _index_paths(folder_path)
+    metrics_path = os.path.join(cache_dir, METRICS_FILE_NAME)
+    if metrics is None:
+        metrics = IndexingMetrics(folder_path)
 
+    try:
+        vectorstore = _build_index(
+            folder_path, embedding_model, index_path, timestamp_path, progress_callback, metrics
+        )
+    except Exception:
+        metrics.finish("error")
+        metrics.dump(metrics_path)
+        raise
+    if metrics.status == "cached":
+        # Загрузка из кеша ничего не мерила — снимок последней настоящей индексации не затираем
+        return vectorstore
+    if metrics.status == "running":
+        metrics.finish("done" if vectorstore is not None else "empty")
+    metrics.dump(metrics_path)
+    snap = metrics.snapshot()
+    print(
+        f"[INDEXER] Метрики: {snap['wall_seconds']} с, {snap['files_per_s']} файлов/с, "
+        f"{snap['chunks_per_s']} чанков/с ({metrics_path})"
+    )
+    return vectorstore
+
+
+def _build_index(folder_path, embedding_model, index_path, timestamp_path, progress_callback, metrics):
     # === 1. Сбор файлов ===
     print(f"[INDEXER] Сканирование папки: {folder_path}")
     current_timestamps = {}
     supported_files = []
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            path = os.path.join(root, file)
-            ext = os.path.splitext(path)[1].lower().lstrip(".")
-            if ext in SUPPORTED_FORMATS:
-                current_timestamps[path] = os.path.getmtime(path)
-                supported_files.append(path)
+    file_sizes = {}
+    with metrics.measure("scan", items=0) as m:
+        for root, _, files in os.walk(folder_path):
+            for file in files:
+                path = os.path.join(root, file)
+                m["items"] += 1
+                ext = os.path.splitext(path)[1].lower().lstrip(".")
+                if ext in SUPPORTED_FORMATS:
+                    st = os.stat(path)
+                    current_timestamps[path] = st.st_mtime
+                    file_sizes[path] = st.st_size
+                    supported_files.append(path)
+        m["bytes"] = sum(file_sizes.values())
 
     print(f"[INDEXER] Найдено файлов: {len(supported_files)}")
     total_files = len(supported_files)
+    metrics.info["supported_files"] = total_files
+    metrics.info["supported_bytes"] = sum(file_sizes.values())
 
     # === 2. Проверка кэша ===
     try:
@@ -95,7 +183,7 @@ def build_index(folder_path, embedding_model, progress_callback=None):
     except FileNotFoundError:
         previous_timestamps = {}
 
-    needs_reindex = len(current_timestamps) != len(previous_timestamps)
+    needs_reindex = len(current_timestamps) != len(previous_timestamps) or not _index_version_ok(index_path)
     if not needs_reindex:
         for path, mtime in current_timestamps.items():
             if path not in previous_timestamps or previous_timestamps[path] != mtime:
@@ -104,9 +192,10 @@ def build_index(folder_path, embedding_model, progress_callback=None):
 
     if os.path.exists(index_path) and not needs_reindex:
         print("[INDEXER] Загрузка кэша...")
-        embeddings = OllamaEmbeddings(model=embedding_model)
+        embeddings = OllamaEmbeddings(model=embedding_model, base_url=OLLAMA_BASE_URL)
         vectorstore = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
         print("[INDEXER] Кэш загружен!")
+        metrics.finish("cached")
         if progress_callback:
             progress_callback(total_files, total_files)
         return vectorstore
@@ -114,13 +203,30 @@ def build_index(folder_path, embedding_model, progress_callback=None):
     print("[INDEXER] Построение нового индекса...")
 
     # === 3. Извлечение текста ===
+    # Текст неизменившихся файлов берётся из хранилища — повторно не разбираем и не распознаём
+    store = text_store.get_text_store(folder_path)
+    reused_texts = 0
     texts = []
+    layouts = []
     metadatas = []
     for i, path in enumerate(supported_files):
         print(f"[INDEXER] [{i+1}/{len(supported_files)}] Обработка: {os.path.basename(path)}")
-        text = extract_text(path)
+        metrics.set_queue_depth("extract_pending", total_files - i)
+        t_file = time.perf_counter()
+        text = store.get(path)
+        # Без сохранённого layout у PDF/DOCX нет страниц и абзацев — такой файл извлекаем заново
+        layout = store.get_layout(path, text) if text is not None else None
+        if layout is not None:
+            reused_texts += 1
+        else:
+            text, layout = extract_document(path)
+            if text:
+                store.put(path, text, layout)
+        metrics.observe_file(path, time.perf_counter() - t_file, file_sizes.get(path, 0), len(text),
+                             error=not text)
         text.strip()
         texts.append(text)
+        layouts.append(layout)
         metadatas.append(
             {
                 "source": path,
@@ -133,6 +239,9 @@ def build_index(folder_path, embedding_model, progress_callback=None):
             progress_callback(i + 1, total_files)
     else:
         print("  → Текст пустой")
+    metrics.set_queue_depth("extract_pending", 0)
+    metrics.info["texts_reused"] = reused_texts
+    store.retain(supported_files)
 
     if not texts:
         print("[INDEXER] Нет текста для индексации")
@@ -146,7 +255,8 @@ def build_index(folder_path, embedding_model, progress_callback=None):
     split_texts = []
     split_metadatas = []
     total_chunks = 0
-    for i, (text, meta) in enumerate(zip(texts, metadatas)):
+    for i, (text, layout, meta) in enumerate(zip(texts, layouts, metadatas)):
+        t_chunk = time.perf_counter()
         chunks = text_splitter.split_text(text)
         total_chunks += len(chunks)
         split_texts.extend(chunks)
@@ -161,26 +271,59 @@ def build_index(folder_path, embedding_model, progress_callback=None):
             chunk_meta["chunk_index"] = chunk_idx
             chunk_meta["start_char"] = pos
             chunk_meta["end_char"] = pos + len(chunk)
-            chunk_meta["start_line"] = text[:pos].count("\n")
+            # Номер строки — бинпоиском по таблице начал строк (раньше — подсчёт с начала текста на каждый чанк)
+            chunk_meta["start_line"] = layout.line_of(pos)
+            # Страница — по границам страниц из модели документа (только у PDF)
+            page = layout.page_of(pos)
+            if page is not None:
+                chunk_meta["page"] = page + 1
+            # Границы spans для reranker — считаются один раз здесь, а не на каждый вопрос
+            chunk_meta["spans"] = compute_spans(chunk)
             split_metadatas.append(chunk_meta)
             if pos != -1:
                 search_start = pos + max(1, len(chunk) - 80)
 
+        metrics.observe("chunk", time.perf_counter() - t_chunk, 1, len(text.encode("utf-8")), len(chunks))
         print(f"  → Док {i+1}: {len(chunks)} чанков")
 
     print(f"[INDEXER] Всего чанков: {total_chunks}")
 
     # === 5. Эмбеддинги ===
     print("[INDEXER] Загрузка модели эмбеддингов...")
-    embeddings = OllamaEmbeddings(model=embedding_model)
+    embeddings = OllamaEmbeddings(model=embedding_model, base_url=OLLAMA_BASE_URL)
+    # Эмбеддинги считаем пачками отдельно от вставки в FAISS — так у каждого
+    # этапа своя пропускная способность в метриках
+    # Между пачками индексация уступает вопросам пользователя (scheduler.checkpoint);
+    # ожидание слота не входит в метрику embed
+    scheduler = get_scheduler()
+    vectors = []
+    for start in range(0, len(split_texts), EMBED_BATCH_SIZE):
+        batch = split_texts[start:start + EMBED_BATCH_SIZE]
+        metrics.set_queue_depth("embed_pending_chunks", len(split_texts) - start)
+        scheduler.checkpoint()
+        with scheduler.slot("embedder"):
+            with metrics.measure("embed", items=len(batch), n_bytes=sum(len(t.encode("utf-8")) for t in batch),
+                                 chunks=len(batch)):
+                vectors.extend(embeddings.embed_documents(batch))
+    metrics.set_queue_depth("embed_pending_chunks", 0)
+
     print("[INDEXER] Создание FAISS...")
-    vectorstore = FAISS.from_texts(texts=split_texts, embedding=embeddings, metadatas=split_metadatas)
+    with metrics.measure("faiss_insert", items=len(vectors), chunks=len(vectors)):
+        vectorstore = FAISS.from_embeddings(
+            text_embeddings=list(zip(split_texts, vectors)),
+            embedding=embeddings,
+            metadatas=split_metadatas,
+        )
 
     # === 6. Сохранение ===
     print("[INDEXER] Сохранение индекса в:", index_path)
-    vectorstore.save_local(index_path)
-    with open(timestamp_path, "wb") as f:
-        pickle.dump(current_timestamps, f)
+    with metrics.measure("save"):
+        vectorstore.save_local(index_path)
+        with open(timestamp_path, "wb") as f:
+            pickle.dump(current_timestamps, f)
+        with open(_version_path(index_path), "w", encoding="utf-8") as f:
+            f.write(str(INDEX_VERSION))
+    metrics.info["total_chunks"] = total_chunks
 
     print("[INDEXER] Индексация завершена!")
     return vectorstore
\ No newline at end of file
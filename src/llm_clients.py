@@ -0,0 +1,241 @@
+"""
+llm_clients.py — общий на процесс реестр LLM-клиентов.
+
+Раньше get_rag_chain, summarize_all_in_one и generate_suggested_questions
+каждый раз создавали новый ChatOllama и перед этим блокирующе опрашивали
+/api/tags. Теперь:
+
+  * клиенты живут в реестре по ключу (провайдер, модель, режим GPU,
+    температура) — повторные вызовы и пересборка цепочки берут готовый
+    клиент с уже открытыми соединениями;
+  * HTTP-запросы самого приложения (health, warm-up, OpenRouter) идут через
+    один requests.Session с пулом соединений;
+  * доступность Ollama кешируется и обновляется в фоне, вопрос не ждёт
+    health-check;
+  * warm_up_ollama() загружает модель в память заранее (keep_alive),
+    когда индекс готов;
+  * для ответов на вопросы get_generate_llm() отдаёт клиент /api/generate,
+    который переиспользует префикс промпта по областям (ollama_generate.py).
+"""
+
+from __future__ import annotations
+
+import time
+import hashlib
+import logging
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from langchain_ollama import ChatOllama
+
+from config import OLLAMA_BASE_URL
+from openrouter import OpenRouterLLM
+from ollama_generate import OllamaGenerateLLM
+
+# Сколько модель остаётся в памяти Ollama после последнего запроса
+OLLAMA_KEEP_ALIVE = "5m"
+
+_HEALTH_TTL_S = 15.0
+_HEALTH_TIMEOUT_S = 2.0
+_WARMUP_TIMEOUT_S = 120.0
+_WARMUP_DEDUP_S = 60.0
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+_registry: dict = {}
+_registry_lock = threading.Lock()
+
+_warmups: dict = {}  # (model, gpu) -> time.monotonic() последнего прогрева
+_warmups_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Общий Session с пулом keep-alive соединений (Ollama и OpenRouter)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+    return _session
+
+
+# ── Health Ollama ────────────────────────────────────────────────────────
+
+class _OllamaHealth:
+    """Кешированное состояние Ollama: первый опрос синхронный, дальше — в фоне по TTL."""
+
+    def __init__(self):
+        self.available: Optional[bool] = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def check(self) -> bool:
+        try:
+            resp = get_http_session().get(f"{OLLAMA_BASE_URL}/api/tags", timeout=_HEALTH_TIMEOUT_S)
+            ok = resp.status_code == 200
+        except Exception:
+            ok = False
+        with self._lock:
+            if self.available is not None and ok != self.available:
+                logging.info(f"[LLM] Ollama {'доступен' if ok else 'недоступен'} ({OLLAMA_BASE_URL})")
+            self.available = ok
+            self.checked_at = time.monotonic()
+            self._refreshing = False
+        return ok
+
+    def refresh_async(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.check, name="ollama-health", daemon=True).start()
+
+    def get(self) -> bool:
+        if self.available is None:
+            return self.check()
+        if time.monotonic() - self.checked_at > _HEALTH_TTL_S:
+            self.refresh_async()
+        return self.available
+
+
+_ollama_health = _OllamaHealth()
+
+
+def ollama_available() -> bool:
+    """Доступен ли Ollama. Не блокирует, кроме самого первого вызова в процессе."""
+    return _ollama_health.get()
+
+
+def refresh_ollama_health() -> None:
+    """Запустить фоновую проверку Ollama (например, при старте приложения)."""
+    _ollama_health.refresh_async()
+
+
+# ── Реестр клиентов ──────────────────────────────────────────────────────
+
+def _make_chat_ollama(model_name: str, use_gpu: bool, temperature: float):
+    try:
+        return ChatOllama(model=model_name,
+                          num_gpu=-1 if use_gpu else 0,
+                          temperature=temperature,
+                          base_url=OLLAMA_BASE_URL,
+                          keep_alive=OLLAMA_KEEP_ALIVE,
+                          timeout=60)
+    except TypeError:
+        return ChatOllama(model=model_name,
+                          num_gpu=-1 if use_gpu else 0,
+                          temperature=temperature,
+                          base_url=OLLAMA_BASE_URL)
+
+
+def get_chat_llm(provider: str, model_name: str, use_gpu: bool = True, temperature: float = 0.1,
+                 api_key: str = "", fallback: bool = True, hedge_after_s: Optional[float] = None):
+    """
+    Клиент из реестра (создаётся при первом обращении).
+    Возвращает None, если Ollama недоступен или для OpenRouter не задан ключ.
+    fallback / hedge_after_s — политика OpenRouter (см. openrouter.py).
+    """
+    if provider == "openrouter":
+        if not api_key:
+            return None
+        model = model_name or "openrouter/elephant-alpha"
+        key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+        key = ("openrouter", model, None, temperature, key_hash, bool(fallback), hedge_after_s)
+
+        def factory():
+            return OpenRouterLLM(api_key=api_key, model=model, temperature=temperature,
+                                 fallback=fallback, hedge_after_s=hedge_after_s)
+    else:
+        if not ollama_available():
+            return None
+        key = ("ollama", model_name, bool(use_gpu), temperature)
+
+        def factory():
+            return _make_chat_ollama(model_name, use_gpu, temperature)
+
+    client = _registry.get(key)
+    if client is not None:
+        return client
+    with _registry_lock:
+        client = _registry.get(key)
+        if client is None:
+            try:
+                client = factory()
+            except Exception as e:
+                logging.error(f"[LLM] Ошибка инициализации {provider}/{model_name}: {e}")
+                return None
+            _registry[key] = client
+            logging.info(f"[LLM] Новый клиент: {provider}/{model_name} (gpu={use_gpu}, t={temperature})")
+    return client
+
+
+def get_generate_llm(model_name: str, use_gpu: bool = True, temperature: float = 0.1,
+                     prefix_reuse: bool = True) -> Optional[OllamaGenerateLLM]:
+    """
+    Клиент Ollama /api/generate для ответов на вопросы (из того же реестра).
+    Опции совпадают с ChatOllama, поэтому вопросы и саммари не перезагружают модель.
+    """
+    if not ollama_available():
+        return None
+    key = ("ollama-generate", model_name, bool(use_gpu), temperature, bool(prefix_reuse))
+    client = _registry.get(key)
+    if client is not None:
+        return client
+    with _registry_lock:
+        client = _registry.get(key)
+        if client is None:
+            client = OllamaGenerateLLM(model_name, use_gpu=use_gpu, temperature=temperature,
+                                       keep_alive=OLLAMA_KEEP_ALIVE, prefix_reuse=prefix_reuse)
+            _registry[key] = client
+            logging.info(f"[LLM] Новый клиент: ollama-generate/{model_name} (gpu={use_gpu}, prefix={prefix_reuse})")
+    return client
+
+
+# ── Прогрев ──────────────────────────────────────────────────────────────
+
+def _warm_up(model_name: str, use_gpu: bool) -> None:
+    t0 = time.perf_counter()
+    try:
+        resp = get_http_session().post(
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json={
+                "model": model_name,
+                "prompt": "",
+                "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                # Те же опции, что у ChatOllama, иначе Ollama перезагрузит модель
+                "options": {"num_gpu": -1 if use_gpu else 0},
+            },
+            timeout=_WARMUP_TIMEOUT_S,
+        )
+        logging.info(
+            f"[LLM] Прогрев {model_name}: HTTP {resp.status_code}, {time.perf_counter() - t0:.1f} с"
+        )
+    except Exception as e:
+        logging.warning(f"[LLM] Прогрев {model_name} не удался: {e}")
+
+
+def warm_up_ollama(model_name: str, use_gpu: bool = True) -> bool:
+    """
+    Загружает модель в память Ollama в фоне (пустой промпт + keep_alive).
+    Повторные вызовы в течение минуты игнорируются. Возвращает True, если прогрев запущен.
+    """
+    if not model_name or not ollama_available():
+        return False
+    key = (model_name, bool(use_gpu))
+    now = time.monotonic()
+    with _warmups_lock:
+        last = _warmups.get(key)
+        if last is not None and now - last < _WARMUP_DEDUP_S:
+            return False
+        _warmups[key] = now
+    threading.Thread(target=_warm_up, args=(model_name, use_gpu), name="ollama-warmup", daemon=True).start()
+    return True
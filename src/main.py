@@ -1,10 +1,19 @@
 import sys
+import math
 import time
+import json
+import argparse
 import psutil
 import os
-from config import MODEL_NAME, EMBEDDING_MODEL
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import MODEL_NAME, EMBEDDING_MODEL, get_debug_settings
 from indexer import build_index
 from rag import get_rag_chain
+from retrieval_trace import get_retrieval_trace_writer
+
+# Размер батча для эмбеддинга вопросов в batch-режиме
+BATCH_EMBED_SIZE = 64
+
 
 def detect_power_source():
     try:
@@ -13,12 +22,175 @@ def detect_power_source():
     except:
         return True
 
+
+def _read_questions(path):
+    """
+    Читает вопросы из JSONL: {"id": ..., "question": "...", "file": "опционально"}.
+    Вместо "question" допускается "query"; строки без вопроса пропускаются.
+    """
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"[BATCH] Строка {line_no} пропущена: {e}")
+                continue
+            if isinstance(item, str):
+                item = {"question": item}
+            question = (item.get("question") or item.get("query") or "").strip()
+            if not question:
+                continue
+            questions.append({
+                "id": item.get("id", line_no),
+                "question": question,
+                "file": item.get("file"),
+            })
+    return questions
+
+
+def _embed_queries(vectorstore, queries):
+    """Эмбеддит все вопросы батчами. Возвращает список векторов (None при ошибке)."""
+    embeddings = getattr(vectorstore, "embeddings", None) or getattr(vectorstore, "embedding_function", None)
+    if embeddings is None or not hasattr(embeddings, "embed_documents"):
+        return [None] * len(queries)
+    vectors = []
+    for i in range(0, len(queries), BATCH_EMBED_SIZE):
+        batch = queries[i:i + BATCH_EMBED_SIZE]
+        try:
+            vectors.extend(embeddings.embed_documents(batch))
+        except Exception as e:
+            print(f"[BATCH] Ошибка батч-эмбеддинга, вопросы будут эмбеддиться по одному: {e}")
+            vectors.extend([None] * len(batch))
+    return vectors
+
+
+def _collect_response(resp):
+    """Дочитывает streaming-ответ цепочки до финального dict."""
+    if isinstance(resp, dict):
+        return resp
+    cum = ""
+    for item in resp:
+        if isinstance(item, dict):
+            if item.get("final"):
+                final = dict(item)
+                final["result"] = final.get("result") or cum
+                return final
+            cum += item.get("delta") or ""
+        elif isinstance(item, str):
+            cum += item
+    return {"result": cum}
+
+
+def _percentile(values, pct):
+    """Процентиль по методу ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def _answer_one(qa_chain, folder_path, item, vector, embed_ms):
+    file_filter = None
+    if item.get("file"):
+        path = item["file"]
+        if not os.path.isabs(path):
+            path = os.path.join(folder_path, path)
+        if os.path.exists(path):
+            file_filter = os.path.abspath(path)
+
+    start = time.perf_counter()
+    record = {"id": item["id"], "question": item["question"]}
+    try:
+        response = _collect_response(qa_chain(item["question"], file_filter=file_filter, query_embedding=vector))
+        record["answer"] = response.get("result", "")
+        record["sources"] = response.get("sources", "")
+        record["source_documents"] = [
+            {
+                "source": doc.metadata.get("source"),
+                "chunk_index": doc.metadata.get("chunk_index"),
+            }
+            for doc in response.get("source_documents", [])
+        ]
+        timings = dict(response.get("timings") or {})
+    except Exception as e:
+        record["error"] = str(e)
+        timings = {}
+    timings["embed_ms"] = embed_ms
+    timings["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    record["timings"] = timings
+    return record
+
+
+def run_batch(qa_chain, vectorstore, folder_path, in_path, out_path, concurrency=4):
+    """
+    Batch-режим: все вопросы из JSONL эмбеддятся батчами, LLM-вызовы идут
+    с ограниченной параллельностью, ответы пишутся в JSONL по мере готовности.
+    В конце печатает QPS и p50/p95 латентности.
+    """
+    questions = _read_questions(in_path)
+    if not questions:
+        print(f"[BATCH] Нет вопросов в {in_path}")
+        return
+
+    print(f"[BATCH] Вопросов: {len(questions)}, параллельность: {concurrency}")
+    wall_start = time.perf_counter()
+
+    t0 = time.perf_counter()
+    vectors = _embed_queries(vectorstore, [q["question"] for q in questions])
+    batch_embed_ms = round((time.perf_counter() - t0) * 1000, 1)
+    per_query_embed_ms = round(batch_embed_ms / len(questions), 2)
+    print(f"[BATCH] Эмбеддинг вопросов: {batch_embed_ms} мс")
+
+    latencies = []
+    errors = 0
+    with open(out_path, "w", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [
+            pool.submit(_answer_one, qa_chain, folder_path, item, vector, per_query_embed_ms)
+            for item, vector in zip(questions, vectors)
+        ]
+        for done, fut in enumerate(as_completed(futures), 1):
+            record = fut.result()
+            latencies.append(record["timings"]["total_ms"])
+            if "error" in record:
+                errors += 1
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            if done % 50 == 0 or done == len(futures):
+                print(f"[BATCH] [{done}/{len(futures)}]")
+
+    wall = time.perf_counter() - wall_start
+    qps = len(questions) / wall if wall > 0 else 0.0
+    if get_debug_settings()["retrieval_traces"]:
+        # Фоновый writer — daemon-поток: дописываем очередь до выхода процесса
+        get_retrieval_trace_writer(folder_path).flush(timeout=10)
+    print("-" * 50)
+    print(f"[BATCH] Готово: {len(questions)} вопросов за {wall:.2f} с, ошибок: {errors}")
+    print(f"[BATCH] QPS: {qps:.2f}")
+    print(f"[BATCH] Латентность p50: {_percentile(latencies, 50):.1f} мс, p95: {_percentile(latencies, 95):.1f} мс")
+    print(f"[BATCH] Ответы: {out_path}")
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="RAG по папке: интерактивный или batch-режим")
+    parser.add_argument("folder_path")
+    parser.add_argument("--batch", metavar="QUESTIONS_JSONL", help="файл с вопросами (JSONL)")
+    parser.add_argument("--out", metavar="ANSWERS_JSONL", help="куда писать ответы (по умолчанию <вход>.answers.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=4, help="число одновременных LLM-вызовов")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python main.py <folder_path>")
+        print("Usage: python main.py <folder_path> [--batch questions.jsonl [--out answers.jsonl] [--concurrency N]]")
         sys.exit(1)
 
-    folder_path = sys.argv[1]
+    args = _parse_args(sys.argv[1:])
+    folder_path = args.folder_path
     use_gpu = detect_power_source()
     power_mode = "GPU mode (AC power)" if use_gpu else "CPU mode (Battery)"
 
@@ -31,6 +203,11 @@ if __name__ == "__main__":
 
     qa_chain = get_rag_chain(vectorstore, MODEL_NAME, use_gpu=use_gpu, folder_path=folder_path)
 
+    if args.batch:
+        out_path = args.out or os.path.splitext(args.batch)[0] + ".answers.jsonl"
+        run_batch(qa_chain, vectorstore, folder_path, args.batch, out_path, concurrency=args.concurrency)
+        sys.exit(0)
+
     print(f"Index built/loaded. Ask questions: {power_mode}")
     print("-" * 50)
 
@@ -51,18 +228,18 @@ if __name__ == "__main__":
             else:
                 print(f"Файл не найден: {file_name}")
 
-        response = qa_chain(query, file_filter=file_filter)
+        response = _collect_response(qa_chain(query, file_filter=file_filter))
         answer = response["result"]
-        sources = response["sources"]
+        sources = response.get("sources", "")
 
         print("Retrieved documents:")
-        for doc in response["source_documents"]:
+        for doc in response.get("source_documents", []):
             source_name = os.path.basename(doc.metadata.get('source', 'Неизвестный источник'))
             doc_type = doc.metadata.get('type', 'document')
             print(f" - {source_name} ({doc_type}): {doc.page_content[:100]}...")
 
-        print(f"Context preview: {response['formatted_context']}")
+        print(f"Context preview: {response.get('formatted_context', '')}")
         print(f"Sources: {sources}")
         print(f"Answer: {answer}")
         print(f"Response time: {time.time() - start_time:.2f} seconds ({power_mode})")
-        print("-" * 50)
\ No newline at end of file
+        print("-" * 50)
@@ -0,0 +1,189 @@
+"""
+metrics.py — метрики пропускной способности индексации.
+
+IndexingMetrics собирает по этапам build_index (scan, extract, chunk, embed,
+faiss_insert, save) счётчики элементов / байт / чанков, суммарное время и
+гистограмму латентностей. Для extract дополнительно ведётся разбивка по типу
+файла и топ самых медленных документов, для очередей — текущая и пиковая
+глубина. snapshot() потокобезопасен: UI может опрашивать его во время
+индексации через RAGCoordinator.metrics_snapshot().
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import heapq
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+METRICS_FILE_NAME = "indexing_metrics.json"
+
+# Границы корзин гистограммы латентностей, мс (последняя корзина — «больше»)
+_LATENCY_BUCKETS_MS = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 60000]
+
+_SLOWEST_FILES = 10
+
+
+class _StageStats:
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.min_ms: Optional[float] = None
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(_LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, seconds: float, items: int, n_bytes: int, chunks: int, error: bool):
+        ms = seconds * 1000
+        self.count += items
+        self.bytes += n_bytes
+        self.chunks += chunks
+        self.errors += 1 if error else 0
+        self.seconds += seconds
+        self.min_ms = ms if self.min_ms is None else min(self.min_ms, ms)
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect.bisect_left(_LATENCY_BUCKETS_MS, ms)] += 1
+
+    def to_dict(self) -> dict:
+        sec = self.seconds
+        labels = [f"<={b}ms" for b in _LATENCY_BUCKETS_MS] + [f">{_LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "bytes": self.bytes,
+            "chunks": self.chunks,
+            "errors": self.errors,
+            "seconds": round(sec, 3),
+            "min_ms": round(self.min_ms, 2) if self.min_ms is not None else None,
+            "max_ms": round(self.max_ms, 2),
+            "items_per_s": round(self.count / sec, 2) if sec > 0 else None,
+            "bytes_per_s": round(self.bytes / sec, 1) if sec > 0 else None,
+            "chunks_per_s": round(self.chunks / sec, 2) if sec > 0 else None,
+            "histogram": {label: n for label, n in zip(labels, self.buckets) if n},
+        }
+
+
+class IndexingMetrics:
+    """Метрики одного прогона build_index."""
+
+    def __init__(self, folder_path: str = ""):
+        self.folder_path = folder_path
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.status = "running"  # running | cached | done | empty | error
+        self._t0 = time.perf_counter()
+        self._wall_s: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stages: dict = {}
+        self._by_type: dict = {}
+        self._slowest: list = []  # min-heap (seconds, path, ext, bytes, text_chars)
+        self._queues: dict = {}   # name -> {"depth", "peak"}
+        self.info: dict = {}
+
+    # ── запись ───────────────────────────────────────────────────────────
+
+    def observe(self, stage: str, seconds: float, items: int = 1, n_bytes: int = 0,
+                chunks: int = 0, error: bool = False) -> None:
+        with self._lock:
+            self._stages.setdefault(stage, _StageStats()).observe(seconds, items, n_bytes, chunks, error)
+
+    @contextmanager
+    def measure(self, stage: str, items: int = 1, n_bytes: int = 0, chunks: int = 0):
+        """
+        with metrics.measure("embed", items=len(batch)) as m:
+            ...
+            m["chunks"] = len(batch)
+        """
+        m = {"items": items, "bytes": n_bytes, "chunks": chunks, "error": False}
+        start = time.perf_counter()
+        try:
+            yield m
+        except Exception:
+            m["error"] = True
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, m["items"], m["bytes"], m["chunks"], m["error"])
+
+    def observe_file(self, path: str, seconds: float, n_bytes: int, text_chars: int, error: bool = False) -> None:
+        """Извлечение текста одного файла: этап extract + разбивка по типу + топ медленных."""
+        ext = os.path.splitext(path)[1].lower().lstrip(".") or "?"
+        self.observe("extract", seconds, 1, n_bytes, 0, error)
+        with self._lock:
+            st = self._by_type.setdefault(ext, _StageStats())
+            st.observe(seconds, 1, n_bytes, 0, error)
+            entry = (seconds, path, ext, n_bytes, text_chars)
+            if len(self._slowest) < _SLOWEST_FILES:
+                heapq.heappush(self._slowest, entry)
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def set_queue_depth(self, name: str, depth: int) -> None:
+        with self._lock:
+            q = self._queues.setdefault(name, {"depth": 0, "peak": 0})
+            q["depth"] = depth
+            q["peak"] = max(q["peak"], depth)
+
+    def finish(self, status: str = "done") -> None:
+        with self._lock:
+            if self._wall_s is None:
+                self._wall_s = time.perf_counter() - self._t0
+                self.finished_at = time.time()
+            self.status = status
+
+    # ── чтение ───────────────────────────────────────────────────────────
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            wall = self._wall_s if self._wall_s is not None else time.perf_counter() - self._t0
+            stages = {name: st.to_dict() for name, st in self._stages.items()}
+            by_type = {ext: st.to_dict() for ext, st in sorted(self._by_type.items())}
+            slowest = [
+                {"path": p, "type": ext, "seconds": round(s, 3), "bytes": b, "text_chars": c}
+                for s, p, ext, b, c in sorted(self._slowest, reverse=True)
+            ]
+            queues = {name: dict(q) for name, q in self._queues.items()}
+            info = dict(self.info)
+        extract = stages.get("extract", {})
+        chunk = stages.get("chunk", {})
+        return {
+            "folder": self.folder_path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wall_seconds": round(wall, 3),
+            # Сквозная пропускная способность — относительно полного времени прогона
+            "files_per_s": round(extract.get("count", 0) / wall, 2) if wall > 0 else None,
+            "bytes_per_s": round(extract.get("bytes", 0) / wall, 1) if wall > 0 else None,
+            "chunks_per_s": round(chunk.get("chunks", 0) / wall, 2) if wall > 0 else None,
+            "stages": stages,
+            "extract_by_type": by_type,
+            "slowest_files": slowest,
+            "queues": queues,
+            "info": info,
+        }
+
+    def dump(self, path: str) -> None:
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+        except Exception as e:
+            logging.warning(f"[METRICS] Не удалось сохранить метрики индексации: {e}")
+
+
+def load_metrics(folder_path: str) -> Optional[dict]:
+    """Последний сохранённый снимок метрик для папки (или None)."""
+    from cache import get_folder_cache_dir
+    path = os.path.join(get_folder_cache_dir(folder_path), METRICS_FILE_NAME)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
@@ -0,0 +1,133 @@
+"""
+multi_index.py — поиск сразу по нескольким загруженным индексам папок.
+
+FanOutVectorStore повторяет ту часть интерфейса FAISS, которой пользуется
+wrapped_qa_chain (embeddings, docstore._dict, MMR по вектору/строке,
+as_retriever), поэтому вопрос «по всем папкам» проходит ту же цепочку:
+ветки, сборку контекста, стрим и историю диалога.
+
+Каждый индекс ищется отдельно (MMR со score), кандидаты сливаются по
+расстоянию и обрезаются до k. Все индексы строятся одной моделью
+эмбеддингов (config.EMBEDDING_MODEL), поэтому расстояния сравнимы, а вектор
+вопроса считается один раз.
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Optional
+
+# Грубая оценка накладных расходов на Document в docstore (объект, метаданные, ключ)
+_DOC_OVERHEAD_BYTES = 400
+
+
+def estimate_index_bytes(vectorstore) -> int:
+    """Примерная память индекса: векторы FAISS (float32) + тексты чанков в docstore."""
+    total = 0
+    try:
+        index = vectorstore.index
+        total += int(index.ntotal) * int(index.d) * 4
+    except Exception:
+        pass
+    try:
+        for doc in vectorstore.docstore._dict.values():
+            total += len(doc.page_content.encode("utf-8")) + _DOC_OVERHEAD_BYTES
+    except Exception:
+        pass
+    return total
+
+
+def _higher_is_better(vectorstore) -> bool:
+    # По умолчанию FAISS в langchain — евклидово расстояние (меньше — ближе)
+    strategy = getattr(vectorstore, "distance_strategy", None)
+    return str(getattr(strategy, "value", strategy) or "").upper() == "MAX_INNER_PRODUCT"
+
+
+def _folder_contains(folder: str, path: str) -> bool:
+    try:
+        return os.path.commonpath([folder, os.path.abspath(path)]) == folder
+    except ValueError:
+        return False
+
+
+class _MergedDocstore:
+    """docstore._dict объединённого индекса (ключи — с префиксом папки, чтобы не пересекались)."""
+
+    def __init__(self, stores: list):
+        self._stores = stores
+        self._merged: Optional[dict] = None
+
+    @property
+    def _dict(self) -> dict:
+        if self._merged is None:
+            merged = {}
+            for folder, vs in self._stores:
+                for key, doc in vs.docstore._dict.items():
+                    merged[f"{folder}\x00{key}"] = doc
+            self._merged = merged
+        return self._merged
+
+
+class _FanOutRetriever:
+    def __init__(self, store: "FanOutVectorStore", search_kwargs: dict):
+        self._store = store
+        self._k = search_kwargs.get("k", 4)
+        self._filter = search_kwargs.get("filter")
+
+    def invoke(self, query: str) -> list:
+        vector = self._store.embeddings.embed_query(query)
+        pairs = self._store.similarity_search_with_score_by_vector(vector, k=self._k, filter=self._filter)
+        return [doc for doc, _score in pairs]
+
+
+class FanOutVectorStore:
+    """Несколько FAISS-индексов за интерфейсом одного. stores — [(папка, vectorstore)]."""
+
+    def __init__(self, stores: list):
+        if not stores:
+            raise ValueError("stores must not be empty")
+        self.stores = [(os.path.abspath(folder), vs) for folder, vs in stores]
+        self.embeddings = self.stores[0][1].embeddings
+        self.docstore = _MergedDocstore(self.stores)
+        self._reverse = _higher_is_better(self.stores[0][1])
+
+    @property
+    def folders(self) -> list:
+        return [folder for folder, _vs in self.stores]
+
+    def _targets(self, filter: Optional[dict]) -> list:
+        # Фильтр по файлу: искать имеет смысл только в индексе папки, где лежит файл
+        source = (filter or {}).get("source")
+        if source:
+            targets = [(f, vs) for f, vs in self.stores if _folder_contains(f, source)]
+            if targets:
+                return targets
+        return self.stores
+
+    def _merge(self, pairs: list, k: int) -> list:
+        pairs.sort(key=lambda p: p[1], reverse=self._reverse)
+        return pairs[:k]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4, filter: Optional[dict] = None,
+                                               **kwargs) -> list:
+        pairs = []
+        for _folder, vs in self._targets(filter):
+            pairs.extend(vs.similarity_search_with_score_by_vector(embedding, k=k, filter=filter, **kwargs))
+        return self._merge(pairs, k)
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k: int = 4, fetch_k: int = 20,
+                                                filter: Optional[dict] = None, **kwargs) -> list:
+        pairs = []
+        for _folder, vs in self._targets(filter):
+            pairs.extend(vs.max_marginal_relevance_search_with_score_by_vector(
+                embedding, k=k, fetch_k=fetch_k, filter=filter, **kwargs
+            ))
+        return [doc for doc, _score in self._merge(pairs, k)]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20,
+                                      filter: Optional[dict] = None, **kwargs) -> list:
+        vector = self.embeddings.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(vector, k=k, fetch_k=fetch_k, filter=filter, **kwargs)
+
+    def as_retriever(self, search_kwargs: Optional[dict] = None) -> _FanOutRetriever:
+        return _FanOutRetriever(self, search_kwargs or {})
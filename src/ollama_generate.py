@@ -0,0 +1,271 @@
+"""
+ollama_generate.py — генерация через /api/generate с переиспользованием префикса.
+
+Промпт раскладывается так, чтобы неизменная часть шла первой:
+
+    <инструкция> → Контекст: <фрагменты> → Вопрос: <вопрос> → Ответ:
+
+Инструкция одинакова для всех вопросов, поэтому Ollama (llama.cpp) берёт её
+из KV-кеша загруженной модели. Кроме того, для каждой области (папка + файл)
+запоминаются токены `context`, которые Ollama возвращает в конце генерации.
+Если следующий вопрос в той же области опирается на те же фрагменты (все
+блоки нового контекста уже были в прошлом), отправляется только сам вопрос
+вместе с сохранёнными токенами — префилл контекста не повторяется.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from config import OLLAMA_BASE_URL
+
+# Сколько областей держим в памяти
+_MAX_SCOPES = 8
+# Сохранённые токены + новый вопрос и ответ должны поместиться в num_ctx модели
+# (по умолчанию у Ollama 4096), иначе Ollama обрежет начало — и префикс, и контекст
+_NUM_CTX = 4096
+_TURN_RESERVE_TOKENS = 512
+# Через сколько секунд простоя сохранённые токены считаем устаревшими (keep_alive модели)
+_SCOPE_TTL_S = 5 * 60
+
+_CONTEXT_BLOCK_SEP = "\n\n[Источник: "
+
+
+def history_block(history: str) -> str:
+    return f"История диалога:\n{history}\n\n" if history else ""
+
+
+def build_prompt(preamble: str, context: str, question: str, history: str = "") -> str:
+    """Стабильная раскладка: инструкция, контекст, история диалога, вопрос — последним."""
+    return f"{preamble}\n\nКонтекст:\n{context}\n\n{history_block(history)}Вопрос: {question}\n\nОтвет:"
+
+
+def _follow_up_prompt(question: str) -> str:
+    return f"Вопрос: {question}\n\nОтвет:"
+
+
+def _context_blocks(context: str) -> list:
+    parts = context.split(_CONTEXT_BLOCK_SEP)
+    return [parts[0]] + [_CONTEXT_BLOCK_SEP + p for p in parts[1:]]
+
+
+class _ScopeState:
+    def __init__(self, context: str, tokens: list):
+        self.context = context
+        self.tokens = tokens
+        self.updated_at = time.monotonic()
+        self.busy = False
+
+
+class OllamaGenerateLLM:
+    """Клиент /api/generate со стримингом и переиспользованием context по областям."""
+
+    class _Chunk:
+        def __init__(self, text: str, model_used: str):
+            self.content = text
+            self.model_used = model_used
+
+    class _Response:
+        def __init__(self, text: str, model_used: str):
+            self.content = text
+            self.model_used = model_used
+
+    def __init__(self, model: str, use_gpu: bool = True, temperature: float = 0.1, keep_alive: str = "5m",
+                 prefix_reuse: bool = True):
+        self.model = model
+        self.use_gpu = use_gpu
+        self.temperature = temperature
+        self.keep_alive = keep_alive
+        self.prefix_reuse = prefix_reuse
+        self._scopes: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _options(self) -> dict:
+        # num_gpu — как у ChatOllama и warm-up, иначе Ollama перезагрузит модель
+        return {"num_gpu": -1 if self.use_gpu else 0, "temperature": self.temperature}
+
+    @property
+    def url(self) -> str:
+        return f"{OLLAMA_BASE_URL}/api/generate"
+
+    def payload(self, prompt: str, stream: bool, context_tokens: Optional[list] = None) -> dict:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "options": self._options(),
+        }
+        if context_tokens:
+            payload["context"] = context_tokens
+        return payload
+
+    def _post(self, prompt: str, stream: bool, context_tokens: Optional[list] = None):
+        from llm_clients import get_http_session
+
+        resp = get_http_session().post(
+            self.url, json=self.payload(prompt, stream, context_tokens), timeout=120, stream=stream,
+        )
+        if resp.status_code != 200:
+            try:
+                msg = resp.json().get("error", resp.text[:200])
+            except Exception:
+                msg = resp.text[:200]
+            resp.close()
+            raise RuntimeError(f"Ollama {resp.status_code}: {msg}")
+        return resp
+
+    # ── области ──────────────────────────────────────────────────────────
+
+    @staticmethod
+    def scope_key(*parts) -> str:
+        return hashlib.sha1("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:16]
+
+    def _acquire_scope(self, scope: str, context: str) -> Optional[_ScopeState]:
+        """Состояние области, если его можно переиспользовать для этого контекста."""
+        with self._lock:
+            st = self._scopes.get(scope)
+            if st is None or st.busy:
+                return None
+            if time.monotonic() - st.updated_at > _SCOPE_TTL_S or len(st.tokens) + _TURN_RESERVE_TOKENS > _NUM_CTX:
+                del self._scopes[scope]
+                return None
+            if not all(block in st.context for block in _context_blocks(context)):
+                return None
+            st.busy = True
+            self._scopes.move_to_end(scope)
+            return st
+
+    def _store_scope(self, scope: str, context: str, tokens: list, reused: Optional[_ScopeState]):
+        with self._lock:
+            if reused is not None:
+                # Область продолжает прежний контекст; набор фрагментов не меняется
+                reused.tokens = tokens
+                reused.updated_at = time.monotonic()
+                reused.busy = False
+                return
+            self._scopes[scope] = _ScopeState(context, tokens)
+            self._scopes.move_to_end(scope)
+            while len(self._scopes) > _MAX_SCOPES:
+                self._scopes.popitem(last=False)
+
+    def _release_scope(self, scope: str, reused: Optional[_ScopeState]):
+        with self._lock:
+            if reused is not None:
+                # Генерация прервалась — токены могли разойтись с сервером, начинаем заново
+                self._scopes.pop(scope, None)
+
+    # ── генерация ────────────────────────────────────────────────────────
+
+    def begin_scoped(self, scope: Optional[str], preamble: str, context: str, question: str, history: str = "",
+                     stats: Optional[dict] = None) -> tuple:
+        """
+        Первая половина stream_scoped без сети: (payload, reused). После
+        генерации обязательно вызвать end_scoped — он сохранит или освободит область.
+        Используется и синхронным стримом, и async_engine. scope=None — без
+        переиспользования (независимый вопрос вне диалога).
+        """
+        reused = self._acquire_scope(scope, context) if self.prefix_reuse and scope else None
+        if reused is not None:
+            prompt = _follow_up_prompt(question)
+            payload = self.payload(prompt, stream=True, context_tokens=reused.tokens)
+        else:
+            prompt = build_prompt(preamble, context, question, history)
+            payload = self.payload(prompt, stream=True)
+        if stats is not None:
+            stats["prefix_reused"] = reused is not None
+            stats["prompt_chars"] = len(prompt)
+        return payload, reused
+
+    def end_scoped(self, scope: Optional[str], context: str, reused: Optional[_ScopeState], done_event: Optional[dict],
+                   stats: Optional[dict] = None) -> None:
+        """done_event — последнее событие стрима ("done": true) или None, если генерация прервалась."""
+        if done_event is not None and stats is not None:
+            stats["prompt_eval_count"] = done_event.get("prompt_eval_count")
+            if done_event.get("prompt_eval_duration") is not None:
+                stats["prompt_eval_ms"] = round(done_event["prompt_eval_duration"] / 1e6, 1)
+        tokens = done_event.get("context") if done_event is not None else None
+        if self.prefix_reuse and scope and isinstance(tokens, list) and tokens:
+            self._store_scope(scope, context, tokens, reused)
+        else:
+            self._release_scope(scope, reused)
+
+    @staticmethod
+    def parse_event(line) -> Optional[dict]:
+        """Строка NDJSON-стрима → событие (None для пустых/битых строк); ошибка Ollama — исключение."""
+        if not line:
+            return None
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return None
+        if event.get("error"):
+            raise RuntimeError(f"Ollama: {event['error']}")
+        return event
+
+    def stream_scoped(self, scope: Optional[str], preamble: str, context: str, question: str, stats: Optional[dict] = None,
+                      history: str = ""):
+        """
+        Генератор _Chunk. stats (если передан) дополняется: prefix_reused,
+        prompt_chars, prompt_eval_count, prompt_eval_ms. history идёт только
+        в полный промпт — при продолжении области прошлые реплики уже в context.
+        """
+        from llm_clients import get_http_session
+
+        payload, reused = self.begin_scoped(scope, preamble, context, question, history, stats)
+        done_event = None
+        resp = None
+        try:
+            resp = get_http_session().post(self.url, json=payload, timeout=120, stream=True)
+            if resp.status_code != 200:
+                raise RuntimeError(f"Ollama {resp.status_code}: {resp.text[:200]}")
+            for line in resp.iter_lines(decode_unicode=False):
+                event = self.parse_event(line)
+                if event is None:
+                    continue
+                text = event.get("response")
+                if text:
+                    yield self._Chunk(text, self.model)
+                if event.get("done"):
+                    done_event = event
+                    break
+        finally:
+            if resp is not None:
+                resp.close()
+            self.end_scoped(scope, context, reused, done_event, stats)
+
+    def stream(self, prompt):
+        """Обычный стрим без области (совместимость с ChatOllama.stream)."""
+        text = prompt.to_string() if hasattr(prompt, "to_string") else str(prompt)
+        resp = self._post(text, stream=True)
+        try:
+            for line in resp.iter_lines(decode_unicode=False):
+                event = self.parse_event(line)
+                if event is None:
+                    continue
+                if event.get("response"):
+                    yield self._Chunk(event["response"], self.model)
+                if event.get("done"):
+                    break
+        finally:
+            resp.close()
+
+    def invoke(self, prompt) -> "_Response":
+        text = prompt.to_string() if hasattr(prompt, "to_string") else str(prompt)
+        resp = self._post(text, stream=False)
+        try:
+            data = resp.json()
+        finally:
+            resp.close()
+        return self._Response(data.get("response", ""), self.model)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._scopes.clear()
+        logging.info(f"[OLLAMA] Сброшены сохранённые префиксы для {self.model}")
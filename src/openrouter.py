@@ -0,0 +1,550 @@
+"""
+openrouter.py — клиент OpenRouter с retry, fallback по моделям и hedging.
+
+Бесплатные модели OpenRouter часто отвечают 429 или подолгу молчат, поэтому
+один запрос проходит через несколько ступеней:
+
+  1. retry с экспоненциальной задержкой на той же модели (429, 5xx, таймауты);
+  2. fallback на следующую модель из OPENROUTER_FREE_MODELS;
+  3. circuit breaker на модель: после нескольких неудач подряд модель
+     пропускается на время cooldown. Состояние хранится в
+     <cache_root>/openrouter_breakers.json и переживает перезапуск;
+  4. hedging (опционально): если выбранная модель не ответила за
+     hedge_after_s (для stream — не прислала первый токен), параллельно
+     запускается следующая модель; берётся тот ответ, что пришёл первым.
+
+Какая модель ответила — в .model_used ответа (invoke) и каждого чанка (stream).
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional
+
+import requests
+
+from config import OPENROUTER_FREE_MODELS
+
+OPENROUTER_CHAT_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+_REQUEST_TIMEOUT_S = 60
+
+# Retry на одной модели: задержки 0.5 → 1 → 2 с (с джиттером), не больше _BACKOFF_MAX_S
+_MAX_RETRIES = 3
+_BACKOFF_BASE_S = 0.5
+_BACKOFF_MAX_S = 4.0
+
+# Сколько моделей максимум пробуем за один запрос (выбранная + резервные)
+_MAX_MODELS_PER_REQUEST = 4
+
+# Circuit breaker
+_BREAKER_FILE = "openrouter_breakers.json"
+_BREAKER_FAILURE_THRESHOLD = 2
+_BREAKER_COOLDOWN_S = 60.0
+_BREAKER_COOLDOWN_MAX_S = 30 * 60.0
+_BREAKER_NOT_FOUND_S = 24 * 3600.0
+
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+_hedge_pool_lock = threading.Lock()
+
+
+def _get_hedge_pool() -> ThreadPoolExecutor:
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _hedge_pool_lock:
+            if _hedge_pool is None:
+                _hedge_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="openrouter")
+    return _hedge_pool
+
+
+class ModelError(RuntimeError):
+    """
+    Ошибка одной модели. retryable — имеет смысл повторить на ней же,
+    fatal — бессмысленно пробовать другие модели (например, неверный ключ).
+    """
+
+    def __init__(self, message: str, model: str, code: Optional[int] = None, retryable: bool = False,
+                 fatal: bool = False, retry_after: Optional[float] = None, trips_breaker: bool = True):
+        super().__init__(message)
+        self.model = model
+        self.code = code
+        self.retryable = retryable
+        self.fatal = fatal
+        self.retry_after = retry_after
+        self.trips_breaker = trips_breaker
+
+
+def _error_from_response(resp, model: str) -> ModelError:
+    """Человекочитаемые сообщения об ошибках + классификация для retry/fallback."""
+    code = resp.status_code
+    try:
+        err = resp.json().get("error", {})
+        msg = err.get("message", resp.text[:200])
+    except Exception:
+        msg = resp.text[:200]
+    retry_after = None
+    try:
+        retry_after = float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        pass
+
+    if code == 429:
+        return ModelError(
+            f"Модель {model} перегружена (rate limit). Попробуйте позже или выберите другую модель в настройках.",
+            model, code, retryable=True, retry_after=retry_after,
+        )
+    if code == 400:
+        # Обычно слишком длинный контекст — проблема запроса, а не модели: breaker не трогаем
+        return ModelError(
+            f"Модель {model} не приняла запрос (возможно слишком длинный контекст). Выберите другую модель.",
+            model, code, trips_breaker=False,
+        )
+    if code == 401:
+        return ModelError("Неверный API ключ OpenRouter. Проверьте ключ в настройках.", model, code, fatal=True)
+    if code == 404:
+        return ModelError(
+            f"Модель {model} не найдена на OpenRouter. Выберите другую модель в настройках.",
+            model, code, retry_after=_BREAKER_NOT_FOUND_S,
+        )
+    return ModelError(
+        f"Ошибка OpenRouter {code}: {msg}", model, code,
+        retryable=code >= 500 or code == 408, retry_after=retry_after,
+    )
+
+
+def _backoff_delay(attempt: int, retry_after: Optional[float]) -> float:
+    if retry_after is not None:
+        return retry_after
+    delay = min(_BACKOFF_MAX_S, _BACKOFF_BASE_S * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+
+# ── Circuit breakers ─────────────────────────────────────────────────────
+
+class CircuitBreakers:
+    """Состояние breaker'ов по моделям, сохраняемое в JSON между сессиями."""
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._state: Optional[dict] = None
+
+    def _file(self) -> str:
+        if self._path is None:
+            from cache import get_cache_root
+            self._path = os.path.join(get_cache_root(), _BREAKER_FILE)
+        return self._path
+
+    def _load(self) -> dict:
+        if self._state is None:
+            try:
+                with open(self._file(), "r", encoding="utf-8") as f:
+                    self._state = json.load(f)
+            except Exception:
+                self._state = {}
+        return self._state
+
+    def _save(self) -> None:
+        try:
+            path = self._file()
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._state, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+        except Exception as e:
+            logging.warning(f"[OPENROUTER] Не удалось сохранить состояние breaker'ов: {e}")
+
+    def is_open(self, model: str) -> bool:
+        with self._lock:
+            st = self._load().get(model)
+            return bool(st) and st.get("open_until", 0) > time.time()
+
+    def record_success(self, model: str) -> None:
+        with self._lock:
+            state = self._load()
+            if model in state:
+                del state[model]
+                self._save()
+
+    def record_failure(self, model: str, error: ModelError) -> None:
+        if not error.trips_breaker or error.fatal:
+            return
+        now = time.time()
+        with self._lock:
+            st = self._load().setdefault(model, {"failures": 0, "trips": 0, "open_until": 0})
+            st["failures"] += 1
+            st["last_error"] = str(error)[:200]
+            cooldown = None
+            if error.code == 404:
+                cooldown = _BREAKER_NOT_FOUND_S
+            elif error.retry_after and error.retry_after > _BACKOFF_MAX_S:
+                cooldown = error.retry_after
+            elif st["failures"] >= _BREAKER_FAILURE_THRESHOLD:
+                cooldown = min(_BREAKER_COOLDOWN_MAX_S, _BREAKER_COOLDOWN_S * (2 ** st["trips"]))
+            if cooldown:
+                st["trips"] += 1
+                st["failures"] = 0
+                st["open_until"] = now + cooldown
+                logging.warning(f"[OPENROUTER] Breaker открыт для {model} на {cooldown:.0f} с: {error}")
+            self._save()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self._load()))
+
+
+breakers = CircuitBreakers()
+
+
+# ── Запросы одной модели для hedging ─────────────────────────────────────
+
+class _Lane:
+    """Отменяемый запрос к одной модели: отмена закрывает ответ и прекращает retry."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._cancelled = threading.Event()
+        self._resp = None
+
+    def cancel(self):
+        self._cancelled.set()
+        resp = self._resp
+        if resp is not None:
+            try:
+                resp.close()
+            except Exception:
+                pass
+
+
+class _StreamLane(_Lane):
+    """Один стрим-запрос в фоновом потоке; события складываются в общую очередь."""
+
+    def __init__(self, llm: "OpenRouterLLM", model: str, text: str, events: queue.Queue):
+        super().__init__(model)
+        self._llm = llm
+        self._text = text
+        self._events = events
+        self._thread = threading.Thread(target=self._run, name=f"openrouter-{model}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for chunk in self._llm._stream_model(self.model, self._text, self):
+                if self._cancelled.is_set():
+                    return
+                self._events.put((self, "chunk", chunk))
+            self._events.put((self, "done", None))
+        except Exception as e:
+            if not self._cancelled.is_set():
+                self._events.put((self, "error", e))
+
+
+class OpenRouterLLM:
+    """
+    Враппер для OpenRouter API с автоматическим retry и fallback на другие модели.
+
+    При 429 / 5xx / таймауте повторяет запрос с экспоненциальной задержкой,
+    затем (и сразу при 400 / 404) пробует следующую модель из
+    OPENROUTER_FREE_MODELS, пропуская модели с открытым breaker'ом.
+    Использует requests напрямую — без langchain-openai. invoke() — один
+    ответ целиком, stream() — SSE-поток дельт (как ChatOllama.stream).
+    """
+
+    def __init__(self, api_key: str, model: str, temperature: float = 0.1, fallback: bool = True,
+                 hedge_after_s: Optional[float] = None, max_retries: int = _MAX_RETRIES):
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.fallback = fallback
+        self.hedge_after_s = hedge_after_s if hedge_after_s and hedge_after_s > 0 else None
+        self.max_retries = max_retries
+
+    class _Response:
+        def __init__(self, text: str):
+            self.content = text
+
+    class _Chunk:
+        """Фрагмент стрима: .content — новая часть текста, .model_used — кто отвечает."""
+
+        def __init__(self, text: str, model_used: str):
+            self.content = text
+            self.model_used = model_used
+
+    def _prompt_to_text(self, prompt) -> str:
+        if hasattr(prompt, "to_string"):
+            text = prompt.to_string()
+        elif hasattr(prompt, "text"):
+            text = prompt.text
+        else:
+            text = str(prompt)
+        # Длину контекста ограничивает context_builder (бюджет токенов), здесь не режем
+        return text
+
+    def _candidates(self) -> list:
+        """Выбранная модель, затем бесплатные; модели с открытым breaker'ом — в конец."""
+        models = [self.model]
+        if self.fallback:
+            models += [m for m in OPENROUTER_FREE_MODELS if m != self.model]
+        ready = [m for m in models if not breakers.is_open(m)]
+        if not ready:
+            # Все на cooldown — всё равно пробуем выбранную модель
+            return [self.model]
+        return ready[:_MAX_MODELS_PER_REQUEST]
+
+    def _call_model(self, model: str, text: str, stream: bool = False):
+        from llm_clients import get_http_session
+
+        payload = {
+            "model": model,
+            "messages": [{"role": "user", "content": text}],
+            "temperature": self.temperature,
+        }
+        if stream:
+            payload["stream"] = True
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com/W1TAS/rag_local_fs",
+            "X-Title": "RAG Local FS",
+        }
+        try:
+            return get_http_session().post(
+                OPENROUTER_CHAT_URL,
+                json=payload,
+                headers=headers,
+                timeout=_REQUEST_TIMEOUT_S,
+                stream=stream,
+            )
+        except (requests.Timeout, requests.ConnectionError) as e:
+            raise ModelError(f"Модель {model} не ответила: {e}", model, retryable=True) from e
+
+    def _request_with_retries(self, model: str, text: str, stream: bool, lane: Optional[_Lane] = None):
+        """HTTP-запрос к одной модели с retry; возвращает ответ со статусом 200."""
+        for attempt in range(self.max_retries + 1):
+            if lane is not None and lane._cancelled.is_set():
+                raise ModelError(f"Запрос к {model} отменён", model)
+            try:
+                resp = self._call_model(model, text, stream=stream)
+                if lane is not None:
+                    lane._resp = resp
+                if resp.status_code == 200:
+                    return resp
+                error = _error_from_response(resp, model)
+                resp.close()
+            except ModelError as e:
+                error = e
+            if lane is not None and lane._cancelled.is_set():
+                raise error
+            delay = _backoff_delay(attempt, error.retry_after)
+            if not error.retryable or attempt >= self.max_retries or delay > _BACKOFF_MAX_S:
+                breakers.record_failure(model, error)
+                raise error
+            logging.info(f"[OPENROUTER] {model}: {error.code or 'сеть'}, повтор через {delay:.1f} с")
+            if lane is not None:
+                lane._cancelled.wait(delay)
+            else:
+                time.sleep(delay)
+
+    # ── invoke ───────────────────────────────────────────────────────────
+
+    def _invoke_model(self, model: str, text: str, lane: Optional[_Lane] = None) -> "_Response":
+        resp = self._request_with_retries(model, text, stream=False, lane=lane)
+        try:
+            data = resp.json()
+            answer = data["choices"][0]["message"]["content"]
+        except Exception as e:
+            error = ModelError(f"Модель {model} вернула некорректный ответ: {e}", model)
+            breakers.record_failure(model, error)
+            raise error
+        breakers.record_success(model)
+        result = self._Response(answer)
+        result.model_used = data.get("model") or model
+        return result
+
+    def invoke(self, prompt) -> "_Response":
+        import logging as _log
+
+        text = self._prompt_to_text(prompt)
+        candidates = self._candidates()
+        _log.info(f"[OPENROUTER] Запрос к модели: {candidates[0]}")
+
+        errors = []
+        if self.hedge_after_s is None:
+            # Без hedging — модели по очереди в вызывающем потоке, пул не занимаем
+            for model in candidates:
+                try:
+                    result = self._invoke_model(model, text)
+                except ModelError as e:
+                    _log.warning(f"[OPENROUTER] {model}: {e}")
+                    if e.fatal:
+                        raise RuntimeError(str(e))
+                    errors.append(e)
+                    continue
+                _log.info(f"[OPENROUTER] Ответ получен от: {result.model_used}")
+                return result
+            raise RuntimeError(self._summarize_errors(errors))
+
+        pool = _get_hedge_pool()
+        futures = {}
+        hedged = False
+
+        def _launch():
+            lane = _Lane(candidates.pop(0))
+            futures[pool.submit(self._invoke_model, lane.model, text, lane)] = lane
+
+        _launch()
+        try:
+            while futures:
+                hedge_wait = self.hedge_after_s if (not hedged and candidates) else None
+                done, _ = wait(list(futures), timeout=hedge_wait, return_when=FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    _log.info(f"[OPENROUTER] Нет ответа за {self.hedge_after_s:.1f} с — hedging на {candidates[0]}")
+                    _launch()
+                    continue
+                for fut in done:
+                    model = futures.pop(fut).model
+                    try:
+                        result = fut.result()
+                    except ModelError as e:
+                        _log.warning(f"[OPENROUTER] {model}: {e}")
+                        if e.fatal:
+                            raise RuntimeError(str(e))
+                        errors.append(e)
+                        continue
+                    _log.info(f"[OPENROUTER] Ответ получен от: {result.model_used}")
+                    return result
+                # Упавшую модель заменяем следующей
+                if not futures and candidates:
+                    _launch()
+            raise RuntimeError(self._summarize_errors(errors))
+        finally:
+            # Проигравшие запросы не должны держать воркеры пула до таймаута и retry
+            for fut, lane in futures.items():
+                fut.cancel()
+                lane.cancel()
+
+    # ── stream ───────────────────────────────────────────────────────────
+
+    def _iter_sse(self, resp, model: str):
+        model_used = model
+        for line in resp.iter_lines(decode_unicode=False):
+            # Пустые строки разделяют события, ":" — keep-alive комментарии OpenRouter
+            if not line or line.startswith(b":") or not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            if event.get("error"):
+                err = event["error"]
+                msg = err.get("message", str(err)) if isinstance(err, dict) else str(err)
+                raise ModelError(f"Ошибка OpenRouter во время генерации: {msg}", model)
+            model_used = event.get("model") or model_used
+            choices = event.get("choices") or []
+            if not choices:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield self._Chunk(delta, model_used)
+
+    def _stream_model(self, model: str, text: str, lane: Optional[_StreamLane] = None):
+        resp = self._request_with_retries(model, text, stream=True, lane=lane)
+        try:
+            got_any = False
+            for chunk in self._iter_sse(resp, model):
+                if not got_any:
+                    got_any = True
+                    breakers.record_success(model)
+                yield chunk
+        except ModelError as e:
+            breakers.record_failure(model, e)
+            raise
+        finally:
+            resp.close()
+
+    def stream(self, prompt):
+        """
+        Генератор _Chunk по мере прихода SSE-событий. Запрос отправляется при
+        первой итерации. Fallback и hedging работают до первого токена: после
+        него стрим привязан к ответившей модели.
+        """
+        import logging as _log
+
+        text = self._prompt_to_text(prompt)
+        candidates = self._candidates()
+        _log.info(f"[OPENROUTER] Стрим от модели: {candidates[0]}")
+
+        events: queue.Queue = queue.Queue()
+        lanes = []
+        errors = []
+        winner = None
+        hedged = False
+
+        def _launch():
+            lanes.append(_StreamLane(self, candidates.pop(0), text, events))
+
+        _launch()
+        try:
+            while True:
+                hedge_wait = (
+                    self.hedge_after_s
+                    if (winner is None and self.hedge_after_s and not hedged and candidates) else None
+                )
+                try:
+                    lane, kind, payload = events.get(timeout=hedge_wait)
+                except queue.Empty:
+                    hedged = True
+                    _log.info(f"[OPENROUTER] Нет первого токена за {self.hedge_after_s:.1f} с — hedging на {candidates[0]}")
+                    _launch()
+                    continue
+
+                if winner is not None and lane is not winner:
+                    continue
+
+                if kind == "chunk":
+                    if winner is None:
+                        winner = lane
+                        for other in lanes:
+                            if other is not lane:
+                                other.cancel()
+                    yield payload
+                elif kind == "done":
+                    if winner is None:
+                        winner = lane
+                    _log.info(f"[OPENROUTER] Стрим завершён: {lane.model}")
+                    return
+                else:
+                    if winner is not None:
+                        raise payload
+                    lanes.remove(lane)
+                    _log.warning(f"[OPENROUTER] {lane.model}: {payload}")
+                    if isinstance(payload, ModelError) and payload.fatal:
+                        raise RuntimeError(str(payload))
+                    errors.append(payload)
+                    if not lanes:
+                        if not candidates:
+                            raise RuntimeError(self._summarize_errors(errors))
+                        _launch()
+        finally:
+            # И проигравшие hedge-запросы, и победитель, если потребитель бросил стрим
+            for lane in lanes:
+                lane.cancel()
+
+    def _summarize_errors(self, errors: list) -> str:
+        if not errors:
+            return f"Модель {self.model} недоступна."
+        if len(errors) == 1:
+            return str(errors[0])
+        tried = ", ".join(getattr(e, "model", "?") for e in errors)
+        return f"{errors[0]} Резервные модели тоже недоступны ({tried})."
@@ -1,14 +1,24 @@
 import os
 import re
 import json
+import time
 import pickle
 import hashlib
+import contextlib
+import threading
+import contextvars
 from collections import Counter, defaultdict
 import numpy as np
-import requests
-from langchain_ollama import ChatOllama
 from langchain_core.prompts import ChatPromptTemplate
-from config import SUPPORTED_FORMATS, get_llm_settings
+from config import SUPPORTED_FORMATS, get_llm_settings, get_debug_settings, get_retrieval_settings
+from tracing import QueryTrace
+from retrieval_trace import get_retrieval_trace_writer
+from llm_clients import OpenRouterLLM, get_chat_llm, get_generate_llm, ollama_available  # OpenRouterLLM — реэкспорт
+from ollama_generate import build_prompt, history_block, OllamaGenerateLLM
+from conversation import DEFAULT_HISTORY_TOKENS
+from scheduler import get_scheduler, Priority
+from text_store import load_text
+from context_builder import build_context, get_token_counter, warm_token_counter, DEFAULT_CONTEXT_TOKENS
 from typing import Optional
 
 
@@ -100,14 +110,6 @@ def get_folder_hash(folder_path):
     return hash_md5.hexdigest()
 
 
-def _ollama_available():
-    try:
-        resp = requests.get("http://127.0.0.1:11434/api/tags", timeout=2)
-        return resp.status_code == 200
-    except Exception:
-        return False
-
-
 def clear_summary_cache(folder_path: str, file_filter: str = None) -> bool:
     """Удалить кэш суммаризации. Если file_filter — только кэш конкретного файла."""
     try:
@@ -163,23 +165,9 @@ def summarize_all_in_one(vectorstore, model_name, use_gpu=True, folder_path=None
             with open(cache_file, "rb") as f:
                 return pickle.load(f)
 
-    if not _ollama_available():
+    llm = get_chat_llm("ollama", model_name, use_gpu)
+    if llm is None:
         return "Локальный сервер моделей (Ollama) недоступен. Запустите 'ollama serve' или переключитесь на облачную модель в настройках."
-    try:
-        try:
-            llm = ChatOllama(model=model_name,
-                             num_gpu=-1 if use_gpu else 0,
-                             temperature=0.1,
-                             base_url="http://127.0.0.1:11434",
-                             keep_alive="5m",
-                             timeout=60)
-        except TypeError:
-            llm = ChatOllama(model=model_name,
-                             num_gpu=-1 if use_gpu else 0,
-                             temperature=0.1,
-                             base_url="http://127.0.0.1:11434")
-    except Exception as e:
-        return f"Ошибка инициализации модели: {e}"
     seen = set()
     previews = []
     for doc in vectorstore.docstore._dict.values():
@@ -212,7 +200,9 @@ def summarize_all_in_one(vectorstore, model_name, use_gpu=True, folder_path=None
     )
 
     try:
-        response = llm.invoke(prompt.format(context=context))
+        # Сводка уступает очередь вопросам пользователя, но идёт раньше подсказок
+        with get_scheduler().slot("llm", Priority.SUMMARY):
+            response = llm.invoke(prompt.format(context=context))
         result = response.content.strip()
         if folder_path:
             try:
@@ -227,11 +217,16 @@ def summarize_all_in_one(vectorstore, model_name, use_gpu=True, folder_path=None
         return f"Ошибка суммирования: {e}"
 
 
-def generate_suggested_questions(vectorstore, model_name, use_gpu=True, folder_path=None, max_q=5):
+# Сколько раз подсказки перезапускаются после вытеснения вопросом пользователя
+_SUGGESTION_ATTEMPTS = 3
+
+
+def generate_suggested_questions(vectorstore, model_name, use_gpu=True, folder_path=None, max_q=5, sources=None):
     """Генерирует 3-6 рекомендуемых вопросов по набору файлов в папке.
+    sources — только эти файлы (запуск по одному файлу поверх индекса папки).
     Возвращает список строк (вопросов) на русском.
     """
-    if not _ollama_available():
+    if not ollama_available():
         return []
 
     # Собираем превью каждого файла (первые 300 символов)
@@ -239,7 +234,7 @@ def generate_suggested_questions(vectorstore, model_name, use_gpu=True, folder_p
     previews = []
     for doc in vectorstore.docstore._dict.values():
         source = doc.metadata.get("source")
-        if not source or source in seen:
+        if not source or source in seen or (sources and source not in sources):
             continue
         seen.add(source)
         name = os.path.basename(source)
@@ -248,20 +243,8 @@ def generate_suggested_questions(vectorstore, model_name, use_gpu=True, folder_p
 
     context = "\n".join(previews)[:4000]
 
-    try:
-        try:
-            llm = ChatOllama(model=model_name,
-                             num_gpu=-1 if use_gpu else 0,
-                             temperature=0.2,
-                             base_url="http://127.0.0.1:11434",
-                             keep_alive="2m",
-                             timeout=30)
-        except TypeError:
-            llm = ChatOllama(model=model_name,
-                             num_gpu=-1 if use_gpu else 0,
-                             temperature=0.2,
-                             base_url="http://127.0.0.1:11434")
-    except Exception:
+    llm = get_chat_llm("ollama", model_name, use_gpu, temperature=0.2)
+    if llm is None:
         return []
 
     prompt = ChatPromptTemplate.from_template(
@@ -275,9 +258,29 @@ def generate_suggested_questions(vectorstore, model_name, use_gpu=True, folder_p
 Ответ:"""
     )
 
+    scheduler = get_scheduler()
     try:
-        response = llm.invoke(prompt.format(context=context, max_q=max_q))
-        text = response.content.strip()
+        text = None
+        with scheduler.task(Priority.SUGGESTIONS):
+            for _attempt in range(_SUGGESTION_ATTEMPTS):
+                # Пока пользователь ждёт ответа, подсказки не начинаются
+                scheduler.checkpoint()
+                with scheduler.slot("llm") as slot:
+                    parts = []
+                    for chunk in llm.stream(prompt.format(context=context, max_q=max_q)):
+                        if slot.preempted.is_set():
+                            # Пришёл вопрос — бросаем генерацию (Ollama прервёт её
+                            # при закрытии соединения) и повторим после ответа
+                            parts = None
+                            break
+                        parts.append(chunk.content)
+                if parts is not None:
+                    text = "".join(parts).strip()
+                    break
+                import logging as _log
+                _log.info("[SCHED] Генерация подсказок уступила вопросу пользователя, повтор позже")
+        if text is None:
+            return []
         # Разбиваем по строкам и фильтруем
         lines = [l.strip() for l in text.splitlines() if l.strip()]
         # Обрезаем до max_q
@@ -324,12 +327,10 @@ def select_best_file(docs, query):
 
 
 # === ФОРМАТИРОВАНИЕ КОНТЕКСТА ===
-def format_context_with_sources(docs, query):
-    chunks = []
-    for doc in docs:
-        source = os.path.basename(doc.metadata.get("source", "Неизвестный"))
-        chunks.append(f"[Источник: {source}]\n{doc.page_content}\n")
-    return "\n\n".join(chunks) if chunks else "Нет релевантного контекста"
+def format_context_with_sources(docs, query, budget_tokens=DEFAULT_CONTEXT_TOKENS, model_name=""):
+    """Контекст из чанков в бюджет токенов (см. context_builder.build_context)."""
+    context, _ = build_context(docs, budget_tokens=budget_tokens, model_name=model_name)
+    return context
 
 
 # === НОВАЯ ФУНКЦИЯ: ВЫВОД ВСЕГО ТЕКСТА ИЗ ФАЙЛА ===
@@ -350,28 +351,6 @@ def print_full_file_text(vectorstore, file_path):
     print("=" * 80 + "\n")
 
 
-def _write_debug_chunks(query: str, docs: list) -> None:
-    """Записывает последние обработанные чанки в ПОСЛЕДНИЕ_ЧАНКИ.txt рядом с rag.py."""
-    from datetime import datetime
-    save_dir = os.path.dirname(os.path.abspath(__file__))
-    debug_file = os.path.join(save_dir, "ПОСЛЕДНИЕ_ЧАНКИ.txt")
-    try:
-        with open(debug_file, "w", encoding="utf-8") as f:
-            f.write(f"Время: {datetime.now():%Y-%m-%d %H:%M:%S}\n")
-            f.write(f"Вопрос: {query}\n")
-            f.write("=" * 100 + "\n\n")
-            for i, doc in enumerate(docs, 1):
-                filename = os.path.basename(doc.metadata.get("source", "неизвестно"))
-                f.write(f"ЧАНК {i}  ←  {filename}\n")
-                f.write("\u2014" * 80 + "\n")
-                f.write(doc.page_content.strip())
-                f.write("\n\n" + "\u2550" * 80 + "\n\n")
-            f.write(f"Всего чанков: {len(docs)}\n")
-        print(f"Чанки сохранены: {debug_file}")
-    except Exception as e:
-        print(f"Не удалось записать чанки: {e}")
-
-
 def _docs_to_highlights(docs: list, top_k: int = 3, base_score: float = 0.5) -> list[dict]:
     """
     Конвертирует список документов в highlight-диапазоны.
@@ -392,20 +371,8 @@ def _docs_to_highlights(docs: list, top_k: int = 3, base_score: float = 0.5) ->
         # Если позиции нулевые или некорректные — ищем текст в файле
         if end <= start:
             try:
-                ext = os.path.splitext(src)[1].lower().lstrip(".")
-                if ext in ("txt", "md"):
-                    with open(src, "r", encoding="utf-8", errors="replace") as f:
-                        file_text = f.read()
-                elif ext == "pdf":
-                    import PyPDF2
-                    with open(src, "rb") as f:
-                        reader = PyPDF2.PdfReader(f)
-                        file_text = "".join(p.extract_text() or "" for p in reader.pages)
-                elif ext == "docx":
-                    from docx import Document as _D
-                    file_text = "\n".join(p.text for p in _D(src).paragraphs)
-                else:
-                    file_text = doc.page_content
+                # Текст, извлечённый при индексации (text_store), — без повторного разбора файла
+                file_text = load_text(src) or doc.page_content
                 anchor = doc.page_content.strip()[:120]
                 pos = file_text.find(anchor)
                 if pos != -1:
@@ -423,39 +390,28 @@ def _docs_to_highlights(docs: list, top_k: int = 3, base_score: float = 0.5) ->
             "source": src,
             "start_char": start,
             "end_char": end,
+            "page": doc.metadata.get("page"),
             "text": doc.page_content,
             "relevance_score": base_score,
         })
     return results
 
 
-def _rerank_highlight(query: str, docs: list, top_k: int = 3) -> list[dict]:
+def _ranked_highlights(query: str, docs: list, top_k: int = 3) -> Optional[list]:
     """
     Скорирует каждый чанк reranker-моделью по паре (вопрос, чанк).
-    Возвращает top_k чанков с наибольшим score в виде highlight-диапазонов.
-    При любой ошибке reranker — возвращает все входные чанки как есть (не пустой список).
+    Возвращает top_k чанков с наибольшим score в виде highlight-диапазонов;
+    None — reranker не готов, недоступен или упал.
     """
-    if not docs:
-        return []
-
+    # Батч-скоринг; чанки, уже оценённые для этого вопроса, берутся из кеша scores.
+    # Модель здесь не грузится: пока она не прогрета в фоне, подсветка — без ранжирования
     try:
-        from reranker import _get_reranker
-        reranker = _get_reranker()
+        from reranker import score_pairs
+        scores = score_pairs(query, [doc.page_content for doc in docs], wait_for_model=False)
     except Exception:
-        reranker = None
-
-    if reranker is None:
-        return _docs_to_highlights(docs, top_k)
-
-    # Батч-скоринг
-    pairs = [(query, doc.page_content) for doc in docs]
-    try:
-        import numpy as _np
-        raw_scores = reranker.predict(pairs)
-        scores = [float(s) for s in _np.atleast_1d(raw_scores).flatten()]
-    except Exception:
-        # Reranker упал — возвращаем все чанки без ранжирования
-        return _docs_to_highlights(docs, top_k)
+        scores = None
+    if scores is None:
+        return None
 
     # Берём top_k по score
     ranked = sorted(zip(scores, docs), key=lambda x: x[0], reverse=True)
@@ -463,143 +419,153 @@ def _rerank_highlight(query: str, docs: list, top_k: int = 3) -> list[dict]:
     return _docs_to_highlights(top_docs, top_k, base_score=0.0)
 
 
+def _rerank_candidates(query: str, docs: list, budget_ms: float) -> tuple:
+    """
+    Второй этап поиска: (docs в порядке cross-encoder'а, сколько оценено).
+    Оценённые идут первыми по убыванию score, не успевшие в бюджет — следом
+    в исходном порядке MMR. Модель не готова — (docs, 0) без изменений.
+    """
+    try:
+        from reranker import score_within_budget
+        scores = score_within_budget(query, [doc.page_content for doc in docs], budget_ms)
+    except Exception:
+        scores = None
+    if not scores:
+        return docs, 0
+    scored = sorted((i for i, sc in enumerate(scores) if sc is not None), key=lambda i: -scores[i])
+    rest = [i for i, sc in enumerate(scores) if sc is None]
+    return [docs[i] for i in scored + rest], len(scored)
+
 
-# Максимальная длина промпта в символах — обрезаем чтобы не получить 400
-_OPENROUTER_MAX_PROMPT_CHARS = 12_000
+# Подсветка зависит только от вопроса и найденных чанков, поэтому считается
+# параллельно с генерацией ответа, а не после неё
+_highlight_executor = None
+_highlight_executor_lock = threading.Lock()
 
 
-class OpenRouterLLM:
-    """
-    Враппер для OpenRouter API с автоматическим retry и fallback на другие модели.
+def _get_highlight_executor():
+    global _highlight_executor
+    if _highlight_executor is None:
+        with _highlight_executor_lock:
+            if _highlight_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _highlight_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="highlight")
+    return _highlight_executor
+
+
+def _highlight_job(query: str, docs: list) -> tuple:
+    """(чанки подсветки в порядке файла, ranked) — ranked=False, если reranker не ответил."""
+    ranked = _ranked_highlights(query, docs) if docs else []
+    # Reranker ещё не готов, недоступен или упал — чанки без ранжирования
+    chunks = ranked if ranked is not None else _docs_to_highlights(docs)
+    # Сортируем по позиции в файле для последовательной подсветки
+    chunks.sort(key=lambda x: (x.get("source", ""), x.get("start_char", 0)))
+    return chunks, ranked is not None
 
-    При 429 (rate limit) или 400 (контекст слишком длинный) автоматически
-    пробует следующую модель из OPENROUTER_FREE_MODELS.
-    Использует requests напрямую — без langchain-openai.
+
+def start_highlights(query: str, docs: list):
+    """
+    Запускает подсветку в фоне и возвращает Future с результатом _highlight_job.
+    Контекст (приоритет планировщика) копируется в поток пула.
     """
+    ctx = contextvars.copy_context()
+    return _get_highlight_executor().submit(ctx.run, _highlight_job, query, list(docs))
 
-    def __init__(self, api_key: str, model: str, temperature: float = 0.1):
-        self.api_key = api_key
-        self.model = model
-        self.temperature = temperature
 
-    class _Response:
-        def __init__(self, text: str):
-            self.content = text
+def highlights_event(future) -> Optional[dict]:
+    """Раннее событие стрима {"highlights": [...], "final": False}, если подсветка готова."""
+    if future is None or not future.done():
+        return None
+    try:
+        chunks, _ranked = future.result()
+    except Exception:
+        return None
+    return {"highlights": chunks, "final": False} if chunks else None
 
-    def _prompt_to_text(self, prompt) -> str:
-        if hasattr(prompt, "to_string"):
-            text = prompt.to_string()
-        elif hasattr(prompt, "text"):
-            text = prompt.text
-        else:
-            text = str(prompt)
-        # Обрезаем слишком длинный промпт
-        if len(text) > _OPENROUTER_MAX_PROMPT_CHARS:
-            text = text[:_OPENROUTER_MAX_PROMPT_CHARS] + "\n...[контекст обрезан]"
-        return text
-
-    def _call_model(self, model: str, text: str):
-        import requests as _req
-        payload = {
-            "model": model,
-            "messages": [{"role": "user", "content": text}],
-            "temperature": self.temperature,
-        }
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://github.com/W1TAS/rag_local_fs",
-            "X-Title": "RAG Local FS",
-        }
-        resp = _req.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=60,
-        )
-        return resp
-
-    def invoke(self, prompt) -> "_Response":
-        import logging as _log
-
-        text = self._prompt_to_text(prompt)
-        _log.info(f"[OPENROUTER] Запрос к модели: {self.model}")
-
-        resp = self._call_model(self.model, text)
-
-        if resp.status_code == 200:
-            data = resp.json()
-            answer = data["choices"][0]["message"]["content"]
-            _log.info(f"[OPENROUTER] Ответ получен от: {self.model}")
-            result = self._Response(answer)
-            result.model_used = self.model
-            return result
-
-        # Человекочитаемые сообщения об ошибках
-        code = resp.status_code
-        try:
-            err = resp.json().get("error", {})
-            msg = err.get("message", resp.text[:200])
-        except Exception:
-            msg = resp.text[:200]
-
-        if code == 429:
-            raise RuntimeError(f"Модель {self.model} перегружена (rate limit). Попробуйте позже или выберите другую модель в настройках.")
-        elif code == 400:
-            raise RuntimeError(f"Модель {self.model} не приняла запрос (возможно слишком длинный контекст). Выберите другую модель.")
-        elif code == 401:
-            raise RuntimeError("Неверный API ключ OpenRouter. Проверьте ключ в настройках.")
-        elif code == 404:
-            raise RuntimeError(f"Модель {self.model} не найдена на OpenRouter. Выберите другую модель в настройках.")
-        else:
-            raise RuntimeError(f"Ошибка OpenRouter {code}: {msg}")
 
 
+# Сколько финальный payload стрима ждёт подсветку reranker'а, прежде чем
+# перейти на эвристику по словам ответа
+_HIGHLIGHT_WAIT_S = 2.0
 
-def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embeddinggemma:latest", folder_path=None,
-                  llm_provider="ollama", openrouter_api_key="", openrouter_model=""):
-    global llm
-    llm = None
+# Неизменная часть промпта ответа — идёт первой, чтобы попадать в кеш префикса Ollama
+_QA_PREAMBLE = "Отвечай на русском языке строго на основе предоставленного контекста."
 
+
+def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embeddinggemma:latest", folder_path=None,
+                  llm_provider="ollama", openrouter_api_key="", openrouter_model="",
+                  openrouter_fallback=True, openrouter_hedge_ms=0, context_tokens=DEFAULT_CONTEXT_TOKENS,
+                  ollama_prefix_reuse=True):
+    import logging as _log
+    # Клиент берётся из общего реестра на каждый вопрос (это поиск в словаре):
+    # пересборка цепочки не пересоздаёт соединения, а если Ollama поднялся
+    # после сборки цепочки — следующий вопрос уже получит клиент.
     if llm_provider == "openrouter" and openrouter_api_key:
-        import logging as _log
         _log.info(f"[RAG] Инициализация OpenRouter, модель: {openrouter_model}")
-        llm = OpenRouterLLM(
-            api_key=openrouter_api_key,
-            model=openrouter_model or "openrouter/elephant-alpha",
-        )
+        token_model = openrouter_model
+
+        hedge_after_s = openrouter_hedge_ms / 1000 if openrouter_hedge_ms else None
+
+        def _get_llm():
+            return get_chat_llm("openrouter", openrouter_model, api_key=openrouter_api_key,
+                                fallback=openrouter_fallback, hedge_after_s=hedge_after_s)
     else:
-        import logging as _log
         _log.info(f"[RAG] Инициализация Ollama, модель: {model_name}")
-        ollama_ok = _ollama_available()
-        if ollama_ok:
-            try:
-                try:
-                    llm = ChatOllama(model=model_name,
-                                     num_gpu=-1 if use_gpu else 0,
-                                     temperature=0.1,
-                                     base_url="http://127.0.0.1:11434",
-                                     keep_alive="5m",
-                                     timeout=60)
-                except TypeError:
-                    llm = ChatOllama(model=model_name,
-                                     num_gpu=-1 if use_gpu else 0,
-                                     temperature=0.1,
-                                     base_url="http://127.0.0.1:11434")
-            except Exception as e:
-                llm = None
+        token_model = model_name
+
+        # Вопросы идут через /api/generate: повторные вопросы по той же области
+        # не пересчитывают префилл контекста (см. ollama_generate.py)
+        def _get_llm():
+            return get_generate_llm(model_name, use_gpu, prefix_reuse=ollama_prefix_reuse)
+
+    # Токенизатор грузится в фоне, пока пользователь формулирует вопрос
+    warm_token_counter(token_model)
+
+    # Лимит слотов "llm" — про локальный Ollama; OpenRouter ограничивает себя сам
+    local_llm = not (llm_provider == "openrouter" and openrouter_api_key)
 
+    def _llm_slot():
+        return get_scheduler().slot("llm") if local_llm else contextlib.nullcontext()
+
+    # Раскладка: инструкция → контекст → история диалога → вопрос (вопрос всегда последним)
     prompt = ChatPromptTemplate.from_template(
-        """Отвечай на русском языке строго на основе предоставленного контекста.
+        _QA_PREAMBLE + """
 
 Контекст:
 {context}
 
-Вопрос: {input}
+{history}Вопрос: {input}
 
 Ответ:"""
     )
 
+    # Отладочная запись найденных чанков — только если включена в настройках;
+    # иначе writer не создаётся и путь ответа ничего не пишет на диск
+    trace_writer = None
+    if folder_path and get_debug_settings()["retrieval_traces"]:
+        try:
+            trace_writer = get_retrieval_trace_writer(folder_path)
+        except Exception as e:
+            import logging as _log
+            _log.warning(f"[RAG] Retrieval-trace недоступен: {e}")
+
+    # Второй этап поиска (cross-encoder по кандидатам MMR). Профиль "auto"
+    # разрешается при первом вопросе: для него нужен torch, а сборка цепочки его не грузит
+    retrieval = get_retrieval_settings()
+
+    def _rerank_params() -> Optional[dict]:
+        if not retrieval["rerank"]:
+            return None
+        if not retrieval.get("resolved"):
+            try:
+                from reranker import hardware_profile
+                hardware = hardware_profile()
+            except Exception:
+                hardware = "cpu"
+            retrieval.update(get_retrieval_settings(hardware), resolved=True)
+            _log.info(f"[RAG] Переранжирование кандидатов: профиль {retrieval['profile']}, "
+                      f"{retrieval['candidates']} → {retrieval['top_k']} за {retrieval['budget_ms']} мс")
+        return retrieval
 
         # Паттерны запросов о содержании конкретного файла
     _FILE_SUMMARY_PATTERNS = [
@@ -607,13 +573,38 @@ def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embedd
         "про что", "расскажи про", "опиши", "что такое", "что это"
     ]
 
-    def wrapped_qa_chain(query, file_filter=None):
+    def wrapped_qa_chain(query, file_filter=None, query_embedding=None, trace=None, conversation=None,
+                         defer_llm=False):
+        """
+        query_embedding — заранее посчитанный вектор вопроса (батч-режим main.py):
+        если передан, retriever ищет по вектору и не эмбеддит вопрос повторно.
+        trace — QueryTrace вызывающего (AskRunnable); если не передан, цепочка
+        создаёт и завершает свой. В ответ добавляются "trace" (spans этапов)
+        и "timings" — плоская сводка длительностей в миллисекундах.
+        conversation — Conversation чата (conversation.py): уточняющий вопрос
+        переписывается для поиска, чанки прошлого хода переиспользуются, а
+        сжатая история попадает в промпт.
+        defer_llm — не вызывать LLM в ветке вопроса, а вернуть {"deferred": True,
+        "llm", "prompt_text", ..., "finish"}: генерацию ведёт async_engine, а
+        finish(answer, model_used) собирает финальный payload. Ветки сводок
+        всегда отвечают как обычно.
+        """
         query_lower = query.lower().strip()
+        owns_trace = trace is None
+        if owns_trace:
+            trace = QueryTrace(query)
+
+        def _done(payload):
+            payload["timings"] = trace.timings()
+            payload["trace"] = trace.finish() if owns_trace else trace.to_dict()
+            return payload
 
         # --- Определяем конкретный файл из запроса ---
         inferred_file = None
         if not file_filter and folder_path:
-            inferred_file = _extract_file_from_query(query, folder_path)
+            with trace.span("extract_file_from_query") as attrs:
+                inferred_file = _extract_file_from_query(query, folder_path)
+                attrs["found"] = bool(inferred_file)
 
         effective_file = file_filter or inferred_file
 
@@ -624,97 +615,170 @@ def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embedd
             "что в этих файлах", "опиши содержимое", "о чём документы"
         ]
         if any(p in query_lower for p in general_patterns) and not effective_file:
-            summary = summarize_all_in_one(vectorstore, model_name, use_gpu, folder_path=folder_path)
-            return {
+            trace.attrs["branch"] = "summary_all"
+            with trace.span("summarize_all"):
+                summary = summarize_all_in_one(vectorstore, model_name, use_gpu, folder_path=folder_path)
+            return _done({
                 "result": summary,
                 "source_documents": [],
                 "sources": "все файлы",
                 "keywords": [],
-                "formatted_context": ""
-            }
+                "formatted_context": "",
+            })
 
         # === ВЕТКА 2: "о чём файл X" — суммаризация конкретного файла ===
         if effective_file and any(p in query_lower for p in _FILE_SUMMARY_PATTERNS):
+            trace.attrs["branch"] = "summary_file"
             # Собираем ВСЕ чанки конкретного файла из vectorstore для дебаг-файла
             eff_base = os.path.basename(effective_file).lower()
-            file_chunks = [
-                doc for doc in vectorstore.docstore._dict.values()
-                if os.path.basename(doc.metadata.get("source", "")).lower() == eff_base
-            ]
-            _write_debug_chunks(query, file_chunks)
-
-            summary = summarize_all_in_one(
-                vectorstore, model_name, use_gpu,
-                folder_path=folder_path, file_filter=effective_file
-            )
+            with trace.span("collect_file_chunks") as attrs:
+                file_chunks = [
+                    doc for doc in vectorstore.docstore._dict.values()
+                    if os.path.basename(doc.metadata.get("source", "")).lower() == eff_base
+                ]
+                attrs["chunks"] = len(file_chunks)
+            if trace_writer is not None:
+                trace_writer.submit(query, file_chunks, trace.trace_id, "summary_file")
+
+            with trace.span("summarize_file"):
+                summary = summarize_all_in_one(
+                    vectorstore, model_name, use_gpu,
+                    folder_path=folder_path, file_filter=effective_file
+                )
             fname = os.path.basename(effective_file)
-            return {
+            return _done({
                 "result": summary,
                 "source_documents": file_chunks[:5],
                 "sources": fname,
                 "keywords": [],
-                "formatted_context": summary[:500]
-            }
+                "formatted_context": summary[:500],
+            })
 
         # === ВЕТКА 3: обычный вопрос — MMR retriever ===
         # MMR (Max Marginal Relevance) выбирает релевантные И разнообразные чанки,
         # не 5 похожих кусков из одного места, а из разных частей документов.
-        k = 8  # берём больше чанков
-        fetch_k = min(30, k * 4)  # кандидатов для MMR-фильтрации
+        trace.attrs["branch"] = "question"
+
+        # === Диалог: уточнение переписываем для поиска, чанки прошлого хода берём повторно ===
+        search_query = query
+        reused = None
+        if conversation is not None:
+            reused = conversation.reusable_docs(query, effective_file, extract_keywords_from_query)
+            search_query = conversation.rewrite_query(query, extract_keywords_from_query)
+            if search_query != query:
+                trace.attrs["search_query"] = search_query
+
+        if reused is not None:
+            raw_docs, final_docs, best_file, effective_file = reused
+            trace.add_span("conversation_reuse", time.perf_counter(), docs=len(final_docs))
+        else:
+            base_k = k = 8  # берём больше чанков
+            fetch_k = min(30, k * 4)  # кандидатов для MMR-фильтрации
+            rerank = _rerank_params()
+            if rerank is not None:
+                # Кандидатов набираем с запасом — порядок и отбор решит cross-encoder
+                k = max(k, rerank["candidates"])
+                fetch_k = max(fetch_k, k * 2)
+
+            # Эмбеддинг вопроса считаем явно, чтобы отделить его время от MMR
+            query_vector = query_embedding if search_query == query else None
+            if query_vector is None:
+                with trace.span("embed_query"):
+                    try:
+                        with get_scheduler().slot("embedder"):
+                            query_vector = vectorstore.embeddings.embed_query(search_query)
+                    except Exception:
+                        query_vector = None
 
-        try:
-            if effective_file:
-                # Фильтр по полному пути (как хранится в метаданных FAISS)
-                raw_docs = vectorstore.max_marginal_relevance_search(
-                    query, k=k, fetch_k=fetch_k,
-                    filter={"source": effective_file}
-                )
-                # Если по полному пути ничего нет — попробуем без фильтра и отфильтруем вручную
-                if not raw_docs:
-                    all_docs = vectorstore.max_marginal_relevance_search(query, k=20, fetch_k=60)
-                    eff_base = os.path.basename(effective_file).lower()
-                    raw_docs = [
-                                   d for d in all_docs
-                                   if os.path.basename(d.metadata.get("source", "")).lower() == eff_base
-                               ][:k]
-            else:
-                raw_docs = vectorstore.max_marginal_relevance_search(query, k=k, fetch_k=fetch_k)
-        except Exception:
-            # Fallback: обычный similarity search
-            search_kwargs = {"k": k}
-            if effective_file:
-                search_kwargs["filter"] = {"source": effective_file}
-            retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
-            raw_docs = retriever.invoke(query)
+            def _mmr(k, fetch_k, filter=None):
+                if query_vector is not None:
+                    return vectorstore.max_marginal_relevance_search_by_vector(
+                        query_vector, k=k, fetch_k=fetch_k, filter=filter
+                    )
+                return vectorstore.max_marginal_relevance_search(search_query, k=k, fetch_k=fetch_k, filter=filter)
 
-        if not raw_docs:
-            return {
-                "result": "Информация отсутствует в доступных документах",
-                "source_documents": [],
-                "sources": "Нет источников",
-                "keywords": extract_keywords_from_query(query, top_n=7),
-                "formatted_context": ""
-            }
-
-        # === Выбор файла-источника ===
-        if effective_file:
-            # Уже знаем файл — используем все найденные чанки
-            final_docs = raw_docs
-            best_file = os.path.basename(effective_file)
-        else:
-            # Keyword reranking для выбора наиболее релевантного файла
-            best_file = select_best_file(raw_docs, query)
-            final_docs = [
-                doc for doc in raw_docs
-                if os.path.basename(doc.metadata.get("source", "")) == best_file
-            ]
-            # Если после фильтрации ничего нет — берём всё
-            if not final_docs:
+            t0 = time.perf_counter()
+            try:
+                if effective_file:
+                    # Фильтр по полному пути (как хранится в метаданных FAISS)
+                    raw_docs = _mmr(k, fetch_k, filter={"source": effective_file})
+                    # Если по полному пути ничего нет — попробуем без фильтра и отфильтруем вручную
+                    if not raw_docs:
+                        all_docs = _mmr(20, 60)
+                        eff_base = os.path.basename(effective_file).lower()
+                        raw_docs = [
+                                       d for d in all_docs
+                                       if os.path.basename(d.metadata.get("source", "")).lower() == eff_base
+                                   ][:k]
+                else:
+                    raw_docs = _mmr(k, fetch_k)
+            except Exception:
+                # Fallback: обычный similarity search
+                search_kwargs = {"k": k}
+                if effective_file:
+                    search_kwargs["filter"] = {"source": effective_file}
+                retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
+                raw_docs = retriever.invoke(search_query)
+            trace.add_span("mmr", t0, k=k, fetch_k=fetch_k, found=len(raw_docs))
+
+            if not raw_docs:
+                return _done({
+                    "result": "Информация отсутствует в доступных документах",
+                    "source_documents": [],
+                    "sources": "Нет источников",
+                    "keywords": extract_keywords_from_query(query, top_n=7),
+                    "formatted_context": "",
+                })
+
+            scored = 0
+            if rerank is not None and len(raw_docs) > 1:
+                with trace.span("rerank_candidates", candidates=len(raw_docs),
+                                budget_ms=rerank["budget_ms"]) as attrs:
+                    raw_docs, scored = _rerank_candidates(search_query, raw_docs, rerank["budget_ms"])
+                    attrs["scored"] = scored
+
+            # === Выбор файла-источника ===
+            if effective_file:
+                # Уже знаем файл — используем все найденные чанки
                 final_docs = raw_docs
-
-        context = format_context_with_sources(final_docs, query)
+                best_file = os.path.basename(effective_file)
+            else:
+                if scored:
+                    # Файл лучшего по cross-encoder'у кандидата
+                    best_file = os.path.basename(raw_docs[0].metadata.get("source", ""))
+                else:
+                    # Keyword reranking для выбора наиболее релевантного файла
+                    with trace.span("select_best_file"):
+                        best_file = select_best_file(raw_docs, search_query)
+                final_docs = [
+                    doc for doc in raw_docs
+                    if os.path.basename(doc.metadata.get("source", "")) == best_file
+                ]
+                # Если после фильтрации ничего нет — берём всё
+                if not final_docs:
+                    final_docs = raw_docs
+            if rerank is not None:
+                # В LLM — только лучшие; без оценок (модель не готова) — прежние k из MMR
+                final_docs = final_docs[:rerank["top_k"] if scored else base_k]
+
+        # История диалога — в пределах своего бюджета, который вычитается из бюджета контекста
+        history = ""
+        history_tokens = 0
+        if conversation is not None:
+            with trace.span("conversation_history") as attrs:
+                history, history_tokens = conversation.history_text(
+                    get_token_counter(token_model), min(DEFAULT_HISTORY_TOKENS, context_tokens // 3)
+                )
+                attrs["tokens"] = history_tokens
+                attrs["turns"] = len(conversation.turns)
+
+        with trace.span("format_context", docs=len(final_docs)) as attrs:
+            context, ctx_stats = build_context(final_docs, budget_tokens=context_tokens - history_tokens,
+                                               model_name=token_model)
+            attrs.update(ctx_stats)
+        llm = _get_llm()
         if llm is None:
-            return {
+            return _done({
                 "result": (
                     "Локальный сервер моделей (Ollama) недоступен или модель не инициализирована. "
                     "Запустите Ollama (ollama serve) и выполните 'ollama pull' для модели: "
@@ -723,18 +787,145 @@ def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embedd
                 "source_documents": [],
                 "sources": "Нет источников",
                 "keywords": extract_keywords_from_query(query, top_n=7),
-                "formatted_context": ""
-            }
+                "formatted_context": "",
+            })
+        # Подсветка считается, пока модель генерирует ответ
+        hl_future = start_highlights(query, final_docs)
+
         try:
-            prompt_text = prompt.format(context=context, input=query)
+            scoped = isinstance(llm, OllamaGenerateLLM)
+            if scoped:
+                prompt_text = build_prompt(_QA_PREAMBLE, context, query, history)
+            else:
+                prompt_text = prompt.format(context=context, history=history_block(history), input=query)
             # detect streaming capability on the LLM object
             stream_fn = next(
                 (n for n in ("stream", "stream_invoke", "invoke_stream", "stream_chat", "stream_invoke_chat") if hasattr(llm, n)),
                 None,
             )
 
+            def _finish_streamed(answer, stream_model=None):
+                """
+                Финальный payload стримингового ответа. Подсветка — результат reranker'а,
+                запущенного вместе с генерацией; если он не ответил — по пересечению слов с ответом.
+                """
+                if conversation is not None:
+                    conversation.remember(search_query, effective_file, best_file, raw_docs, final_docs)
+
+                # Post-process highlight_chunks same as non-streaming branch
+                sources = {best_file} if best_file else set()
+                if trace_writer is not None:
+                    trace_writer.submit(query, raw_docs, trace.trace_id, "question")
+
+                t_hl = time.perf_counter()
+
+                highlight_chunks = []
+                _no_answer_markers = [
+                    "информация отсутствует", "нет информации", "нет данных",
+                    "не содержит", "не найдено", "не упоминается", "отсутствует в",
+                    "не могу ответить", "не нашёл", "не нашел", "нет ответа",
+                    "не указано", "контекст не содержит",
+                ]
+                answer_lower = answer.lower()
+                answer_has_info = not any(m in answer_lower for m in _no_answer_markers)
+
+                ranked_chunks = None
+                if answer_has_info and final_docs:
+                    try:
+                        chunks, ranked = hl_future.result(timeout=_HIGHLIGHT_WAIT_S)
+                        if ranked:
+                            ranked_chunks = chunks
+                    except Exception:
+                        pass
+
+                if ranked_chunks is not None:
+                    highlight_chunks = ranked_chunks
+                elif answer_has_info and final_docs:
+                    answer_words = set(re.findall(r'\w{4,}', answer_lower))
+                    answer_words -= RUSSIAN_STOP_WORDS
+
+                    for doc in final_docs:
+                        src = doc.metadata.get("source", "")
+                        if not src:
+                            continue
+                        chunk_words = set(re.findall(r'\w{4,}', doc.page_content.lower()))
+                        chunk_words -= RUSSIAN_STOP_WORDS
+                        if not chunk_words:
+                            continue
+                        overlap = chunk_words & answer_words
+                        score = len(overlap) / len(chunk_words)
+                        if score >= 0.06:
+                            highlight_chunks.append({
+                                "source": src,
+                                "start_char": doc.metadata.get("start_char"),
+                                "end_char": doc.metadata.get("end_char"),
+                                "start_line": doc.metadata.get("start_line"),
+                                "page": doc.metadata.get("page"),
+                                "chunk_index": doc.metadata.get("chunk_index"),
+                                "text": doc.page_content,
+                                "relevance_score": score,
+                            })
+
+                    highlight_chunks.sort(key=lambda x: -x["relevance_score"])
+                trace.add_span("highlight_final", t_hl, chunks=len(highlight_chunks),
+                               reranked=ranked_chunks is not None)
+
+                model_used = openrouter_model if llm_provider == "openrouter" else model_name
+                if llm_provider == "openrouter" and stream_model:
+                    model_used = stream_model
+
+                return _done({
+                    "result": answer,
+                    "source_documents": final_docs,
+                    "sources": ", ".join(sources),
+                    "keywords": extract_keywords_from_query(query, top_n=7),
+                    "formatted_context": context[:500] + "..." if len(context) > 500 else context,
+                    "highlight_chunks": highlight_chunks,
+                    "model_used": model_used,
+                    "llm_provider": llm_provider,
+                    "final": True,
+                })
+
+            # Область — папка + файл ответа: последующие вопросы по тому же файлу
+            # с теми же фрагментами продолжают сохранённый context. Каждый чат —
+            # своя область: в сохранённом context есть его прошлые реплики.
+            # Без диалога (batch, бенчмарки) вопросы независимы — переиспользования нет
+            scope = None
+            if conversation is not None:
+                scope = OllamaGenerateLLM.scope_key(folder_path or "", effective_file or best_file or "",
+                                                    conversation.id)
+
+            if defer_llm:
+                # Генерацию ведёт вызывающий (async_engine): отдаём запрос и финализатор
+                return {
+                    "deferred": True,
+                    "llm": llm,
+                    "prompt_text": prompt_text,
+                    "scope": scope,
+                    "preamble": _QA_PREAMBLE,
+                    "context": context,
+                    "history": history,
+                    "question": query,
+                    "finish": _finish_streamed,
+                    "highlights": hl_future,
+                }
+
             if stream_fn:
-                gen = getattr(llm, stream_fn)(prompt_text)
+                t_llm = time.perf_counter()
+                llm_stats = {}
+                if scoped:
+                    gen = llm.stream_scoped(scope, _QA_PREAMBLE, context, query, stats=llm_stats, history=history)
+                else:
+                    gen = getattr(llm, stream_fn)(prompt_text)
+
+                def _in_llm_slot(stream):
+                    # Слот LLM занимается при первом чтении стрима и держится до его конца
+                    with _llm_slot() as slot:
+                        if slot is not None:
+                            llm_stats["queue_ms"] = round(slot.wait_ms, 1)
+                        yield from stream
+
+                gen = _in_llm_slot(gen)
 
                 def _stream_generator():
                     """Streaming generator that yields only the delta (new text) on each chunk.
@@ -743,8 +934,20 @@ def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embedd
                     """
                     cum = ""
                     last_text_chunk = ""
+                    first_token_seen = False
+                    stream_model = None
+                    stream_error = None
+                    highlights_sent = False
                     try:
                         for chunk in gen:
+                            # Подсветка готова раньше ответа — отдаём её отдельным событием
+                            if not highlights_sent:
+                                event = highlights_event(hl_future)
+                                if event is not None:
+                                    highlights_sent = True
+                                    trace.add_span("highlights_early", t_llm, chunks=len(event["highlights"]))
+                                    yield event
+                            stream_model = getattr(chunk, "model_used", None) or stream_model
                             # chunk may be object with textual attributes or plain string
                             text_chunk = None
                             # 1) plain string
@@ -800,96 +1003,67 @@ def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embedd
                             last_text_chunk = delta
 
                             cum += delta
+                            if not first_token_seen:
+                                first_token_seen = True
+                                trace.add_span("llm_first_token", t_llm)
                             yield {"delta": delta, "final": False}
 
-                    except Exception:
-                        # streaming failed — fall back to non-stream below
-                        pass
-
+                    except Exception as e:
+                        stream_error = e
+
+                    trace.add_span("llm_generate", t_llm, streamed=True, chars=len(cum), **llm_stats)
+                    if stream_error is not None and not cum:
+                        # Стрим упал до первого токена — пробуем обычный вызов
+                        try:
+                            with trace.span("llm_generate_fallback"), _llm_slot():
+                                answer_obj = llm.invoke(prompt_text)
+                            cum = answer_obj.content
+                            stream_model = getattr(answer_obj, "model_used", None) or stream_model
+                        except Exception as e:
+                            cum = f"Ошибка при запросе к модели: {e}"
                     answer = cum.strip()
 
-                    # Post-process highlight_chunks same as non-streaming branch
-                    sources = {best_file} if best_file else set()
-                    _write_debug_chunks(query, raw_docs)
-
-                    highlight_chunks = []
-                    _no_answer_markers = [
-                        "информация отсутствует", "нет информации", "нет данных",
-                        "не содержит", "не найдено", "не упоминается", "отсутствует в",
-                        "не могу ответить", "не нашёл", "не нашел", "нет ответа",
-                        "не указано", "контекст не содержит",
-                    ]
-                    answer_lower = answer.lower()
-                    answer_has_info = not any(m in answer_lower for m in _no_answer_markers)
-
-                    if answer_has_info and final_docs:
-                        answer_words = set(re.findall(r'\w{4,}', answer_lower))
-                        answer_words -= RUSSIAN_STOP_WORDS
-
-                        for doc in final_docs:
-                            src = doc.metadata.get("source", "")
-                            if not src:
-                                continue
-                            chunk_words = set(re.findall(r'\w{4,}', doc.page_content.lower()))
-                            chunk_words -= RUSSIAN_STOP_WORDS
-                            if not chunk_words:
-                                continue
-                            overlap = chunk_words & answer_words
-                            score = len(overlap) / len(chunk_words)
-                            if score >= 0.06:
-                                highlight_chunks.append({
-                                    "source": src,
-                                    "start_char": doc.metadata.get("start_char"),
-                                    "end_char": doc.metadata.get("end_char"),
-                                    "start_line": doc.metadata.get("start_line"),
-                                    "chunk_index": doc.metadata.get("chunk_index"),
-                                    "text": doc.page_content,
-                                    "relevance_score": score,
-                                })
-
-                        highlight_chunks.sort(key=lambda x: -x["relevance_score"])
-
-                    yield {
-                        "result": answer,
-                        "source_documents": final_docs,
-                        "sources": ", ".join(sources),
-                        "keywords": extract_keywords_from_query(query, top_n=7),
-                        "formatted_context": context[:500] + "..." if len(context) > 500 else context,
-                        "highlight_chunks": highlight_chunks,
-                        "final": True,
-                    }
+                    yield _finish_streamed(answer, stream_model)
 
                 return _stream_generator()
 
             # Fallback: synchronous invoke
-            answer_obj = llm.invoke(prompt.format(context=context, input=query))
-            answer = answer_obj.content.strip()
+            with trace.span("llm_generate", streamed=False), _llm_slot():
+                answer_obj = llm.invoke(prompt_text)
+                answer = answer_obj.content.strip()
         except Exception as e:
-            return {
+            return _done({
                 "result": f"Ошибка при запросе к модели: {e}",
                 "source_documents": [],
                 "sources": "Нет источников",
                 "keywords": extract_keywords_from_query(query, top_n=7),
                 "formatted_context": context[:500] + "..." if len(context) > 500 else context,
-            }
+            })
+
+        if conversation is not None:
+            conversation.remember(search_query, effective_file, best_file, raw_docs, final_docs)
 
         sources = {best_file} if best_file else set()
 
-        _write_debug_chunks(query, raw_docs)
+        if trace_writer is not None:
+            trace_writer.submit(query, raw_docs, trace.trace_id, "question")
 
         # Подсветка: reranker скорирует чанки по вопросу, возвращаем топ релевантных.
         # Подсвечиваем чанки целиком — честно и предсказуемо, без попыток угадать фразу.
-        highlight_chunks = _rerank_highlight(query, final_docs)
-
-        # Сортируем по позиции в файле для последовательной подсветки
-        highlight_chunks.sort(key=lambda x: (x.get("source", ""), x.get("start_char", 0)))
+        # Скоринг запущен до llm.invoke, здесь обычно только забираем готовый результат
+        with trace.span("rerank_highlight_wait", docs=len(final_docs)) as attrs:
+            try:
+                highlight_chunks, attrs["reranked"] = hl_future.result()
+            except Exception:
+                highlight_chunks = _docs_to_highlights(final_docs)
+            attrs["chunks"] = len(highlight_chunks)
 
         # Определяем какая модель реально ответила
         model_used = openrouter_model if llm_provider == "openrouter" else model_name
         if llm_provider == "openrouter" and hasattr(answer_obj, "model_used"):
             model_used = answer_obj.model_used
 
-        return {
+        return _done({
             "result": answer,
             "source_documents": final_docs,
             "sources": ", ".join(sources),
@@ -898,6 +1072,6 @@ def get_rag_chain(vectorstore, model_name, use_gpu=True, embedding_model="embedd
             "highlight_chunks": highlight_chunks,
             "model_used": model_used,
             "llm_provider": llm_provider,
-        }
+        })
 
     return wrapped_qa_chain
\ No newline at end of file
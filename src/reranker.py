@@ -12,18 +12,52 @@ reranker.py — sentence/paragraph-level reranker для точной подсв
   — альтернатива для лучшего русского: amberoad/bert-multilingual-passage-reranking-msmarco
 
 Загрузка происходит один раз при первом вызове (ленивая инициализация).
+
+Границы spans считаются при индексации и лежат в metadata["spans"] чанка;
+scores cross-encoder'а кешируются (LRU) по (модель, хеш вопроса, хеш span),
+так что повторные и совпадающие после нормализации вопросы почти не
+запускают модель.
+
+Инференс идёт через общий micro-batcher: пары сортируются по длине и
+режутся на корзины (меньше паддинга при max_length=512), длинные тексты
+обрезаются до окна вокруг слов вопроса, а одновременные вызовы из разных
+чатов и batch-режима собираются в общие батчи.
 """
 
 from __future__ import annotations
+import os
 import re
+import time
+import queue
+import socket
+import shutil
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
-# Глобальный синглтон — загружается один раз
+# Глобальный синглтон — загружается один раз (перезагружается при смене бэкенда в настройках)
 _reranker = None
 _reranker_model_name: Optional[str] = None
+_reranker_backend: Optional[str] = None
+_load_lock = threading.Lock()
+# Прогрев: бэкенд, для которого модель загружена и прогнана на пробном батче
+_warmed_backend: Optional[str] = None
+_warm_up_thread: Optional[threading.Thread] = None
+# Отдельно от _load_lock: тот держится всю загрузку модели, а запуск прогрева
+# вызывается из ответа и GUI-потока и ждать загрузку не должен
+_warm_up_lock = threading.Lock()
+# После неудачной загрузки всех моделей не повторяем попытку на каждом вопросе
+_LOAD_RETRY_S = 10 * 60
+_load_failed_at: Optional[float] = None
+# Пользователь сам выставил офлайн-режим — онлайн-загрузку не пробуем никогда
+_USER_OFFLINE = os.environ.get("TRANSFORMERS_OFFLINE") == "1" or os.environ.get("HF_HUB_OFFLINE") == "1"
+_HF_HOST = ("huggingface.co", 443)
+_ONLINE_CHECK_TIMEOUT_S = 1.5
 
 # Модели в порядке предпочтения (первая доступная будет использована)
 CANDIDATE_MODELS = [
@@ -32,48 +66,525 @@ CANDIDATE_MODELS = [
     "cross-encoder/ms-marco-TinyBERT-L-2-v2",               # самый лёгкий fallback
 ]
 
+# Бэкенды инференса (config.RERANKER_BACKEND / настройки):
+#   torch — CrossEncoder в полной точности, как раньше;
+#   int8  — тот же CrossEncoder, Linear-слои квантизованы динамически (torch, CPU);
+#   onnx  — модель экспортирована в ONNX и квантизована в int8 (optimum), инференс
+#           через ONNX Runtime; экспорт выполняется один раз и кешируется на диске.
+BACKENDS = ("torch", "int8", "onnx")
+
+_ONNX_QUANTIZED = "model_quantized.onnx"
+_ONNX_BATCH_SIZE = 32
+_MAX_LENGTH = 512
+
+
+def _backend_cache_dir(model_name: str, backend: str) -> str:
+    from cache import get_cache_root
+    return os.path.join(get_cache_root(), "rerankers", f"{model_name.replace('/', '__')}-{backend}")
+
+
+def export_onnx(model_name: str, model_dir: Optional[str] = None) -> str:
+    """
+    Экспорт cross-encoder в ONNX с динамической int8-квантизацией весов.
+    Результат (модель + токенизатор) — в кеше приложения; повторно не выполняется.
+    """
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model_dir = model_dir or _backend_cache_dir(model_name, "onnx")
+    if os.path.exists(os.path.join(model_dir, _ONNX_QUANTIZED)):
+        return model_dir
+    logger.info(f"[RERANKER] Экспорт {model_name} в ONNX (int8), один раз...")
+    tmp_dir = model_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    ORTModelForSequenceClassification.from_pretrained(model_name, export=True).save_pretrained(tmp_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_dir)
+    quantizer = ORTQuantizer.from_pretrained(tmp_dir)
+    quantizer.quantize(save_dir=tmp_dir,
+                       quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+    # Папка появляется целиком: прерванный экспорт не оставит битую модель
+    shutil.rmtree(model_dir, ignore_errors=True)
+    os.replace(tmp_dir, model_dir)
+    logger.info(f"[RERANKER] ONNX-модель сохранена: {model_dir}")
+    return model_dir
+
+
+class _OnnxCrossEncoder:
+    """predict(pairs) как у CrossEncoder, поверх ONNX Runtime на CPU."""
+
+    def __init__(self, model_dir: str, max_length: int = _MAX_LENGTH):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(os.path.join(model_dir, _ONNX_QUANTIZED), opts,
+                                            providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self.session.get_inputs()}
+
+    def predict(self, pairs, batch_size: int = _ONNX_BATCH_SIZE, **_kwargs):
+        import numpy as _np
+        outputs = []
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i + batch_size]
+            enc = self.tokenizer([q for q, _ in batch], [t for _, t in batch], padding=True,
+                                 truncation="longest_first", max_length=self.max_length, return_tensors="np")
+            feed = {k: v.astype(_np.int64) for k, v in enc.items() if k in self._inputs}
+            outputs.append(self.session.run(None, feed)[0])
+        return _np.concatenate(outputs) if outputs else _np.zeros((0, 1))
+
+
+def _load_model(model_name: str, backend: str):
+    if backend == "onnx":
+        return _OnnxCrossEncoder(export_onnx(model_name))
+    from sentence_transformers import CrossEncoder
+    model = CrossEncoder(model_name, max_length=_MAX_LENGTH)
+    if backend == "int8":
+        import torch
+        # Квантизация занимает секунды, поэтому не кешируется — на диске лежат исходные веса
+        model.model = torch.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def _online() -> bool:
+    """Доступен ли HuggingFace (короткий TCP-connect) — без сети онлайн-попытка только ждала бы таймауты."""
+    if _USER_OFFLINE:
+        return False
+    try:
+        socket.create_connection(_HF_HOST, timeout=_ONLINE_CHECK_TIMEOUT_S).close()
+        return True
+    except OSError:
+        return False
+
+
+def _load_with_offline_retry(model_name: str, backend: str):
+    try:
+        logger.info(f"[RERANKER] Загрузка модели: {model_name} [{backend}]")
+        # TRANSFORMERS_OFFLINE=1 — не проверять обновления на HuggingFace
+        # если модель уже есть в кеше. Убирает таймауты при офлайн-работе.
+        os.environ["TRANSFORMERS_OFFLINE"] = "1"
+        os.environ.setdefault("HF_DATASETS_OFFLINE", "1")
+        model = _load_model(model_name, backend)
+        logger.info(f"[RERANKER] Модель загружена: {model_name} [{backend}]")
+        return model
+    except ImportError as e:
+        # Нет пакетов бэкенда (optimum/onnxruntime/torch) — онлайн не поможет
+        logger.warning(f"[RERANKER] Бэкенд {backend} недоступен: {e}")
+        return None
+    except Exception as e:
+        logger.warning(f"[RERANKER] Не удалось загрузить {model_name}: {e}")
+    # Если не нашли в кеше — пробуем онлайн, но только когда сеть действительно есть
+    if not _online():
+        logger.info(f"[RERANKER] Нет доступа к HuggingFace — онлайн-загрузка {model_name} пропущена")
+        return None
+    try:
+        os.environ.pop("TRANSFORMERS_OFFLINE", None)
+        model = _load_model(model_name, backend)
+        logger.info(f"[RERANKER] Модель загружена онлайн: {model_name} [{backend}]")
+        return model
+    except Exception as e2:
+        logger.warning(f"[RERANKER] Онлайн загрузка тоже не удалась {model_name}: {e2}")
+        return None
+    finally:
+        os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+
+def _configured_backend() -> str:
+    try:
+        from config import get_reranker_settings
+        backend = get_reranker_settings()["backend"]
+    except Exception:
+        backend = "torch"
+    return backend if backend in BACKENDS else "torch"
+
+
+def hardware_profile() -> str:
+    """
+    "gpu" или "cpu" — профиль бюджета второго этапа поиска (config.RETRIEVAL_RERANK_PROFILES).
+    int8 и onnx всегда на CPU; torch — на GPU, если его видит torch.
+    """
+    if _configured_backend() != "torch":
+        return "cpu"
+    try:
+        import importlib.util
+        if importlib.util.find_spec("torch") is None:
+            return "cpu"
+        import torch
+        return "gpu" if torch.cuda.is_available() else "cpu"
+    except Exception:
+        return "cpu"
+
+
+def load_backend(backend: str) -> Optional[tuple]:
+    """(имя модели, модель) для бэкенда — без глобального синглтона (бенчмарк сравнения)."""
+    for model_name in CANDIDATE_MODELS:
+        model = _load_with_offline_retry(model_name, backend)
+        if model is not None:
+            return model_name, model
+    return None
+
 
 def _get_reranker():
-    """Ленивая загрузка reranker-модели."""
-    global _reranker, _reranker_model_name
-    if _reranker is not None:
+    """Ленивая загрузка reranker-модели выбранного бэкенда (при неудаче — torch)."""
+    global _reranker, _reranker_model_name, _reranker_backend, _load_failed_at
+    backend = _configured_backend()
+    if _reranker is not None and _reranker_backend == backend:
         return _reranker
+    if _load_failed_at is not None and time.monotonic() - _load_failed_at < _LOAD_RETRY_S:
+        return None
 
     try:
-        from sentence_transformers import CrossEncoder
+        from sentence_transformers import CrossEncoder  # noqa: F401
     except ImportError:
-        logger.warning("sentence-transformers не установлен. pip install sentence-transformers")
-        return None
+        if backend != "onnx":
+            logger.warning("sentence-transformers не установлен. pip install sentence-transformers")
+            return None
 
-    import os as _os
-    for model_name in CANDIDATE_MODELS:
-        try:
-            logger.info(f"[RERANKER] Загрузка модели: {model_name}")
-            # TRANSFORMERS_OFFLINE=1 — не проверять обновления на HuggingFace
-            # если модель уже есть в кеше. Убирает таймауты при офлайн-работе.
-            _os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
-            _os.environ.setdefault("HF_DATASETS_OFFLINE", "1")
-            _reranker = CrossEncoder(model_name, max_length=512)
-            _reranker_model_name = model_name
-            logger.info(f"[RERANKER] Модель загружена: {model_name}")
+    with _load_lock:
+        if _reranker is not None and _reranker_backend == backend:
             return _reranker
-        except Exception as e:
-            logger.warning(f"[RERANKER] Не удалось загрузить {model_name}: {e}")
-            # Если не нашли в кеше — пробуем онлайн
-            try:
-                _os.environ.pop("TRANSFORMERS_OFFLINE", None)
-                _reranker = CrossEncoder(model_name, max_length=512)
-                _reranker_model_name = model_name
-                logger.info(f"[RERANKER] Модель загружена онлайн: {model_name}")
+        for candidate in ([backend, "torch"] if backend != "torch" else ["torch"]):
+            loaded = load_backend(candidate)
+            if loaded is not None:
+                _reranker_model_name, _reranker = loaded
+                # Запоминаем запрошенный бэкенд, чтобы не пытаться загрузить его на каждом вопросе
+                _reranker_backend = backend
+                if candidate != backend:
+                    logger.warning(f"[RERANKER] Бэкенд {backend} не загрузился, используется torch")
+                _load_failed_at = None
                 return _reranker
-            except Exception as e2:
-                logger.warning(f"[RERANKER] Онлайн загрузка тоже не удалась {model_name}: {e2}")
-                continue
+        _load_failed_at = time.monotonic()
 
     logger.error("[RERANKER] Ни одна модель не доступна")
     return None
 
 
+def ready_reranker():
+    """Модель, если она уже загружена и прогрета для выбранного бэкенда; иначе None (без загрузки)."""
+    backend = _configured_backend()
+    if _reranker is not None and _reranker_backend == backend and _warmed_backend == backend:
+        return _reranker
+    return None
+
+
+def _warm_up():
+    global _warmed_backend
+    from scheduler import get_scheduler, Priority
+    backend = _configured_backend()
+    t0 = time.perf_counter()
+    # Фоновый класс: пока пользователь ждёт ответа, загрузка и прогрев уступают ему CPU
+    with get_scheduler().task(Priority.INDEXING):
+        get_scheduler().checkpoint()
+        model = _get_reranker()
+        if model is None:
+            return
+        try:
+            with get_scheduler().slot("reranker"):
+                predict_bucketed(model, [("прогрев", "пробный фрагмент текста для прогрева модели")] * 2,
+                                 _batch_settings()["batch_size"])
+        except Exception as e:
+            logger.warning(f"[RERANKER] Прогрев не удался: {e}")
+            return
+    _warmed_backend = backend
+    logger.info(f"[RERANKER] Модель готова [{backend}] за {time.perf_counter() - t0:.1f} с")
+
+
+def warm_up_reranker() -> None:
+    """Загрузить и прогреть reranker в фоне (после индексации, при смене бэкенда). Повторный вызов — no-op."""
+    global _warm_up_thread
+    if ready_reranker() is not None or not is_available():
+        return
+    with _warm_up_lock:
+        if _warm_up_thread is not None and _warm_up_thread.is_alive():
+            return
+        _warm_up_thread = threading.Thread(target=_warm_up, name="reranker-warmup", daemon=True)
+        _warm_up_thread.start()
+
+
+def to_scores(raw) -> list:
+    """
+    Выход predict → по одному float на пару. У моделей с двумя классами
+    (amberoad/bert-…) берётся логит класса «релевантно», а не оба логита.
+    """
+    import numpy as _np
+    arr = _np.asarray(raw, dtype=float)
+    if arr.ndim == 2:
+        arr = arr[:, -1]
+    return [float(s) for s in _np.atleast_1d(arr).flatten()]
+
+
+# ── кеш scores ───────────────────────────────────────────────────────────
+
+# Сколько пар (вопрос, фрагмент) помним; запись — ключ из трёх коротких строк и float
+_SCORE_CACHE_SIZE = 50_000
+_score_cache: OrderedDict = OrderedDict()
+_score_cache_lock = threading.Lock()
+_score_cache_stats = {"hits": 0, "misses": 0}
+
+_QUERY_PUNCT_RE = re.compile(r"[\s?!.,;:]+")
+
+
+def _hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _query_key(query: str) -> str:
+    # «Что такое FAISS?» и «что такое faiss» — один и тот же вопрос для кеша
+    return _hash(_QUERY_PUNCT_RE.sub(" ", query.lower()).strip())
+
+
+def _lookup_cached(query: str, texts: list) -> tuple:
+    """(ключи кеша, scores) — None на месте пар, которых нет в кеше; попадания считаются в stats."""
+    q = _query_key(query)
+    model_key = f"{_reranker_model_name}:{_reranker_backend}"
+    keys = [(model_key, q, _hash(t)) for t in texts]
+    scores: list = [None] * len(texts)
+    with _score_cache_lock:
+        for i, key in enumerate(keys):
+            cached = _score_cache.get(key)
+            if cached is not None:
+                _score_cache.move_to_end(key)
+                scores[i] = cached
+        _score_cache_stats["hits"] += sum(1 for s in scores if s is not None)
+    return keys, scores
+
+
+def score_pairs(query: str, texts: list, wait_for_model: bool = True) -> Optional[list]:
+    """
+    Scores cross-encoder'а для (query, text) по каждому тексту. Через модель
+    идут только пары, которых нет в кеше, — одним батчем. None — модель
+    недоступна или predict упал. wait_for_model=False (путь ответа) — модель
+    не грузится синхронно: пока она не прогрета, сразу None и прогрев в фоне.
+    """
+    reranker = _get_reranker() if wait_for_model else ready_reranker()
+    if reranker is None:
+        if not wait_for_model:
+            warm_up_reranker()
+        return None
+    keys, scores = _lookup_cached(query, texts)
+    missing = [i for i, s in enumerate(scores) if s is None]
+    with _score_cache_lock:
+        _score_cache_stats["misses"] += len(missing)
+    if missing:
+        max_chars = _batch_settings()["max_chars"]
+        try:
+            fresh = _batcher.predict(reranker, [
+                (query, truncate_around_query(query, texts[i], max_chars)) for i in missing
+            ])
+        except Exception as e:
+            logger.error(f"[RERANKER] Ошибка predict: {e}")
+            return None
+        with _score_cache_lock:
+            for i, score in zip(missing, fresh):
+                scores[i] = score
+                _score_cache[keys[i]] = score
+            while len(_score_cache) > _SCORE_CACHE_SIZE:
+                _score_cache.popitem(last=False)
+    return scores
+
+
+def score_within_budget(query: str, texts: list, budget_ms: float,
+                        wait_for_model: bool = False) -> Optional[list]:
+    """
+    Scores по texts в их порядке (лучшие кандидаты первыми), пока укладываемся
+    в budget_ms. Пары из кеша — сразу; остальные — батчами по reranker_batch_size.
+    Следующий батч не начинается, если по времени прошлого он не успеет до
+    конца бюджета (ранний выход): на месте неоценённых — None.
+    None целиком — модель не готова или predict упал на первом батче.
+    """
+    if not texts:
+        return []
+    if (_get_reranker() if wait_for_model else ready_reranker()) is None:
+        if not wait_for_model:
+            warm_up_reranker()
+        return None
+    t0 = time.perf_counter()
+    _keys, scores = _lookup_cached(query, texts)
+    missing = [i for i, s in enumerate(scores) if s is None]
+    batch_size = _batch_settings()["batch_size"]
+    last_batch_ms = 0.0
+    for start in range(0, len(missing), batch_size):
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        if start and elapsed_ms + last_batch_ms > budget_ms:
+            logger.info(f"[RERANKER] Бюджет {budget_ms:.0f} мс исчерпан: "
+                        f"оценено {len(texts) - len(missing) + start} из {len(texts)}")
+            break
+        batch = missing[start:start + batch_size]
+        t_batch = time.perf_counter()
+        fresh = score_pairs(query, [texts[i] for i in batch], wait_for_model=wait_for_model)
+        if fresh is None:
+            if not start and len(missing) == len(texts):
+                return None
+            break
+        for i, score in zip(batch, fresh):
+            scores[i] = score
+        last_batch_ms = (time.perf_counter() - t_batch) * 1000
+    return scores
+
+
+def score_cache_stats() -> dict:
+    with _score_cache_lock:
+        size = len(_score_cache)
+    return {"size": size, **_score_cache_stats}
+
+
+def clear_score_cache() -> None:
+    with _score_cache_lock:
+        _score_cache.clear()
+
+
+# ── пакетный инференс ────────────────────────────────────────────────────
+
+# Границы корзин по длине пары (символы вопроса + фрагмента): внутри батча длины близки
+_BUCKET_CHARS = (160, 320, 640, 1280)
+# Сколько micro-batcher ждёт попутные запросы после первого
+_BATCH_WINDOW_S = 0.003
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _batch_settings() -> dict:
+    try:
+        from config import get_reranker_settings
+        s = get_reranker_settings()
+        return {"batch_size": max(1, int(s["batch_size"])), "max_chars": max(100, int(s["max_chars"]))}
+    except Exception:
+        return {"batch_size": 16, "max_chars": 1000}
+
+
+def truncate_around_query(query: str, text: str, max_chars: int) -> str:
+    """
+    Текст длиннее max_chars → окно max_chars, где больше всего слов вопроса
+    (сравнение по первым 5 буквам — грубая основа). Без совпадений — начало текста.
+    """
+    if len(text) <= max_chars:
+        return text
+    stems = {w[:5] for w in _WORD_RE.findall(query.lower()) if len(w) > 2}
+    hits = [m.start() for m in _WORD_RE.finditer(text) if m.group().lower()[:5] in stems]
+    if not hits:
+        return text[:max_chars]
+    best_start, best_count, right = hits[0], 0, 0
+    for left, start in enumerate(hits):
+        while right < len(hits) and hits[right] < start + max_chars:
+            right += 1
+        if right - left > best_count:
+            best_start, best_count = start, right - left
+    # Немного контекста перед первым совпадением; окно не выходит за конец текста
+    start = max(0, min(best_start - max_chars // 4, len(text) - max_chars))
+    if start > 0:
+        space = text.find(" ", start, start + 40)
+        if space != -1:
+            start = space + 1
+    return text[start:start + max_chars]
+
+
+def _bucket(length: int) -> int:
+    for i, bound in enumerate(_BUCKET_CHARS):
+        if length <= bound:
+            return i
+    return len(_BUCKET_CHARS)
+
+
+def predict_bucketed(model, pairs: list, batch_size: int) -> list:
+    """predict по корзинам длины (батч не смешивает короткие spans с длинными чанками); порядок сохраняется."""
+    scores = [0.0] * len(pairs)
+    order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+    batch: list = []
+    batch_bucket = None
+
+    def flush():
+        out = to_scores(model.predict([pairs[i] for i in batch], batch_size=len(batch), show_progress_bar=False))
+        for i, score in zip(batch, out):
+            scores[i] = score
+
+    for i in order:
+        bucket = _bucket(len(pairs[i][0]) + len(pairs[i][1]))
+        if batch and (bucket != batch_bucket or len(batch) >= batch_size):
+            flush()
+            batch = []
+        batch.append(i)
+        batch_bucket = bucket
+    if batch:
+        flush()
+    return scores
+
+
+class _MicroBatcher:
+    """
+    Один поток инференса: запросы, пришедшие почти одновременно (в пределах
+    _BATCH_WINDOW_S), скорятся вместе; одинаковые пары считаются один раз.
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "requests": 0, "pairs": 0, "shared_batches": 0}
+
+    def predict(self, model, pairs: list) -> list:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="reranker-batcher", daemon=True)
+                self._thread.start()
+        future: Future = Future()
+        self._queue.put((model, [tuple(p) for p in pairs], future))
+        return future.result()
+
+    def _collect(self) -> list:
+        requests = [self._queue.get()]
+        deadline = time.monotonic() + _BATCH_WINDOW_S
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return requests
+            try:
+                requests.append(self._queue.get(timeout=left))
+            except queue.Empty:
+                return requests
+
+    def _run(self):
+        from scheduler import get_scheduler
+        while True:
+            requests = self._collect()
+            # Смена бэкенда между запросами — разные модели в одном окне
+            by_model: dict = {}
+            for model, pairs, future in requests:
+                by_model.setdefault(id(model), (model, []))[1].append((pairs, future))
+            for model, items in by_model.values():
+                merged, index, positions = [], {}, []
+                for pairs, _future in items:
+                    idx = []
+                    for pair in pairs:
+                        if pair not in index:
+                            index[pair] = len(merged)
+                            merged.append(pair)
+                        idx.append(index[pair])
+                    positions.append(idx)
+                try:
+                    with get_scheduler().slot("reranker"):
+                        scores = predict_bucketed(model, merged, _batch_settings()["batch_size"])
+                except Exception as e:
+                    for _pairs, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_pairs, future), idx in zip(items, positions):
+                    future.set_result([scores[k] for k in idx])
+                self.stats["batches"] += 1
+                self.stats["requests"] += len(items)
+                self.stats["pairs"] += len(merged)
+                if len(items) > 1:
+                    self.stats["shared_batches"] += 1
+
+
+_batcher = _MicroBatcher()
+
+
+def batcher_stats() -> dict:
+    return dict(_batcher.stats)
+
+
 def _split_into_spans(text: str, min_len: int = 30) -> list[tuple[int, int, str]]:
     """
     Разбивает текст на небольшие spans для reranking.
@@ -130,6 +641,23 @@ def _split_into_spans(text: str, min_len: int = 30) -> list[tuple[int, int, str]
     return spans
 
 
+def compute_spans(text: str) -> list:
+    """Границы spans чанка [[start, end], ...] — считаются при индексации и хранятся в metadata["spans"]."""
+    return [[int(s), int(e)] for s, e, _ in _split_into_spans(text)]
+
+
+def _doc_spans(doc) -> list[tuple[int, int, str]]:
+    """Spans чанка: из metadata (индекс с предрасчётом) или, для старых индексов, на лету."""
+    text = doc.page_content
+    stored = doc.metadata.get("spans")
+    if stored:
+        try:
+            return [(int(s), int(e), text[int(s):int(e)].strip()) for s, e in stored]
+        except (TypeError, ValueError):
+            pass
+    return _split_into_spans(text)
+
+
 def rerank_chunks(
     query: str,
     docs: list,
@@ -152,10 +680,6 @@ def rerank_chunks(
     Returns:
         Список dict: {source, start_char, end_char, text, relevance_score}
     """
-    reranker = _get_reranker()
-    if reranker is None:
-        return []
-
     # Собираем все spans со всех документов
     all_spans = []  # (source, chunk_start, span_rel_start, span_rel_end, span_text)
     for doc in docs:
@@ -168,26 +692,15 @@ def rerank_chunks(
             chunk_start = int(raw_start) if raw_start is not None else 0
         except (TypeError, ValueError):
             chunk_start = 0
-        chunk_text = doc.page_content
-
-        spans = _split_into_spans(chunk_text)
-        for rel_start, rel_end, span_text in spans:
+        for rel_start, rel_end, span_text in _doc_spans(doc):
             all_spans.append((src, chunk_start, int(rel_start), int(rel_end), span_text))
 
     if not all_spans:
         return []
 
-    # Батч-скоринг через cross-encoder
-    pairs = [(query, span[4]) for span in all_spans]
-    try:
-        import numpy as _np
-        raw_scores = reranker.predict(pairs)
-        # predict() возвращает скаляр при одном элементе — нормализуем в 1D массив
-        scores_arr = _np.atleast_1d(raw_scores)
-        # Конвертируем в обычные Python float — никаких numpy-скаляров дальше
-        scores_list = [float(s) for s in scores_arr.flatten()]
-    except Exception as e:
-        logger.error(f"[RERANKER] Ошибка predict: {e}")
+    # Батч-скоринг через cross-encoder (пары из кеша модель не видит)
+    scores_list = score_pairs(query, [span[4] for span in all_spans])
+    if scores_list is None:
         return []
 
     # Сортируем по score, берём top_k
@@ -234,9 +747,8 @@ def rerank_chunks(
 
 
 def is_available() -> bool:
-    """Проверяет доступность reranker без загрузки модели."""
-    try:
-        from sentence_transformers import CrossEncoder  # noqa: F401
+    """Проверяет доступность reranker без загрузки модели (и без импорта torch — можно звать из GUI)."""
+    import importlib.util
+    if importlib.util.find_spec("sentence_transformers") is not None:
         return True
-    except ImportError:
-        return False
+    return _configured_backend() == "onnx" and importlib.util.find_spec("onnxruntime") is not None
@@ -0,0 +1,126 @@
+"""
+retrieval_trace.py — асинхронная запись найденных чанков для отладки retrieval.
+
+Заменяет синхронную перезапись ПОСЛЕДНИЕ_ЧАНКИ.txt рядом с исходниками.
+Включается флагом "retrieval_traces" в настройках (по умолчанию выключено —
+тогда цепочка не создаёт writer и путь ответа не трогается вообще).
+
+Запись идёт из фонового потока через ограниченную очередь: если диск не
+успевает, новые trace отбрасываются (с подсчётом), а не тормозят ответ.
+Каждый запрос — отдельный файл в <кеш папки>/retrieval_traces/, поэтому
+параллельные вопросы не перетирают друг друга. Хранятся последние
+RETRIEVAL_TRACE_KEEP файлов.
+"""
+
+from __future__ import annotations
+
+import os
+import queue
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+
+RETRIEVAL_TRACE_DIR = "retrieval_traces"
+RETRIEVAL_TRACE_QUEUE_SIZE = 32
+RETRIEVAL_TRACE_KEEP = 200
+
+_writers: dict = {}
+_writers_lock = threading.Lock()
+
+
+class RetrievalTraceWriter:
+    """Фоновый писатель retrieval-trace для одной папки."""
+
+    def __init__(self, out_dir: str, max_queue: int = RETRIEVAL_TRACE_QUEUE_SIZE,
+                 keep: int = RETRIEVAL_TRACE_KEEP):
+        self.out_dir = out_dir
+        self.keep = keep
+        self.dropped = 0
+        self.written = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="retrieval-trace-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, query: str, docs: list, trace_id: str = "", branch: str = "") -> bool:
+        """
+        Ставит trace в очередь и сразу возвращается (копируется только список
+        документов) — форматирование и запись выполняются в фоновом потоке.
+        """
+        item = (datetime.now(), query, list(docs), trace_id, branch)
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Дождаться записи всего, что уже в очереди (для batch-режима и бенчмарков)."""
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            try:
+                self._write(*item)
+                self.written += 1
+                if self.written % 20 == 0:
+                    self._prune()
+            except Exception as e:
+                logging.warning(f"[RETRIEVAL_TRACE] Не удалось записать trace: {e}")
+
+    def _write(self, ts: datetime, query: str, docs: list, trace_id: str, branch: str):
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = f"{ts:%Y%m%d-%H%M%S}-{ts.microsecond // 1000:03d}_{trace_id or 'query'}.txt"
+        path = os.path.join(self.out_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"Время: {ts:%Y-%m-%d %H:%M:%S}\n")
+            f.write(f"Вопрос: {query}\n")
+            if trace_id:
+                f.write(f"Trace: {trace_id}\n")
+            if branch:
+                f.write(f"Ветка: {branch}\n")
+            f.write("=" * 100 + "\n\n")
+            for i, doc in enumerate(docs, 1):
+                meta = doc.metadata or {}
+                filename = os.path.basename(meta.get("source", "неизвестно"))
+                f.write(f"ЧАНК {i}  ←  {filename}")
+                if meta.get("chunk_index") is not None:
+                    f.write(f"  [#{meta.get('chunk_index')}, {meta.get('start_char')}–{meta.get('end_char')}]")
+                f.write("\n" + "—" * 80 + "\n")
+                f.write(doc.page_content.strip())
+                f.write("\n\n" + "═" * 80 + "\n\n")
+            f.write(f"Всего чанков: {len(docs)}\n")
+
+    def _prune(self):
+        try:
+            files = sorted(n for n in os.listdir(self.out_dir) if n.endswith(".txt"))
+        except OSError:
+            return
+        excess = len(files) - self.keep
+        for name in files[:max(0, excess)]:
+            try:
+                os.remove(os.path.join(self.out_dir, name))
+            except OSError:
+                pass
+
+
+def get_retrieval_trace_writer(folder_path: str) -> RetrievalTraceWriter:
+    """Один writer (и один фоновый поток) на папку на весь процесс."""
+    from cache import get_folder_cache_dir
+    out_dir = os.path.join(get_folder_cache_dir(folder_path), RETRIEVAL_TRACE_DIR)
+    with _writers_lock:
+        writer = _writers.get(out_dir)
+        if writer is None:
+            writer = RetrievalTraceWriter(out_dir)
+            _writers[out_dir] = writer
+        return writer
@@ -0,0 +1,265 @@
+"""
+scheduler.py — приоритеты и лимиты параллелизма для обращений к моделям.
+
+Индексация, подсказки, сводки и вопросы пользователя раньше шли в один
+QThreadPool и одновременно били в локальный Ollama, поэтому фоновая
+генерация подсказок могла задержать ответ на десятки секунд. Теперь:
+
+  * у каждой задачи есть класс приоритета (Priority) — он задаётся через
+    scheduler.task(...) и наследуется вложенными вызовами (contextvars);
+  * у каждого бэкенда (llm, embedder, ocr, reranker) есть лимит одновременных
+    слотов; ожидающие получают слот в порядке приоритета, затем очереди;
+  * пока идёт интерактивный вопрос, фоновые задачи (подсказки, индексация)
+    новых слотов не получают и ждут на checkpoint() между пачками;
+  * фоновые слоты, занятые в момент прихода вопроса, помечаются preempted —
+    код, который умеет прерываться (стрим подсказок), бросает запрос и
+    повторяет его после вопроса.
+"""
+
+from __future__ import annotations
+
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+from enum import IntEnum
+from contextvars import ContextVar
+from typing import Optional
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0   # вопрос пользователя
+    SUMMARY = 1       # сводки по файлам/папке
+    SUGGESTIONS = 2   # рекомендованные вопросы
+    INDEXING = 3      # эмбеддинги и OCR при индексации
+
+
+# Фоновые классы: откладываются и вытесняются, пока идёт интерактивный вопрос
+BACKGROUND = (Priority.SUGGESTIONS, Priority.INDEXING)
+
+DEFAULT_CAPS = {
+    "llm": 2,        # одновременных генераций в Ollama
+    "embedder": 2,
+    "ocr": 1,        # EasyOCR на GPU делит память с Ollama
+    "reranker": 1,
+}
+
+_current_priority: ContextVar[Priority] = ContextVar("scheduler_priority", default=Priority.INTERACTIVE)
+
+
+def current_priority() -> Priority:
+    return _current_priority.get()
+
+
+class Slot:
+    """Занятый слот ресурса. Контекстный менеджер; release() идемпотентен."""
+
+    def __init__(self, scheduler: "Scheduler", resource: str, priority: Priority, wait_ms: float):
+        self.resource = resource
+        self.priority = priority
+        self.wait_ms = wait_ms
+        self.preempted = threading.Event()
+        self._scheduler = scheduler
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._scheduler._release(self)
+
+    def __enter__(self) -> "Slot":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "wake")
+
+    def __init__(self, priority: Priority, seq: int, wake=None):
+        self.priority = priority
+        self.seq = seq
+        self.wake = wake  # для async-ожидающих: разбудить loop
+
+
+class _Resource:
+    def __init__(self, cap: int):
+        self.cap = max(1, cap)
+        self.held: list = []      # [Slot]
+        self.waiters: list = []   # [_Waiter]
+        self.granted = 0
+        self.wait_ms_total = 0.0
+
+
+class Scheduler:
+    def __init__(self, caps: Optional[dict] = None):
+        self._cond = threading.Condition()
+        self._resources = {name: _Resource(cap) for name, cap in (caps or DEFAULT_CAPS).items()}
+        self._interactive = 0
+        self._seq = 0
+        self.preemptions = 0
+
+    # ── классы задач ─────────────────────────────────────────────────────
+
+    @contextlib.contextmanager
+    def task(self, priority: Priority):
+        """Выполнить блок с данным приоритетом; интерактивный блок откладывает фоновые."""
+        token = _current_priority.set(priority)
+        if priority == Priority.INTERACTIVE:
+            self._begin_interactive()
+        try:
+            yield
+        finally:
+            if priority == Priority.INTERACTIVE:
+                self._end_interactive()
+            _current_priority.reset(token)
+
+    def _begin_interactive(self):
+        with self._cond:
+            self._interactive += 1
+            for res in self._resources.values():
+                for slot in res.held:
+                    if slot.priority in BACKGROUND and not slot.preempted.is_set():
+                        slot.preempted.set()
+                        self.preemptions += 1
+
+    def _end_interactive(self):
+        with self._cond:
+            self._interactive = max(0, self._interactive - 1)
+            self._wake_all()
+
+    @property
+    def interactive_active(self) -> bool:
+        return self._interactive > 0
+
+    def checkpoint(self, timeout: Optional[float] = None) -> None:
+        """Точка уступки для фоновых циклов: ждёт, пока идут интерактивные вопросы."""
+        if current_priority() not in BACKGROUND:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._interactive > 0:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return
+                self._cond.wait(left if left is not None else 1.0)
+
+    # ── слоты ────────────────────────────────────────────────────────────
+
+    def _can_grant(self, res: _Resource, waiter: _Waiter) -> bool:
+        if len(res.held) >= res.cap:
+            return False
+        if waiter.priority in BACKGROUND and self._interactive > 0:
+            return False
+        best = min(res.waiters, key=lambda w: (w.priority, w.seq))
+        return best is waiter
+
+    def _grant(self, res: _Resource, resource: str, waiter: _Waiter, t0: float) -> Slot:
+        res.waiters.remove(waiter)
+        wait_ms = (time.perf_counter() - t0) * 1000
+        slot = Slot(self, resource, waiter.priority, wait_ms)
+        if waiter.priority in BACKGROUND and self._interactive > 0:
+            slot.preempted.set()
+        res.held.append(slot)
+        res.granted += 1
+        res.wait_ms_total += wait_ms
+        return slot
+
+    def _enqueue(self, res: _Resource, priority: Priority, wake=None) -> _Waiter:
+        self._seq += 1
+        waiter = _Waiter(priority, self._seq, wake)
+        res.waiters.append(waiter)
+        return waiter
+
+    def acquire(self, resource: str, priority: Optional[Priority] = None) -> Slot:
+        """Блокирующе занять слот ресурса (приоритет по умолчанию — текущий класс задачи)."""
+        priority = current_priority() if priority is None else priority
+        res = self._resources[resource]
+        t0 = time.perf_counter()
+        with self._cond:
+            waiter = self._enqueue(res, priority)
+            while not self._can_grant(res, waiter):
+                self._cond.wait()
+            return self._grant(res, resource, waiter, t0)
+
+    async def acquire_async(self, resource: str, priority: Optional[Priority] = None) -> Slot:
+        """То же для asyncio: ожидание не занимает поток."""
+        priority = current_priority() if priority is None else priority
+        res = self._resources[resource]
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        t0 = time.perf_counter()
+
+        def wake():
+            loop.call_soon_threadsafe(event.set)
+
+        with self._cond:
+            waiter = self._enqueue(res, priority, wake)
+        try:
+            while True:
+                with self._cond:
+                    if self._can_grant(res, waiter):
+                        return self._grant(res, resource, waiter, t0)
+                    event.clear()
+                await event.wait()
+        except BaseException:
+            with self._cond:
+                if waiter in res.waiters:
+                    res.waiters.remove(waiter)
+                    self._wake_all()
+            raise
+
+    def slot(self, resource: str, priority: Optional[Priority] = None) -> Slot:
+        """`with scheduler.slot("llm"):` — синоним acquire для контекстного менеджера."""
+        return self.acquire(resource, priority)
+
+    def _release(self, slot: Slot) -> None:
+        with self._cond:
+            res = self._resources[slot.resource]
+            if slot in res.held:
+                res.held.remove(slot)
+            self._wake_all()
+
+    def _wake_all(self) -> None:
+        # Вызывается под self._cond
+        self._cond.notify_all()
+        for res in self._resources.values():
+            for waiter in res.waiters:
+                if waiter.wake is not None:
+                    waiter.wake()
+
+    # ── состояние ────────────────────────────────────────────────────────
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "interactive": self._interactive,
+                "preemptions": self.preemptions,
+                "resources": {
+                    name: {
+                        "cap": res.cap,
+                        "in_use": len(res.held),
+                        "waiting": len(res.waiters),
+                        "granted": res.granted,
+                        "avg_wait_ms": round(res.wait_ms_total / res.granted, 1) if res.granted else 0.0,
+                    }
+                    for name, res in self._resources.items()
+                },
+            }
+
+
+_scheduler: Optional[Scheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """Один планировщик на процесс: все задачи делят один локальный Ollama."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler()
+                logging.info(f"[SCHED] Лимиты ресурсов: {DEFAULT_CAPS}")
+    return _scheduler
@@ -0,0 +1,517 @@
+"""
+text_store.py — извлечённый текст документов в кеше папки.
+
+Индексатор уже разбирает каждый файл (PyPDF2, python-docx, BeautifulSoup,
+OCR), а превью и подсветка раньше разбирали его заново — на GUI-потоке, при
+каждом клике и каждом ответе. Теперь текст, извлечённый при индексации,
+сохраняется в <кеш папки>/texts/:
+
+  * <sha256 содержимого>.z — текст, сжатый zlib; одинаковые файлы (копии,
+    переименования) делят один блоб;
+  * manifest.json — путь → {mtime, size, hash}: запись действительна, пока
+    файл не изменился, поэтому чтение не хеширует файл заново;
+  * <sha256>.lay — таблицы TextLayout (начала строк, схлопывание пробелов)
+    для этого текста: превью и подсветка переводят позиции бинпоиском;
+  * VERSION — версия формата извлечения; при её смене хранилище очищается,
+    чтобы смещения чанков и текст превью не разошлись.
+
+load_text(path) — общий вход для индексатора, превью и подсветки: текст из
+хранилища, а при промахе — извлечение тем же кодом, что и при индексации.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import zlib
+import struct
+import bisect
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from cache import get_folder_cache_dir
+
+# Меняется вместе с извлечением текста (extract_document): старые тексты становятся недействительны.
+# 2 — страницы PDF склеиваются через "\n" и запоминаются их границы
+TEXT_STORE_VERSION = 2
+
+_TEXTS_DIR = "texts"
+_MANIFEST = "manifest.json"
+_VERSION_FILE = "VERSION"
+_BLOB_EXT = ".z"
+_LAYOUT_EXT = ".lay"
+_COMPRESS_LEVEL = 6
+_HASH_CHUNK = 1 << 20
+
+IMAGE_FORMATS = ("png", "jpg", "jpeg")
+# Форматы, у которых TextLayout несёт структуру документа (страницы PDF, абзацы DOCX)
+_STRUCTURED_FORMATS = ("pdf", "docx")
+
+
+def content_hash(path: str) -> str:
+    """sha256 содержимого файла (hex, 32 символа) — ключ блоба."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()[:32]
+
+
+def _join(parts: list, sep: str = "\n") -> tuple:
+    """Склейка частей документа: (текст, позиция начала каждой части)."""
+    starts = array("q")
+    pos = 0
+    for part in parts:
+        starts.append(pos)
+        pos += len(part) + len(sep)
+    return sep.join(parts), starts
+
+
+def extract_document(file_path: str, ocr: Optional[Callable[[str], str]] = None) -> tuple:
+    """
+    (текст, TextLayout) файла — одна модель документа для индекса и превью:
+    смещения чанков, подсветка и навигация считаются по одному и тому же тексту.
+    У PDF — границы страниц (страницы склеиваются через "\n"), у DOCX —
+    границы абзацев. ocr(path) — распознавание изображений; без него изображения дают "".
+    """
+    ext = os.path.splitext(file_path)[1].lower().lstrip(".")
+    text, pages, paragraphs = "", None, None
+    try:
+        if ext in IMAGE_FORMATS:
+            text = ocr(file_path) if ocr is not None else ""
+
+        elif ext == "pdf":
+            import PyPDF2
+            with open(file_path, "rb") as f:
+                reader = PyPDF2.PdfReader(f)
+                text, pages = _join([page.extract_text() or "" for page in reader.pages])
+
+        elif ext in ("txt", "md"):
+            with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+                text = f.read()
+
+        elif ext == "docx":
+            from docx import Document as DocxDocument
+            doc = DocxDocument(file_path)
+            text, paragraphs = _join([para.text for para in doc.paragraphs])
+
+        elif ext == "html":
+            import bs4
+            with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+                text = bs4.BeautifulSoup(f.read(), "html.parser").get_text()
+
+    except Exception as e:
+        logging.error(f"Ошибка извлечения текста из {file_path}: {e}")
+        text, pages, paragraphs = "", None, None
+
+    return text, TextLayout.build(text, page_starts=pages, paragraph_starts=paragraphs)
+
+
+def extract_text(file_path: str, ocr: Optional[Callable[[str], str]] = None) -> str:
+    """Только текст документа (см. extract_document)."""
+    return extract_document(file_path, ocr)[0]
+
+
+_WS_RE = re.compile(r"\s+")
+# Пустая строка (возможно, с пробелами) разделяет абзацы в документах без своей разметки абзацев
+_PARAGRAPH_BREAK_RE = re.compile(r"\n[ \t]*\n\s*")
+# Заголовок .lay: длина текста, числа начал строк, точек схлопывания, страниц и абзацев
+_LAYOUT_HEADER = struct.Struct("<QQQQQ")
+
+
+class TextLayout:
+    """
+    Модель документа: таблицы смещений одного текста, считаются за один проход:
+
+      * line_starts — позиция начала каждой строки: строка по позиции и
+        позиция по строке — бинпоиск, без text[:pos].count("\n");
+      * page_starts — начала страниц (PDF; у остальных форматов пусто):
+        номер страницы чанка и переход к странице в превью;
+      * paragraph_starts — начала абзацев (DOCX — по документу, иначе по
+        пустым строкам);
+      * точки схлопывания пробелов — для текста, где каждый пробельный
+        промежуток заменён одним пробелом (так ищутся чанки, склеенные из
+        строк): после промежутка длиной L сдвиг растёт на L-1, и позиция
+        нормализованного текста переводится в исходную бинпоиском по точкам.
+    """
+
+    def __init__(self, text_len: int, line_starts: array, norm_breaks: array, orig_breaks: array,
+                 page_starts: array, paragraph_starts: array):
+        self.text_len = text_len
+        self.line_starts = line_starts
+        self._norm_breaks = norm_breaks
+        self._orig_breaks = orig_breaks
+        self.page_starts = page_starts
+        self.paragraph_starts = paragraph_starts
+
+    @classmethod
+    def build(cls, text: str, page_starts=None, paragraph_starts=None) -> "TextLayout":
+        line_starts = array("q", [0])
+        pos = text.find("\n")
+        while pos != -1:
+            line_starts.append(pos + 1)
+            pos = text.find("\n", pos + 1)
+        norm_breaks, orig_breaks = array("q"), array("q")
+        shift = 0
+        for m in _WS_RE.finditer(text):
+            run = m.end() - m.start()
+            if run > 1:
+                shift += run - 1
+                norm_breaks.append(m.end() - shift)
+                orig_breaks.append(m.end())
+        if paragraph_starts is None:
+            paragraph_starts = array("q", [0])
+            paragraph_starts.extend(m.end() for m in _PARAGRAPH_BREAK_RE.finditer(text) if m.end() < len(text))
+        return cls(len(text), line_starts, norm_breaks, orig_breaks,
+                   array("q", page_starts or []), array("q", paragraph_starts))
+
+    # ── строки ───────────────────────────────────────────────────────────
+
+    @property
+    def line_count(self) -> int:
+        return len(self.line_starts)
+
+    def line_of(self, pos: int) -> int:
+        """Номер строки (с 0), в которой стоит символ pos."""
+        return max(0, bisect.bisect_right(self.line_starts, pos) - 1)
+
+    def line_start(self, line: int) -> int:
+        line = max(0, min(line, len(self.line_starts) - 1))
+        return self.line_starts[line]
+
+    def next_line_start(self, pos: int) -> int:
+        """Начало первой строки не раньше pos (или конец текста)."""
+        i = bisect.bisect_left(self.line_starts, pos)
+        return self.line_starts[i] if i < len(self.line_starts) else self.text_len
+
+    # ── страницы и абзацы ────────────────────────────────────────────────
+
+    @property
+    def page_count(self) -> int:
+        """Число страниц; 0 — у формата нет страниц."""
+        return len(self.page_starts)
+
+    def page_of(self, pos: int) -> Optional[int]:
+        """Номер страницы (с 0) символа pos; None — у документа нет страниц."""
+        if not self.page_starts:
+            return None
+        return max(0, bisect.bisect_right(self.page_starts, pos) - 1)
+
+    def page_start(self, page: int) -> int:
+        if not self.page_starts:
+            return 0
+        return self.page_starts[max(0, min(page, len(self.page_starts) - 1))]
+
+    def paragraph_of(self, pos: int) -> int:
+        return max(0, bisect.bisect_right(self.paragraph_starts, pos) - 1)
+
+    def paragraph_bounds(self, index: int) -> tuple:
+        """(начало, конец) абзаца; конец — начало следующего или конец текста."""
+        index = max(0, min(index, len(self.paragraph_starts) - 1))
+        end = self.paragraph_starts[index + 1] if index + 1 < len(self.paragraph_starts) else self.text_len
+        return self.paragraph_starts[index], end
+
+    # ── нормализация пробелов ────────────────────────────────────────────
+
+    def to_original(self, norm_pos: int) -> int:
+        """Позиция в тексте с схлопнутыми пробелами → позиция в исходном тексте."""
+        i = bisect.bisect_right(self._norm_breaks, norm_pos) - 1
+        if i < 0:
+            return min(norm_pos, self.text_len)
+        return min(self._orig_breaks[i] + norm_pos - self._norm_breaks[i], self.text_len)
+
+    def to_normalized(self, orig_pos: int) -> int:
+        i = bisect.bisect_right(self._orig_breaks, orig_pos) - 1
+        if i < 0:
+            return orig_pos
+        return self._norm_breaks[i] + orig_pos - self._orig_breaks[i]
+
+    # ── сериализация ─────────────────────────────────────────────────────
+
+    def to_bytes(self) -> bytes:
+        header = _LAYOUT_HEADER.pack(self.text_len, len(self.line_starts), len(self._norm_breaks),
+                                     len(self.page_starts), len(self.paragraph_starts))
+        body = b"".join(t.tobytes() for t in (self.line_starts, self._norm_breaks, self._orig_breaks,
+                                               self.page_starts, self.paragraph_starts))
+        return zlib.compress(header + body, _COMPRESS_LEVEL)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TextLayout":
+        raw = zlib.decompress(data)
+        text_len, n_lines, n_breaks, n_pages, n_paragraphs = _LAYOUT_HEADER.unpack_from(raw)
+        tables = []
+        offset = _LAYOUT_HEADER.size
+        for n in (n_lines, n_breaks, n_breaks, n_pages, n_paragraphs):
+            table = array("q")
+            table.frombytes(raw[offset:offset + n * table.itemsize])
+            offset += n * table.itemsize
+            tables.append(table)
+        return cls(text_len, *tables)
+
+
+def normalize_whitespace(text: str) -> str:
+    """Каждый пробельный промежуток → один пробел (та же нормализация, что в TextLayout)."""
+    return _WS_RE.sub(" ", text)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # Папка могла быть удалена очисткой кеша — хранилище переживает это без перезапуска
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class TextStore:
+    """Тексты файлов одной папки. Потокобезопасен: пишет индексатор, читают превью и подсветка."""
+
+    def __init__(self, folder_path: str):
+        self.folder_path = os.path.abspath(folder_path)
+        self.dir = os.path.join(get_folder_cache_dir(self.folder_path), _TEXTS_DIR)
+        self._lock = threading.Lock()
+        self._dirty = False
+        os.makedirs(self.dir, exist_ok=True)
+        self._manifest = self._load_manifest()
+
+    # ── manifest ─────────────────────────────────────────────────────────
+
+    def _load_manifest(self) -> dict:
+        version_path = os.path.join(self.dir, _VERSION_FILE)
+        try:
+            with open(version_path, "r", encoding="utf-8") as f:
+                version = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            version = 0
+        if version != TEXT_STORE_VERSION:
+            # Другой формат извлечения — прежние тексты не совпадут со смещениями нового индекса
+            for name in os.listdir(self.dir):
+                try:
+                    os.remove(os.path.join(self.dir, name))
+                except OSError:
+                    pass
+            _write_atomic(version_path, str(TEXT_STORE_VERSION).encode("ascii"))
+            return {}
+        try:
+            with open(os.path.join(self.dir, _MANIFEST), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def flush(self) -> None:
+        """Записать manifest, если он менялся."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._manifest, ensure_ascii=False).encode("utf-8")
+            self._dirty = False
+        try:
+            _write_atomic(os.path.join(self.dir, _MANIFEST), data)
+        except OSError as e:
+            logging.warning(f"[TEXTS] Не удалось сохранить manifest {self.dir}: {e}")
+
+    # ── тексты ───────────────────────────────────────────────────────────
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.dir, digest + _BLOB_EXT)
+
+    def _layout_path(self, digest: str) -> str:
+        return os.path.join(self.dir, digest + _LAYOUT_EXT)
+
+    def get_layout(self, source: str, text: str) -> Optional[TextLayout]:
+        """
+        TextLayout сохранённого текста файла: с диска или построенный (и
+        сохранённый) сейчас. У PDF/DOCX границы страниц и абзацев по тексту не
+        восстановить — без целого .lay None: вызывающий извлекает документ заново.
+        """
+        structured = os.path.splitext(source)[1].lower().lstrip(".") in _STRUCTURED_FORMATS
+        entry = self._entry(os.path.abspath(source))
+        if entry is not None:
+            path = self._layout_path(entry["hash"])
+            try:
+                with open(path, "rb") as f:
+                    layout = TextLayout.from_bytes(f.read())
+                if layout.text_len == len(text):
+                    return layout
+            except (OSError, zlib.error, struct.error):
+                pass
+            if structured:
+                return None
+            layout = TextLayout.build(text)
+            try:
+                _write_atomic(path, layout.to_bytes())
+            except OSError:
+                pass
+            return layout
+        return None if structured else TextLayout.build(text)
+
+    def _entry(self, source: str) -> Optional[dict]:
+        """Запись manifest, если файл с тех пор не менялся."""
+        with self._lock:
+            entry = self._manifest.get(source)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+        if entry.get("mtime") != st.st_mtime or entry.get("size") != st.st_size:
+            return None
+        return entry
+
+    def get(self, source: str) -> Optional[str]:
+        """Сохранённый текст файла; None — нет записи или файл изменился."""
+        source = os.path.abspath(source)
+        entry = self._entry(source)
+        if entry is None:
+            return None
+        try:
+            with open(self._blob_path(entry["hash"]), "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except (OSError, zlib.error, UnicodeDecodeError):
+            return None
+
+    def put(self, source: str, text: str, layout: Optional[TextLayout] = None) -> None:
+        """
+        Сохранить текст файла и, если передана, его TextLayout (mtime/size
+        берутся до хеширования — изменение во время записи не пройдёт).
+        """
+        source = os.path.abspath(source)
+        try:
+            st = os.stat(source)
+            digest = content_hash(source)
+            blob = self._blob_path(digest)
+            if not os.path.exists(blob):
+                _write_atomic(blob, zlib.compress(text.encode("utf-8"), _COMPRESS_LEVEL))
+            # Layout пишется всегда: старый .lay мог быть повреждён (см. get_layout)
+            if layout is not None:
+                _write_atomic(self._layout_path(digest), layout.to_bytes())
+        except OSError as e:
+            logging.warning(f"[TEXTS] Не удалось сохранить текст {source}: {e}")
+            return
+        with self._lock:
+            self._manifest[source] = {"mtime": st.st_mtime, "size": st.st_size, "hash": digest}
+            self._dirty = True
+
+    def retain(self, sources) -> None:
+        """Оставить только записи этих файлов и удалить блобы, на которые никто не ссылается."""
+        keep = {os.path.abspath(s) for s in sources}
+        with self._lock:
+            for source in [s for s in self._manifest if s not in keep]:
+                del self._manifest[source]
+                self._dirty = True
+            used = {entry["hash"] for entry in self._manifest.values()}
+        for name in os.listdir(self.dir):
+            digest, ext = os.path.splitext(name)
+            if ext in (_BLOB_EXT, _LAYOUT_EXT) and digest not in used:
+                try:
+                    os.remove(os.path.join(self.dir, name))
+                except OSError:
+                    pass
+        self.flush()
+
+
+_stores: dict = {}
+_stores_lock = threading.Lock()
+# Папка -> есть ли у неё хранилище (для поиска по предкам файла без повторных stat)
+_store_dirs: dict = {}
+
+
+def get_text_store(folder_path: str) -> TextStore:
+    """Одно хранилище на папку в процессе: manifest общий для индексатора и GUI."""
+    folder_path = os.path.abspath(folder_path)
+    store = _stores.get(folder_path)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(folder_path)
+            if store is None:
+                store = _stores[folder_path] = TextStore(folder_path)
+                _store_dirs[folder_path] = True
+    return store
+
+
+def _has_store(folder: str) -> bool:
+    known = _store_dirs.get(folder)
+    if known is None:
+        manifest = os.path.join(get_folder_cache_dir(folder, create=False), _TEXTS_DIR, _MANIFEST)
+        known = _store_dirs[folder] = os.path.exists(manifest)
+    return known
+
+
+def find_text_store(file_path: str) -> Optional[TextStore]:
+    """Хранилище ближайшей папки-предка, которую индексировали; None — таких нет."""
+    folder = os.path.dirname(os.path.abspath(file_path))
+    while True:
+        if _has_store(folder):
+            return get_text_store(folder)
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+
+def load_document(file_path: str, folder_path: Optional[str] = None) -> Optional[tuple]:
+    """
+    (текст, TextLayout) файла для превью и подсветки: из хранилища папки
+    (folder_path или ближайший проиндексированный предок), иначе — извлечение;
+    результат кладётся в хранилище. Изображения без сохранённого OCR — None
+    (OCR на GUI-потоке не запускаем).
+    """
+    store = get_text_store(folder_path) if folder_path else find_text_store(file_path)
+    if store is not None:
+        text = store.get(file_path)
+        layout = load_layout(file_path, text, folder_path) if text is not None else None
+        if layout is not None:
+            return text, layout
+    ext = os.path.splitext(file_path)[1].lower().lstrip(".")
+    if ext in IMAGE_FORMATS:
+        return None
+    text, layout = extract_document(file_path)
+    if store is not None and text:
+        store.put(file_path, text, layout)
+        store.flush()
+    return text, layout
+
+
+def load_text(file_path: str, folder_path: Optional[str] = None) -> Optional[str]:
+    """Только текст файла (см. load_document)."""
+    document = load_document(file_path, folder_path)
+    return document[0] if document is not None else None
+
+
+# Последние открытые layout'ы (превью листает один файл, подсветка — те же источники)
+_LAYOUT_CACHE_SIZE = 8
+_layout_cache: OrderedDict = OrderedDict()
+_layout_cache_lock = threading.Lock()
+
+
+def load_layout(file_path: str, text: str, folder_path: Optional[str] = None) -> Optional[TextLayout]:
+    """
+    TextLayout текста файла (из load_text): из памяти, из хранилища папки или
+    построенный заново. None — layout PDF/DOCX потерян, нужен extract_document.
+    """
+    file_path = os.path.abspath(file_path)
+    try:
+        st = os.stat(file_path)
+        key = (file_path, st.st_mtime, st.st_size, len(text))
+    except OSError:
+        key = None
+    if key is not None:
+        with _layout_cache_lock:
+            layout = _layout_cache.get(key)
+            if layout is not None:
+                _layout_cache.move_to_end(key)
+                return layout
+    store = get_text_store(folder_path) if folder_path else find_text_store(file_path)
+    layout = store.get_layout(file_path, text) if store is not None else TextLayout.build(text)
+    if layout is not None and key is not None:
+        with _layout_cache_lock:
+            _layout_cache[key] = layout
+            while len(_layout_cache) > _LAYOUT_CACHE_SIZE:
+                _layout_cache.popitem(last=False)
+    return layout
@@ -0,0 +1,189 @@
+"""
+tracing.py — структурированные spans по этапам ответа на вопрос.
+
+QueryTrace собирает spans (имя, смещение от начала, длительность, атрибуты)
+для всех этапов wrapped_qa_chain и AskRunnable.run. Завершённый trace
+попадает в финальный payload ответа, в кольцевой буфер последних trace
+(для окна просмотра в UI) и в ротируемый JSONL-лог <cache_root>/traces.jsonl.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+_TRACE_LOG_NAME = "traces.jsonl"
+_TRACE_LOG_MAX_BYTES = 5 * 1024 * 1024
+_TRACE_LOG_BACKUPS = 3
+
+_trace_logger: Optional[logging.Logger] = None
+_trace_logger_lock = threading.Lock()
+
+# Последние завершённые trace — для окна просмотра в UI
+_recent_traces: deque = deque(maxlen=50)
+
+
+def get_trace_log_path() -> str:
+    from cache import get_cache_root
+    return os.path.join(get_cache_root(), _TRACE_LOG_NAME)
+
+
+def _get_trace_logger() -> Optional[logging.Logger]:
+    """Отдельный логгер без propagate — trace не попадают в app.log."""
+    global _trace_logger
+    if _trace_logger is not None:
+        return _trace_logger
+    with _trace_logger_lock:
+        if _trace_logger is None:
+            try:
+                handler = RotatingFileHandler(
+                    get_trace_log_path(),
+                    maxBytes=_TRACE_LOG_MAX_BYTES,
+                    backupCount=_TRACE_LOG_BACKUPS,
+                    encoding="utf-8",
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger = logging.getLogger("rag.trace")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                logger.addHandler(handler)
+                _trace_logger = logger
+            except Exception as e:
+                logging.warning(f"[TRACE] Не удалось открыть лог trace: {e}")
+                return None
+    return _trace_logger
+
+
+class QueryTrace:
+    """Набор spans одного вопроса. Потокобезопасен: spans пишут и цепочка, и runnable."""
+
+    def __init__(self, query: str, kind: str = "query"):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.query = query
+        self.kind = kind
+        self.started_at = time.time()
+        self.attrs: dict = {}
+        self._t0 = time.perf_counter()
+        self._spans: list = []
+        self._lock = threading.Lock()
+        self._finished = False
+        self._total_ms: Optional[float] = None
+
+    def _offset_ms(self, t: float) -> float:
+        return round((t - self._t0) * 1000, 2)
+
+    def add_span(self, name: str, start: float, end: Optional[float] = None, **attrs) -> None:
+        """Добавить span по меткам time.perf_counter()."""
+        end = time.perf_counter() if end is None else end
+        span = {
+            "name": name,
+            "start_ms": self._offset_ms(start),
+            "duration_ms": round((end - start) * 1000, 2),
+        }
+        if attrs:
+            span["attrs"] = attrs
+        with self._lock:
+            self._spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        with trace.span("mmr", k=8) as attrs:
+            ...
+            attrs["found"] = len(docs)
+        """
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            self.add_span(name, start, **attrs)
+
+    def mark(self, name: str, **attrs) -> None:
+        """Событие нулевой длительности (например, первый токен LLM)."""
+        now = time.perf_counter()
+        self.add_span(name, now, now, **attrs)
+
+    def elapsed_ms(self) -> float:
+        return self._offset_ms(time.perf_counter())
+
+    @property
+    def spans(self) -> list:
+        with self._lock:
+            return list(self._spans)
+
+    def timings(self) -> dict:
+        """Плоская сводка {<имя>_ms: длительность}; одинаковые имена суммируются."""
+        out: dict = {}
+        for span in self.spans:
+            key = f"{span['name']}_ms"
+            if span["duration_ms"] == 0 and span["start_ms"]:
+                out[key] = span["start_ms"]  # события — смещение от начала
+            else:
+                out[key] = round(out.get(key, 0.0) + span["duration_ms"], 2)
+        return out
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "kind": self.kind,
+            "query": self.query,
+            "started_at": self.started_at,
+            "total_ms": self._total_ms if self._total_ms is not None else self.elapsed_ms(),
+            "attrs": dict(self.attrs),
+            "spans": sorted(self.spans, key=lambda s: s["start_ms"]),
+        }
+
+    def finish(self) -> dict:
+        """Завершает trace: пишет в лог и в буфер последних. Повторный вызов ничего не пишет."""
+        with self._lock:
+            already = self._finished
+            self._finished = True
+            if not already:
+                self._total_ms = self._offset_ms(time.perf_counter())
+        data = self.to_dict()
+        if already:
+            return data
+        _recent_traces.append(data)
+        logger = _get_trace_logger()
+        if logger is not None:
+            try:
+                logger.info(json.dumps(data, ensure_ascii=False, default=str))
+            except Exception:
+                pass
+        return data
+
+
+def get_latest_trace() -> Optional[dict]:
+    return _recent_traces[-1] if _recent_traces else None
+
+
+def get_recent_traces(limit: int = 20) -> list:
+    """Последние trace текущего процесса, новые первыми."""
+    return list(reversed(_recent_traces))[:limit]
+
+
+def read_trace_log(limit: int = 20) -> list:
+    """Последние trace из файла (включая прошлые сессии), новые первыми."""
+    path = get_trace_log_path()
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.readlines()[-limit:]
+    except Exception:
+        return []
+    traces = []
+    for line in reversed(lines):
+        try:
+            traces.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return traces
@@ -1,19 +1,23 @@
 # src/ui/main_window.py
 import os
-import re
 from datetime import datetime
 from typing import Optional
 
 from PyQt6 import QtWidgets, QtCore, QtGui
 
 from cache import clear_folder_cache, get_folder_cache_dir
-from config import MODEL_NAME, SUPPORTED_FORMATS, get_llm_settings, save_settings, OPENROUTER_FREE_MODELS
-from coordinator import RAGCoordinator
+from config import (MODEL_NAME, get_llm_settings, get_debug_settings, get_reranker_settings,
+                    get_retrieval_settings, load_settings, save_settings, OPENROUTER_FREE_MODELS,
+                    RETRIEVAL_RERANK_PROFILE)
+from conversation import Conversation
+from coordinator import RAGCoordinator, get_coordinator_pool
 from rag import generate_suggested_questions
 from ui.autocomplete_input import AutocompleteLineEdit
 from ui.chat_delegate import ChatItemDelegate
 from ui.chat_model import ChatListModel, ChatMessage
 from ui.log_window import LogWindow
+from ui.preview_pane import PreviewPane
+from ui.trace_window import TraceWindow
 from ui.tray import create_tray_icon
 
 
@@ -118,13 +122,15 @@ class MainWindow(QtWidgets.QMainWindow):
     QScrollBar::add-line:horizontal, QScrollBar::sub-line:horizontal { width: 0px; }
     """
 
-    def __init__(self, folder_path: Optional[str] = None):
+    def __init__(self, folder_path: Optional[str] = None, scope_file: Optional[str] = None):
         super().__init__()
 
         self.folder_path: Optional[str] = folder_path
         self.coordinator: Optional[RAGCoordinator] = None
 
         self.conversations = []
+        # Состояние диалога для цепочки (история, чанки прошлого хода) — параллельно conversations
+        self.conversation_states: list = []
         self.current_chat_idx = 0
 
         self.typing_timer: Optional[QtCore.QTimer] = None
@@ -140,7 +146,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self._setup_tray()
 
         if self.folder_path:
-            self._start_for_folder(os.path.abspath(self.folder_path), connect_signals=True)
+            self._start_for_folder(os.path.abspath(self.folder_path), connect_signals=True, scope_file=scope_file)
 
         self._init_conversations()
 
@@ -227,43 +233,14 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.center_splitter = QtWidgets.QSplitter(QtCore.Qt.Orientation.Vertical)
 
-        # Module 1: Document preview
-        preview_panel = QtWidgets.QWidget()
-        preview_layout = QtWidgets.QVBoxLayout(preview_panel)
-        preview_layout.setContentsMargins(10, 10, 10, 10)
-        preview_layout.setSpacing(8)
-
-        preview_toolbar = QtWidgets.QWidget()
-        preview_toolbar_layout = QtWidgets.QHBoxLayout(preview_toolbar)
-        preview_toolbar_layout.setContentsMargins(0, 0, 0, 0)
-        preview_toolbar_layout.setSpacing(8)
-
-        self.preview_title = QtWidgets.QLabel("Document Preview")
-        self.preview_title.setStyleSheet("color:#9aa; font-weight:600;")
-        self.preview_title.setTextFormat(QtCore.Qt.TextFormat.RichText)
-        preview_toolbar_layout.addWidget(self.preview_title)
-        preview_toolbar_layout.addStretch()
-
-        self.clear_highlight_btn = QtWidgets.QPushButton("✕ Clear highlight")
-        self.clear_highlight_btn.setVisible(False)
-        self.clear_highlight_btn.setStyleSheet(
-            "padding: 3px 8px; font-size: 11px; color: #ffd966; border-color: #5a5000;"
-        )
-        self.clear_highlight_btn.clicked.connect(self._clear_preview_highlight)
-        preview_toolbar_layout.addWidget(self.clear_highlight_btn)
-
-        self.preview_browser = QtWidgets.QTextBrowser()
-        self.preview_browser.setReadOnly(True)
-        self.preview_browser.setOpenExternalLinks(False)
-        self.preview_browser.setStyleSheet("font-family: Consolas, 'JetBrains Mono', monospace; font-size: 12.5px;")
-        self.preview_browser.setPlainText("Select a file in Files to view its contents.")
-
-        # Храним путь к текущему открытому файлу и его полный текст
-        self._preview_current_path: Optional[str] = None
-        self._preview_current_text: str = ""
-
-        preview_layout.addWidget(preview_toolbar)
-        preview_layout.addWidget(self.preview_browser, 1)
+        # Module 1: Document preview (текст грузится в фоне, в браузере — окно страниц)
+        preview_panel = PreviewPane()
+        self.preview_pane = preview_panel
+        self.preview_title = preview_panel.title
+        self.clear_highlight_btn = preview_panel.clear_highlight_btn
+        self.preview_browser = preview_panel.browser
+        # Подсветка, уже показанная ранним событием "highlights" текущего ответа
+        self._early_highlight_key: Optional[tuple] = None
 
         # Module 2: Chat
         chat_panel = QtWidgets.QWidget()
@@ -311,10 +288,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.send_btn.setObjectName("accentButton")
         self.send_btn.clicked.connect(self.send_question)
 
-        composer_layout.addWidget(self.input_field, 1)
-        composer_layout.addWidget(self.send_btn, 0)
+        # Вопрос сразу по всем папкам, индексы которых загружены в этой сессии
+        self.all_folders_btn = QtWidgets.QPushButton("All folders")
+        self.all_folders_btn.setCheckable(True)
+        self.all_folders_btn.setToolTip("Search every folder opened in this session")
 
         composer_layout.addWidget(self.input_field, 1)
+        composer_layout.addWidget(self.all_folders_btn, 0)
         composer_layout.addWidget(self.send_btn, 0)
 
         chat_layout.addWidget(chat_top)
@@ -412,6 +392,7 @@ class MainWindow(QtWidgets.QMainWindow):
         help_menu = menubar.addMenu("Help")
         help_menu.addAction("About", self.show_about_dialog)
         help_menu.addAction("Logs", self.open_logs)
+        help_menu.addAction("Query Trace", self.open_trace_viewer)
 
     def _setup_statusbar(self):
         sb = QtWidgets.QStatusBar()
@@ -477,12 +458,29 @@ class MainWindow(QtWidgets.QMainWindow):
     def apply_ui_enabled_state(self):
         has_folder = bool(self.folder_path)
         self.send_btn.setEnabled(has_folder)
+        self.all_folders_btn.setEnabled(has_folder)
         self.input_field.setEnabled(has_folder)
         self.reindex_btn.setEnabled(has_folder)
         self.status_clear_cache_btn.setEnabled(has_folder)
         if hasattr(self, "status_clear_summary_btn"):
             self.status_clear_summary_btn.setEnabled(has_folder)
 
+    def _disconnect_signals(self):
+        # Прежний координатор остаётся в пуле загруженным — его сигналы окну больше не нужны
+        coordinator = self.coordinator
+        if not coordinator:
+            return
+        for signal, slot in (
+                (coordinator.indexing_started, self._on_indexing_started),
+                (coordinator.indexing_finished, self._on_indexing_finished),
+                (coordinator.indexing_error, self._on_indexing_error),
+                (coordinator.indexing_progress, self._on_indexing_progress),
+        ):
+            try:
+                signal.disconnect(slot)
+            except (TypeError, RuntimeError):
+                pass
+
     def _connect_signals(self):
         if not self.coordinator:
             return
@@ -492,19 +490,19 @@ class MainWindow(QtWidgets.QMainWindow):
         if hasattr(self.coordinator, "indexing_progress"):
             self.coordinator.indexing_progress.connect(self._on_indexing_progress)
 
-    def _start_for_folder(self, folder_path: str, connect_signals: bool):
+    def _start_for_folder(self, folder_path: str, connect_signals: bool, scope_file: Optional[str] = None):
+        """scope_file — запуск по одному файлу: индекс папки, вопросы только по этому файлу."""
         self.folder_path = os.path.abspath(folder_path)
-        self.folder_label.setText(self.folder_path)
+        self.folder_label.setText(scope_file or self.folder_path)
         self.load_folder_tree(self.folder_path)
 
-        if RAGCoordinator._instance is not None:
-            try:
-                RAGCoordinator._instance.close()
-            except Exception:
-                pass
-            RAGCoordinator._instance = None
-
-        self.coordinator = RAGCoordinator.instance(self.folder_path)
+        if connect_signals:
+            self._disconnect_signals()
+        # Уже открытая в этой сессии папка берётся из пула без повторной загрузки индекса
+        self.coordinator = get_coordinator_pool().open(self.folder_path, scope_file=scope_file)
+        # Чанки прошлых ходов относятся к старой папке — для уточнений не годятся
+        for state in self.conversation_states:
+            state.reset()
         if connect_signals:
             self._connect_signals()
 
@@ -674,212 +672,7 @@ class MainWindow(QtWidgets.QMainWindow):
         except Exception:
             return
 
-        file_path = self.fs_model.filePath(index)
-        self.clear_highlight_btn.setVisible(False)
-        self._load_file_preview(file_path)
-
-    def _load_file_preview(self, file_path: str, highlight_chunks=None):
-        if not file_path or not os.path.exists(file_path):
-            self.preview_browser.setPlainText("Файл не найден.")
-            self._preview_current_path = None
-            self._preview_current_text = ""
-            return
-
-        ext = os.path.splitext(file_path)[1].lower().lstrip(".")
-        text = ""
-        try:
-            if ext in ("txt", "md"):
-                with open(file_path, "r", encoding="utf-8", errors="replace") as f:
-                    text = f.read()
-            elif ext == "html":
-                import bs4
-                with open(file_path, "r", encoding="utf-8", errors="replace") as f:
-                    soup = bs4.BeautifulSoup(f.read(), "html.parser")
-                text = soup.get_text()
-            elif ext == "pdf":
-                import PyPDF2
-                with open(file_path, "rb") as f:
-                    reader = PyPDF2.PdfReader(f)
-                    text = "\n".join((page.extract_text() or "") for page in reader.pages)
-            elif ext == "docx":
-                from docx import Document as DocxDocument
-                doc = DocxDocument(file_path)
-                text = "\n".join(p.text for p in doc.paragraphs)
-            elif ext in ("png", "jpg", "jpeg"):
-                text = (
-                    "Изображение: OCR/превью может занять много времени.\n"
-                    "TODO: добавить фоновое извлечение текста для изображений."
-                )
-            else:
-                text = (
-                    f"Preview for extension '.{ext}' is not implemented.\n"
-                    f"Supported formats: {', '.join(SUPPORTED_FORMATS)}"
-                )
-        except Exception as e:
-            text = f"Preview error: {e}"
-
-        self._preview_current_path = file_path
-        self._preview_current_text = text
-
-        if highlight_chunks:
-            self._render_preview_with_highlights(text, highlight_chunks)
-        else:
-            self._show_plain_text(text)
-            self.preview_title.setText(f"Document Preview — {os.path.basename(file_path)}")
-
-    def _render_preview_with_highlights(self, text: str, highlight_chunks: list):
-        """
-        Рендерит текст в превью с подсветкой конкретных предложений-источников.
-        Использует QTextBrowser с HTML-разметкой.
-
-        Стратегия поиска позиций (в порядке приоритета):
-        1. Точные start_char/end_char из метаданных (новый sentence-level алгоритм)
-        2. Текстовый поиск предложения в файле (fallback для старых индексов)
-        """
-        import html as html_module
-
-        # Собираем диапазоны для подсветки: (start, end)
-        ranges = []
-        for chunk in highlight_chunks:
-            start = chunk.get("start_char")
-            end = chunk.get("end_char")
-            # Вариант 1: точные позиции из sentence-level алгоритма
-            if start is not None and end is not None and 0 <= start < end <= len(text):
-                ranges.append((start, end))
-                continue
-
-            # Вариант 2: поиск текста предложения напрямую в файле
-            chunk_text = chunk.get("text", "").strip()
-            if not chunk_text:
-                continue
-            # Ищем с нормализацией пробелов — чанк мог быть склеен из строк
-            normalized_chunk = re.sub(r'\s+', ' ', chunk_text)
-            normalized_text = re.sub(r'\s+', ' ', text)
-            pos = normalized_text.find(normalized_chunk[:120])
-            if pos != -1:
-                # Переводим позицию из нормализованного текста в оригинальный
-                # Приблизительно: считаем символы в оригинале до этой точки
-                orig_pos = self._map_normalized_pos_to_original(text, pos)
-                orig_end = orig_pos + len(chunk_text)
-                if orig_end <= len(text):
-                    ranges.append((orig_pos, min(orig_end, len(text))))
-
-        # Объединяем пересекающиеся диапазоны
-        ranges.sort()
-        merged = []
-        for start, end in ranges:
-            if merged and start <= merged[-1][1]:
-                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
-            else:
-                merged.append([start, end])
-
-        # Строим HTML с подсветкой
-        html_parts = []
-        prev = 0
-        for start, end in merged:
-            # Текст до подсвеченного фрагмента
-            before = html_module.escape(text[prev:start])
-            # Подсвеченный фрагмент
-            highlighted = html_module.escape(text[start:end])
-            html_parts.append(before)
-            html_parts.append(
-                f'<span style="background-color:#3a3000; color:#ffd966; '
-                f'border-radius:3px; padding:1px 0px;">{highlighted}</span>'
-            )
-            prev = end
-
-        html_parts.append(html_module.escape(text[prev:]))
-
-        body = "".join(html_parts).replace("\n", "<br>")
-        full_html = (
-            '<html><body style="'
-            'background:#1e1e1e; color:#d4d4d4; '
-            'font-family:Consolas,JetBrains Mono,monospace; font-size:12.5px; '
-            'white-space:pre-wrap; word-wrap:break-word;">'
-            f"{body}</body></html>"
-        )
-        self.preview_browser.setHtml(full_html)
-
-        # Скроллим к первому подсвеченному фрагменту
-        if merged:
-            self._scroll_preview_to_char(merged[0][0], text)
-
-        fname = os.path.basename(self._preview_current_path or "")
-        n = len(merged)
-        self.preview_title.setText(
-            f"Document Preview — {fname}  "
-            f'<span style="color:#ffd966;">▶ {n} фрагмент(ов) из ответа</span>'
-        )
-        # preview_title — QLabel, поддерживает richtext
-        self.preview_title.setTextFormat(QtCore.Qt.TextFormat.RichText)
-        self.clear_highlight_btn.setVisible(True)
-
-    def _map_normalized_pos_to_original(self, original_text: str, norm_pos: int) -> int:
-        """Приближённо переводит позицию в нормализованном тексте в позицию в оригинальном."""
-        import re as _re
-        norm_chars = 0
-        orig_i = 0
-        in_space = False
-        for orig_i, ch in enumerate(original_text):
-            if norm_chars >= norm_pos:
-                return orig_i
-            if ch in (' ', '\t', '\n', '\r'):
-                if not in_space:
-                    norm_chars += 1
-                    in_space = True
-            else:
-                norm_chars += 1
-                in_space = False
-        return min(orig_i, len(original_text))
-
-    def _clear_preview_highlight(self):
-        """Убирает подсветку и показывает файл в обычном виде."""
-        self.clear_highlight_btn.setVisible(False)
-        if self._preview_current_path and self._preview_current_text:
-            self._show_plain_text(self._preview_current_text)
-            self.preview_title.setText(
-                f"Document Preview — {os.path.basename(self._preview_current_path)}"
-            )
-        else:
-            self._show_plain_text("Select a file in Files to view its contents.")
-            self.preview_title.setText("Document Preview")
-
-    def _show_plain_text(self, text: str) -> None:
-        """Отображает plain text, полностью сбрасывая предыдущие HTML-стили."""
-        import html as _html
-        escaped = _html.escape(text).replace("\n", "<br>")
-        neutral_html = (
-            '<html><body style="'
-            'background:#1e1e1e; color:#d4d4d4; '
-            'font-family:Consolas,JetBrains Mono,monospace; font-size:12.5px; '
-            'white-space:pre-wrap; word-wrap:break-word;">'
-            f"{escaped}</body></html>"
-        )
-        self.preview_browser.setHtml(neutral_html)
-        cursor = self.preview_browser.textCursor()
-        cursor.movePosition(QtGui.QTextCursor.MoveOperation.Start)
-        self.preview_browser.setTextCursor(cursor)
-
-    def _scroll_preview_to_char(self, char_pos: int, full_text: str):
-        """Скроллит превью к символу char_pos."""
-        # Считаем примерную позицию строки
-        line_number = full_text[:char_pos].count("\n")
-        # Используем курсор QTextBrowser для поиска позиции
-        cursor = self.preview_browser.textCursor()
-        cursor.movePosition(QtGui.QTextCursor.MoveOperation.Start)
-        self.preview_browser.setTextCursor(cursor)
-
-        # Ищем текст через find для позиционирования
-        anchor_text = full_text[char_pos:char_pos + 40].strip()
-        if anchor_text:
-            import html as html_module
-            self.preview_browser.find(anchor_text)
-            found_cursor = self.preview_browser.textCursor()
-            if not found_cursor.isNull():
-                # Снимаем выделение: переставляем курсор без выделения
-                found_cursor.setPosition(found_cursor.position())
-                self.preview_browser.setTextCursor(found_cursor)
-                self.preview_browser.ensureCursorVisible()
+        self.preview_pane.load(self.fs_model.filePath(index))
 
     def _ensure_coordinator(self) -> bool:
         if self.coordinator is None:
@@ -982,11 +775,18 @@ class MainWindow(QtWidgets.QMainWindow):
         self._add_typing_item_for_chat(self.pending_typing_chat_idx)
         self.start_typing_animation()
 
-        self.coordinator.ask_async(
-            query,
-            file_filter,
-            lambda resp, idx=self.pending_typing_chat_idx: self.on_answer(resp, idx),
-        )
+        conversation = None
+        if 0 <= self.current_chat_idx < len(self.conversation_states):
+            conversation = self.conversation_states[self.current_chat_idx]
+            conversation.sync_history(self.conversations[self.current_chat_idx])
+
+        callback = lambda resp, idx=self.pending_typing_chat_idx: self.on_answer(resp, idx)
+        pool = get_coordinator_pool()
+        folders = pool.loaded_folders() if self.all_folders_btn.isChecked() else None
+        if folders and len(folders) > 1:
+            pool.ask_async(query, folders, callback, file_filter=file_filter, conversation=conversation)
+        else:
+            self.coordinator.ask_async(query, file_filter, callback, conversation=conversation)
 
     def on_answer(self, response: dict, chat_idx: Optional[int] = None):
         # Поддержка потоковой (partial) отрисовки: если получен ключ 'partial', обновляем текущее сообщение.
@@ -1018,6 +818,11 @@ class MainWindow(QtWidgets.QMainWindow):
             self._adjust_bubble_widths()
             return
 
+        # подсветка источника, посчитанная параллельно с генерацией, — до конца ответа
+        if "highlights" in response and not response.get("final", False):
+            self._show_answer_highlights(response.get("highlights") or [])
+            return
+
         # потоковые обновления (legacy cumulative partial)
         if "partial" in response and not response.get("final", False):
             partial = response.get("partial", "")
@@ -1079,23 +884,39 @@ class MainWindow(QtWidgets.QMainWindow):
             self.add_message(f"Источник: {sources}", is_source=True, chat_idx=chat_idx)
 
         # Автоматически открыть файл-источник в превью с подсветкой найденных фрагментов
+        early_key = self._early_highlight_key
         if highlight_chunks:
-            # Берём файл из первого чанка
-            source_path = highlight_chunks[0].get("source", "")
-            if source_path and os.path.exists(source_path):
-                # Фильтруем чанки только для этого файла
-                file_chunks = [c for c in highlight_chunks if c.get("source") == source_path]
-                self._load_file_preview(source_path, highlight_chunks=file_chunks)
-                # Выделяем файл в дереве
-                self._select_file_in_tree(source_path)
+            # Та же подсветка уже показана ранним событием — превью не перерисовываем
+            if self._highlight_key(highlight_chunks) != early_key:
+                self._show_answer_highlights(highlight_chunks)
         elif sources and sources not in ("Неизвестно", "все файлы", "Нет источников"):
             # Нет позиций чанков (старый индекс) — просто открыть файл
             source_documents = response.get("source_documents", [])
             if source_documents:
                 src = source_documents[0].metadata.get("source", "")
                 if src and os.path.exists(src):
-                    self._load_file_preview(src)
+                    self.preview_pane.load(src)
                     self._select_file_in_tree(src)
+        # Ответ завершён — следующий вопрос сравнивает подсветку со своим ранним событием
+        self._early_highlight_key = None
+
+    @staticmethod
+    def _highlight_key(highlight_chunks: list) -> tuple:
+        return tuple((c.get("source"), c.get("start_char"), c.get("end_char")) for c in highlight_chunks)
+
+    def _show_answer_highlights(self, highlight_chunks: list):
+        """Открыть файл первого чанка в превью с подсветкой его фрагментов и выделить в дереве."""
+        if not highlight_chunks:
+            return
+        # Берём файл из первого чанка
+        source_path = highlight_chunks[0].get("source", "")
+        if source_path and os.path.exists(source_path):
+            # Фильтруем чанки только для этого файла
+            file_chunks = [c for c in highlight_chunks if c.get("source") == source_path]
+            self.preview_pane.load(source_path, highlight_chunks=file_chunks)
+            # Выделяем файл в дереве
+            self._select_file_in_tree(source_path)
+            self._early_highlight_key = self._highlight_key(highlight_chunks)
 
     def _select_file_in_tree(self, file_path: str):
         """Выделяет файл в дереве файлов (левая панель)."""
@@ -1204,6 +1025,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def _init_conversations(self):
         self.conversations = [[]]
+        self.conversation_states = [Conversation()]
         self.current_chat_idx = 0
         self.chat_threads_list.clear()
         self.chat_threads_list.addItem("New Chat")
@@ -1223,6 +1045,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def create_new_chat(self):
         self.conversations.append([])
+        self.conversation_states.append(Conversation())
         self.current_chat_idx = len(self.conversations) - 1
         self.chat_model = ChatListModel()
         self.chat_list.setModel(self.chat_model)
@@ -1342,6 +1165,8 @@ class MainWindow(QtWidgets.QMainWindow):
             return
 
         self.conversations.pop(conv_idx)
+        if conv_idx < len(self.conversation_states):
+            self.conversation_states.pop(conv_idx)
         self.typing_states.pop(conv_idx, None)
         self.chat_threads_list.takeItem(row)
 
@@ -1354,6 +1179,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def clear_chat_history(self):
         self.conversations = [[]]
+        self.conversation_states = [Conversation()]
         self.current_chat_idx = 0
         self.chat_threads_list.clear()
         self.chat_threads_list.addItem("New Chat")
@@ -1431,6 +1257,13 @@ class MainWindow(QtWidgets.QMainWindow):
         except Exception as e:
             QtWidgets.QMessageBox.warning(self, "Error", f"Failed to open logs: {e}")
 
+    def open_trace_viewer(self):
+        try:
+            win = TraceWindow(self)
+            win.exec()
+        except Exception as e:
+            QtWidgets.QMessageBox.warning(self, "Error", f"Failed to open query trace: {e}")
+
     def show_about_dialog(self):
         QtWidgets.QMessageBox.information(
             self,
@@ -1468,15 +1301,15 @@ class SettingsDialog(QtWidgets.QDialog):
         border-radius: 6px; margin-top: 10px; padding-top: 8px;
     }
     QGroupBox::title { subcontrol-origin: margin; left: 10px; color: #888; }
-    QLineEdit, QComboBox {
+    QLineEdit, QComboBox, QSpinBox {
         background: #2d2d2d; color: #d4d4d4;
         border: 1px solid #3a3a3a; border-radius: 4px;
         padding: 4px 8px; min-height: 24px;
     }
     QLineEdit:focus, QComboBox:focus { border-color: #5a7a9a; }
     QComboBox QAbstractItemView { background: #2d2d2d; color: #d4d4d4; selection-background-color: #3a5a7a; }
-    QRadioButton { color: #d4d4d4; spacing: 6px; }
-    QRadioButton::indicator { width: 14px; height: 14px; }
+    QRadioButton, QCheckBox { color: #d4d4d4; spacing: 6px; }
+    QRadioButton::indicator, QCheckBox::indicator { width: 14px; height: 14px; }
     QPushButton {
         background: #2d2d2d; color: #d4d4d4;
         border: 1px solid #3a3a3a; border-radius: 4px;
@@ -1565,8 +1398,83 @@ class SettingsDialog(QtWidgets.QDialog):
         free_note.setStyleSheet("color: #888; font-size: 11px;")
         gc.addWidget(free_note)
 
+        self.fallback_cb = QtWidgets.QCheckBox("При ошибке или перегрузке переключаться на другие бесплатные модели")
+        gc.addWidget(self.fallback_cb)
+
+        row_hedge = QtWidgets.QHBoxLayout()
+        row_hedge.addWidget(QtWidgets.QLabel("Hedging:"))
+        self.hedge_spin = QtWidgets.QSpinBox()
+        self.hedge_spin.setRange(0, 60000)
+        self.hedge_spin.setSingleStep(500)
+        self.hedge_spin.setSuffix(" мс")
+        self.hedge_spin.setSpecialValueText("выключено")
+        self.hedge_spin.setToolTip("Если модель не начала отвечать за это время, параллельно запрашивается следующая")
+        row_hedge.addWidget(self.hedge_spin)
+        row_hedge.addStretch()
+        gc.addLayout(row_hedge)
+
         layout.addWidget(grp_cloud)
 
+        # === Группа контекста ===
+        grp_ctx = QtWidgets.QGroupBox("Контекст")
+        gx = QtWidgets.QHBoxLayout(grp_ctx)
+        gx.addWidget(QtWidgets.QLabel("Бюджет фрагментов:"))
+        self.context_tokens_spin = QtWidgets.QSpinBox()
+        self.context_tokens_spin.setRange(500, 32000)
+        self.context_tokens_spin.setSingleStep(500)
+        self.context_tokens_spin.setSuffix(" токенов")
+        self.context_tokens_spin.setToolTip("Меньше — быстрее ответ локальной модели и меньше ошибок 400 у облачных")
+        gx.addWidget(self.context_tokens_spin)
+        gx.addStretch()
+        layout.addWidget(grp_ctx)
+
+        # === Группа выполнения ===
+        grp_exec = QtWidgets.QGroupBox("Выполнение")
+        ge = QtWidgets.QVBoxLayout(grp_exec)
+        self.async_engine_cb = QtWidgets.QCheckBox("Асинхронный движок вопросов (параллельные чаты не занимают потоки)")
+        self.async_engine_cb.setToolTip("Требует aiohttp; без него вопросы идут через пул потоков")
+        ge.addWidget(self.async_engine_cb)
+
+        row_rr = QtWidgets.QHBoxLayout()
+        row_rr.addWidget(QtWidgets.QLabel("Reranker:"))
+        self.reranker_backend_combo = QtWidgets.QComboBox()
+        for backend, label in (
+                ("torch", "torch — полная точность"),
+                ("int8", "int8 — квантизация torch (CPU)"),
+                ("onnx", "onnx — ONNX Runtime, int8 (экспорт при первом запуске)"),
+        ):
+            self.reranker_backend_combo.addItem(label, backend)
+        self.reranker_backend_combo.setToolTip("Быстрее на CPU: int8 и onnx; onnx требует optimum и onnxruntime")
+        row_rr.addWidget(self.reranker_backend_combo)
+        row_rr.addStretch()
+        ge.addLayout(row_rr)
+
+        row_rs = QtWidgets.QHBoxLayout()
+        self.retrieval_rerank_cb = QtWidgets.QCheckBox("Отбирать фрагменты для ответа reranker'ом, профиль:")
+        self.retrieval_rerank_cb.setToolTip(
+            "Поиск набирает больше кандидатов, cross-encoder упорядочивает их в пределах бюджета времени, "
+            "в модель уходят лучшие — короче промпт и точнее ответ"
+        )
+        row_rs.addWidget(self.retrieval_rerank_cb)
+        self.retrieval_profile_combo = QtWidgets.QComboBox()
+        for profile, label in (
+                ("auto", "авто"),
+                ("cpu", "CPU — меньше кандидатов, бюджет шире"),
+                ("gpu", "GPU — больше кандидатов, бюджет короче"),
+        ):
+            self.retrieval_profile_combo.addItem(label, profile)
+        row_rs.addWidget(self.retrieval_profile_combo)
+        row_rs.addStretch()
+        ge.addLayout(row_rs)
+        layout.addWidget(grp_exec)
+
+        # === Группа отладки ===
+        grp_debug = QtWidgets.QGroupBox("Отладка")
+        gd = QtWidgets.QVBoxLayout(grp_debug)
+        self.retrieval_traces_cb = QtWidgets.QCheckBox("Сохранять найденные чанки каждого ответа (retrieval_traces в кеше)")
+        gd.addWidget(self.retrieval_traces_cb)
+        layout.addWidget(grp_debug)
+
         # --- Кнопки ---
         btn_row = QtWidgets.QHBoxLayout()
         btn_row.addStretch()
@@ -1604,6 +1512,18 @@ class SettingsDialog(QtWidgets.QDialog):
         else:
             self.rb_ollama.setChecked(True)
 
+        self.fallback_cb.setChecked(s["openrouter_fallback"])
+        self.hedge_spin.setValue(s["openrouter_hedge_ms"])
+        self.context_tokens_spin.setValue(s["context_tokens"])
+        self.async_engine_cb.setChecked(s["async_engine"])
+        idx = self.reranker_backend_combo.findData(get_reranker_settings()["backend"])
+        self.reranker_backend_combo.setCurrentIndex(max(0, idx))
+        self.retrieval_rerank_cb.setChecked(get_retrieval_settings()["rerank"])
+        idx = self.retrieval_profile_combo.findData(load_settings().get("retrieval_rerank_profile",
+                                                                            RETRIEVAL_RERANK_PROFILE))
+        self.retrieval_profile_combo.setCurrentIndex(max(0, idx))
+        self.retrieval_traces_cb.setChecked(get_debug_settings()["retrieval_traces"])
+
 
     def _save_and_accept(self):
         provider = "openrouter" if self.rb_openrouter.isChecked() else "ollama"
@@ -1616,10 +1536,21 @@ class SettingsDialog(QtWidgets.QDialog):
             )
             return
 
-        save_settings({
+        # Сохраняем поверх текущего файла, чтобы не потерять ключи, которых нет в диалоге
+        settings = load_settings()
+        settings.update({
             "provider":         provider,
             "ollama_model":     self.ollama_model_edit.text().strip() or "gemma3:4b",
             "openrouter_key":   key,
             "openrouter_model": self.openrouter_model_combo.currentText().strip(),
+            "openrouter_fallback": self.fallback_cb.isChecked(),
+            "openrouter_hedge_ms": self.hedge_spin.value(),
+            "context_tokens":   self.context_tokens_spin.value(),
+            "async_engine":     self.async_engine_cb.isChecked(),
+            "reranker_backend": self.reranker_backend_combo.currentData(),
+            "retrieval_rerank": self.retrieval_rerank_cb.isChecked(),
+            "retrieval_rerank_profile": self.retrieval_profile_combo.currentData(),
+            "retrieval_traces": self.retrieval_traces_cb.isChecked(),
         })
+        save_settings(settings)
         self.accept()
\ No newline at end of file
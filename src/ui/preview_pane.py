@@ -0,0 +1,409 @@
+# src/ui/preview_pane.py
+"""
+Превью документа с подсветкой фрагментов ответа.
+
+Текст загружается в QThreadPool (text_store.load_document — сохранённый при
+индексации текст, при промахе — разбор PDF/DOCX/HTML), поэтому GUI-поток не
+ждёт файл. В QTextBrowser попадает не весь документ, а окно из нескольких
+страниц по PAGE_CHARS символов: вокруг первой подсветки при открытии из
+ответа, с начала — при клике в дереве. Когда прокрутка подходит к краю окна,
+подгружается следующая (или предыдущая) страница, а дальняя отбрасывается —
+HTML строится для десятков тысяч символов, даже если в логе 20 МБ.
+
+Границы страниц окна, перевод позиций из текста со схлопнутыми пробелами,
+номера строк и страницы PDF — бинпоиск по таблицам text_store.TextLayout:
+та же модель документа, по которой индексатор считал смещения чанков, поэтому
+start_char/end_char из ответа подсвечиваются без поиска текста, а к странице
+PDF можно перейти по номеру.
+"""
+
+import os
+import html as html_module
+from typing import Optional
+
+from PyQt6 import QtWidgets, QtCore, QtGui
+
+from config import SUPPORTED_FORMATS
+from text_store import load_document, normalize_whitespace, TextLayout
+
+# Размер страницы окна (символы; граница сдвигается к ближайшему переводу строки)
+PAGE_CHARS = 20_000
+# Больше страниц в окне не держим: дальняя от места прокрутки отбрасывается
+MAX_WINDOW_PAGES = 4
+# Сколько строк над подсветкой оставить видимыми при прокрутке к ней
+_SCROLL_MARGIN_PX = 40
+
+_HIGHLIGHT_STYLE = "background-color:#3a3000; color:#ffd966; border-radius:3px; padding:1px 0px;"
+_BODY_STYLE = (
+    "background:#1e1e1e; color:#d4d4d4; "
+    "font-family:Consolas,JetBrains Mono,monospace; font-size:12.5px; "
+    "white-space:pre-wrap; word-wrap:break-word;"
+)
+_PLACEHOLDER = "Select a file in Files to view its contents."
+
+
+def _message(text: str) -> tuple:
+    return text, TextLayout.build(text)
+
+
+def read_preview_document(file_path: str) -> tuple:
+    """(текст, TextLayout) для превью (вызывается в потоке пула)."""
+    ext = os.path.splitext(file_path)[1].lower().lstrip(".")
+    try:
+        if ext not in SUPPORTED_FORMATS:
+            return _message(
+                f"Preview for extension '.{ext}' is not implemented.\n"
+                f"Supported formats: {', '.join(SUPPORTED_FORMATS)}"
+            )
+        # Текст и модель документа, сохранённые при индексации (text_store), — без повторного разбора файла
+        document = load_document(file_path)
+        if document is None:
+            return _message("Изображение: распознанный текст появится в превью после индексации папки (OCR).")
+        return document
+    except Exception as e:
+        return _message(f"Preview error: {e}")
+
+
+class _LoadSignals(QtCore.QObject):
+    loaded = QtCore.pyqtSignal(int, str, object)  # номер запроса, путь, (текст, TextLayout, нормализованный текст)
+
+
+class _LoadRunnable(QtCore.QRunnable):
+    def __init__(self, request_id: int, file_path: str, signals: _LoadSignals, normalize: bool = False):
+        super().__init__()
+        self.request_id = request_id
+        self.file_path = file_path
+        self.signals = signals
+        # У чанков нет позиций — нормализованный текст для поиска готовим здесь, а не в GUI-потоке
+        self.normalize = normalize
+
+    def run(self):
+        text, layout = read_preview_document(self.file_path)
+        try:
+            normalized = normalize_whitespace(text) if self.normalize else None
+            self.signals.loaded.emit(self.request_id, self.file_path, (text, layout, normalized))
+        except RuntimeError:
+            pass  # окно закрыто, пока файл читался
+
+
+class PreviewPane(QtWidgets.QWidget):
+    """Заголовок, кнопка снятия подсветки и постраничный QTextBrowser."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.setContentsMargins(10, 10, 10, 10)
+        layout.setSpacing(8)
+
+        toolbar = QtWidgets.QWidget()
+        toolbar_layout = QtWidgets.QHBoxLayout(toolbar)
+        toolbar_layout.setContentsMargins(0, 0, 0, 0)
+        toolbar_layout.setSpacing(8)
+
+        self.title = QtWidgets.QLabel("Document Preview")
+        self.title.setStyleSheet("color:#9aa; font-weight:600;")
+        self.title.setTextFormat(QtCore.Qt.TextFormat.RichText)
+        toolbar_layout.addWidget(self.title)
+        toolbar_layout.addStretch()
+
+        self.clear_highlight_btn = QtWidgets.QPushButton("✕ Clear highlight")
+        self.clear_highlight_btn.setVisible(False)
+        self.clear_highlight_btn.setStyleSheet(
+            "padding: 3px 8px; font-size: 11px; color: #ffd966; border-color: #5a5000;"
+        )
+        self.clear_highlight_btn.clicked.connect(self.clear_highlight)
+        toolbar_layout.addWidget(self.clear_highlight_btn)
+
+        # Переход к странице — только у документов со страницами (PDF)
+        self.page_label = QtWidgets.QLabel("Стр.")
+        self.page_label.setStyleSheet("color:#9aa;")
+        self.page_spin = QtWidgets.QSpinBox()
+        self.page_spin.setMinimum(1)
+        self.page_spin.setKeyboardTracking(False)
+        self.page_spin.valueChanged.connect(self.go_to_page)
+        self.page_total = QtWidgets.QLabel("")
+        self.page_total.setStyleSheet("color:#777;")
+        for widget in (self.page_label, self.page_spin, self.page_total):
+            widget.setVisible(False)
+            toolbar_layout.addWidget(widget)
+
+        self.browser = QtWidgets.QTextBrowser()
+        self.browser.setReadOnly(True)
+        self.browser.setOpenExternalLinks(False)
+        self.browser.setStyleSheet("font-family: Consolas, 'JetBrains Mono', monospace; font-size: 12.5px;")
+        self.browser.setPlainText(_PLACEHOLDER)
+        self.browser.verticalScrollBar().valueChanged.connect(self._on_scroll)
+
+        layout.addWidget(toolbar)
+        layout.addWidget(self.browser, 1)
+
+        # Текущий файл и его полный текст; в браузере — только text[_win_start:_win_end]
+        self.path: Optional[str] = None
+        self.text: str = ""
+        self.layout: TextLayout = TextLayout.build("")
+        self._normalized: Optional[str] = None
+        self._ranges: list = []
+        self._win_start = 0
+        self._win_end = 0
+        self._rendering = False
+
+        self._signals = _LoadSignals()
+        self._signals.loaded.connect(self._on_loaded)
+        self._request_id = 0
+        self._pending_chunks: Optional[list] = None
+        self._loaded_mtime: Optional[float] = None
+
+    # ── загрузка ─────────────────────────────────────────────────────────
+
+    def load(self, file_path: str, highlight_chunks: Optional[list] = None) -> None:
+        """Показать файл (с подсветкой чанков ответа). Текст читается в фоне; устаревшие загрузки отбрасываются."""
+        self._request_id += 1
+        if not file_path or not os.path.exists(file_path):
+            self.path, self.text, self._ranges = None, "", []
+            self.layout, self._normalized = TextLayout.build(""), None
+            self.clear_highlight_btn.setVisible(False)
+            self._update_page_nav()
+            self.browser.setPlainText("Файл не найден.")
+            return
+        try:
+            mtime = os.path.getmtime(file_path)
+        except OSError:
+            mtime = None
+        if file_path == self.path and mtime == self._loaded_mtime and self.text:
+            # Тот же файл (ранняя подсветка, затем финальная) — текст уже в памяти
+            self._apply(highlight_chunks)
+            return
+        self.path, self.text, self._ranges = file_path, "", []
+        self.layout, self._normalized = TextLayout.build(""), None
+        self._update_page_nav()
+        self._loaded_mtime = mtime
+        self._pending_chunks = highlight_chunks
+        self.clear_highlight_btn.setVisible(False)
+        self._set_title(f"Document Preview — {os.path.basename(file_path)}  "
+                        f'<span style="color:#777;">загрузка…</span>')
+        needs_search = any(c.get("start_char") is None or c.get("end_char") is None for c in highlight_chunks or [])
+        QtCore.QThreadPool.globalInstance().start(
+            _LoadRunnable(self._request_id, file_path, self._signals, normalize=needs_search)
+        )
+
+    def _on_loaded(self, request_id: int, file_path: str, loaded) -> None:
+        if request_id != self._request_id or file_path != self.path:
+            return  # пользователь уже открыл другой файл
+        self.text, self.layout, self._normalized = loaded
+        self._update_page_nav()
+        chunks, self._pending_chunks = self._pending_chunks, None
+        self._apply(chunks)
+
+    def _apply(self, highlight_chunks: Optional[list]) -> None:
+        if highlight_chunks:
+            self.show_highlights(highlight_chunks)
+        else:
+            self._show_plain()
+
+    # ── подсветка ────────────────────────────────────────────────────────
+
+    def show_highlights(self, highlight_chunks: list) -> None:
+        """
+        Подсветить чанки ответа в загруженном тексте и открыть окно вокруг первого.
+
+        Стратегия поиска позиций (в порядке приоритета):
+        1. Точные start_char/end_char из метаданных (новый sentence-level алгоритм)
+        2. Текстовый поиск предложения в файле (fallback для старых индексов)
+        """
+        self._ranges = self._merge(self._resolve_ranges(highlight_chunks))
+        first = self._ranges[0][0] if self._ranges else 0
+        self._show_window_around(first)
+
+        fname = os.path.basename(self.path or "")
+        page = self.layout.page_of(first)
+        where = f"стр. {page + 1}, " if page is not None else ""
+        self._set_title(
+            f"Document Preview — {fname}  "
+            f'<span style="color:#ffd966;">▶ {len(self._ranges)} фрагмент(ов) из ответа, '
+            f'{where}строка {self.layout.line_of(first) + 1}</span>'
+        )
+        self.clear_highlight_btn.setVisible(True)
+
+    def clear_highlight(self) -> None:
+        """Убирает подсветку и показывает файл в обычном виде."""
+        if self.path and self.text:
+            self._show_plain()
+        else:
+            self._ranges = []
+            self.clear_highlight_btn.setVisible(False)
+            self.browser.setPlainText(_PLACEHOLDER)
+            self._set_title("Document Preview")
+
+    def _show_plain(self) -> None:
+        self._ranges = []
+        self.clear_highlight_btn.setVisible(False)
+        self._show_window_around(0)
+        self._set_title(f"Document Preview — {os.path.basename(self.path or '')}")
+
+    def _set_title(self, text: str) -> None:
+        # title — QLabel, поддерживает richtext
+        self.title.setTextFormat(QtCore.Qt.TextFormat.RichText)
+        self.title.setText(text)
+
+    def _resolve_ranges(self, highlight_chunks: list) -> list:
+        text = self.text
+        ranges = []
+        for chunk in highlight_chunks:
+            start = chunk.get("start_char")
+            end = chunk.get("end_char")
+            # Вариант 1: точные позиции — индекс и превью считают их по одному тексту (extract_document)
+            if start is not None and end is not None and 0 <= start < end <= len(text):
+                ranges.append((start, end))
+                continue
+
+            # Вариант 2: поиск текста предложения напрямую в файле
+            chunk_text = chunk.get("text", "").strip()
+            if not chunk_text:
+                continue
+            # Ищем с нормализацией пробелов — чанк мог быть склеен из строк.
+            # Нормализованный текст — один на документ, позиции переводит TextLayout
+            normalized_chunk = normalize_whitespace(chunk_text)
+            if self._normalized is None:
+                self._normalized = normalize_whitespace(text)
+            # Известна страница — ищем с её начала, а не с начала документа
+            from_pos = 0
+            page = chunk.get("page")
+            if page and self.layout.page_count:
+                from_pos = self.layout.to_normalized(self.layout.page_start(int(page) - 1))
+            pos = self._normalized.find(normalized_chunk[:120], from_pos)
+            if pos == -1 and from_pos:
+                pos = self._normalized.find(normalized_chunk[:120])
+            if pos != -1:
+                orig_pos = self.layout.to_original(pos)
+                orig_end = self.layout.to_original(min(pos + len(normalized_chunk), len(self._normalized)))
+                if orig_pos < orig_end:
+                    ranges.append((orig_pos, orig_end))
+        return ranges
+
+    @staticmethod
+    def _merge(ranges: list) -> list:
+        # Объединяем пересекающиеся диапазоны
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    # ── страницы ─────────────────────────────────────────────────────────
+
+    def _update_page_nav(self) -> None:
+        pages = self.layout.page_count
+        for widget in (self.page_label, self.page_spin, self.page_total):
+            widget.setVisible(pages > 0)
+        if pages:
+            self.page_spin.blockSignals(True)
+            self.page_spin.setMaximum(pages)
+            self.page_spin.setValue(1)
+            self.page_spin.blockSignals(False)
+            self.page_total.setText(f"/ {pages}")
+
+    def _sync_page_spin(self) -> None:
+        """Номер страницы в переключателе — по верхней видимой строке."""
+        if not self.layout.page_count:
+            return
+        page = self.layout.page_of(self._char_at_top())
+        self.page_spin.blockSignals(True)
+        self.page_spin.setValue(page + 1)
+        self.page_spin.blockSignals(False)
+
+    def go_to_page(self, page: int) -> None:
+        """Открыть окно с начала страницы page (с 1)."""
+        if not self.text or not self.layout.page_count:
+            return
+        self._show_window_around(self.layout.page_start(page - 1))
+        # Над началом страницы оставлен отступ — верхняя строка может быть с предыдущей
+        self.page_spin.blockSignals(True)
+        self.page_spin.setValue(page)
+        self.page_spin.blockSignals(False)
+
+    # ── окно текста ──────────────────────────────────────────────────────
+
+    def _snap(self, pos: int) -> int:
+        """Граница страницы: начало строки не раньше pos (не режем строку посередине)."""
+        if pos <= 0:
+            return 0
+        if pos >= len(self.text):
+            return len(self.text)
+        line_start = self.layout.next_line_start(pos)
+        # Очень длинная строка (минифицированный файл) — режем внутри неё
+        return line_start if line_start - pos <= PAGE_CHARS // 10 else pos
+
+    def _show_window_around(self, char_pos: int) -> None:
+        page = char_pos // PAGE_CHARS
+        start = self._snap((page - 1) * PAGE_CHARS) if page else 0
+        end = self._snap((page + 2) * PAGE_CHARS)
+        self._render(start, end)
+        if char_pos:
+            self._scroll_to_char(char_pos, margin=_SCROLL_MARGIN_PX)
+        else:
+            self.browser.verticalScrollBar().setValue(0)
+        self._sync_page_spin()
+
+    def _render(self, start: int, end: int) -> None:
+        """HTML только для text[start:end] с подсветкой попавших в окно диапазонов."""
+        text = self.text
+        parts = []
+        prev = start
+        for r_start, r_end in self._ranges:
+            if r_end <= start or r_start >= end:
+                continue
+            r_start, r_end = max(r_start, start), min(r_end, end)
+            parts.append(html_module.escape(text[prev:r_start]))
+            parts.append(f'<span style="{_HIGHLIGHT_STYLE}">{html_module.escape(text[r_start:r_end])}</span>')
+            prev = r_end
+        parts.append(html_module.escape(text[prev:end]))
+        body = "".join(parts).replace("\n", "<br>")
+
+        self._rendering = True
+        try:
+            self.browser.setHtml(f'<html><body style="{_BODY_STYLE}">{body}</body></html>')
+            self._win_start, self._win_end = start, end
+        finally:
+            self._rendering = False
+
+    def _char_at_top(self) -> int:
+        """Символ документа в верхней строке видимой области."""
+        cursor = self.browser.cursorForPosition(QtCore.QPoint(0, 0))
+        return self._win_start + cursor.position()
+
+    def _scroll_to_char(self, char_pos: int, margin: int = 0) -> None:
+        """Прокрутить так, чтобы символ char_pos (внутри окна) был у верхнего края."""
+        doc_pos = max(0, min(char_pos - self._win_start, self._win_end - self._win_start))
+        cursor = QtGui.QTextCursor(self.browser.document())
+        cursor.setPosition(min(doc_pos, self.browser.document().characterCount() - 1))
+        bar = self.browser.verticalScrollBar()
+        self._rendering = True
+        try:
+            bar.setValue(bar.value() + self.browser.cursorRect(cursor).top() - margin)
+        finally:
+            self._rendering = False
+
+    def _on_scroll(self, value: int) -> None:
+        if self._rendering or not self.text:
+            return
+        bar = self.browser.verticalScrollBar()
+        edge = bar.pageStep() // 2
+        if value >= bar.maximum() - edge and self._win_end < len(self.text):
+            anchor = self._char_at_top()
+            end = self._snap(self._win_end + PAGE_CHARS)
+            start = self._win_start
+            if end - start > MAX_WINDOW_PAGES * PAGE_CHARS:
+                start = self._snap(end - MAX_WINDOW_PAGES * PAGE_CHARS)
+            self._render(start, end)
+            self._scroll_to_char(anchor)
+        elif value <= edge and self._win_start > 0:
+            anchor = self._char_at_top()
+            start = self._snap(self._win_start - PAGE_CHARS)
+            end = self._win_end
+            if end - start > MAX_WINDOW_PAGES * PAGE_CHARS:
+                end = self._snap(start + MAX_WINDOW_PAGES * PAGE_CHARS)
+            self._render(start, end)
+            self._scroll_to_char(anchor)
+        self._sync_page_spin()
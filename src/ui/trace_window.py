@@ -0,0 +1,124 @@
+# src/ui/trace_window.py
+from PyQt6 import QtWidgets, QtCore, QtGui
+import os
+import json
+from datetime import datetime
+
+from tracing import get_recent_traces, read_trace_log, get_trace_log_path
+
+
+class TraceWindow(QtWidgets.QDialog):
+    """Разбивка времени последних вопросов по этапам (spans из tracing.py)."""
+
+    _BAR_WIDTH = 24
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Query Trace")
+        self.resize(820, 480)
+        self._traces = []
+
+        layout = QtWidgets.QVBoxLayout(self)
+
+        top = QtWidgets.QHBoxLayout()
+        self.trace_combo = QtWidgets.QComboBox()
+        self.trace_combo.currentIndexChanged.connect(self._show_selected)
+        top.addWidget(self.trace_combo, 1)
+        self.refresh_btn = QtWidgets.QPushButton("Refresh")
+        self.refresh_btn.clicked.connect(self.load)
+        top.addWidget(self.refresh_btn)
+        self.open_folder_btn = QtWidgets.QPushButton("Open Folder")
+        self.open_folder_btn.clicked.connect(self.open_folder)
+        top.addWidget(self.open_folder_btn)
+        layout.addLayout(top)
+
+        self.summary_label = QtWidgets.QLabel("")
+        self.summary_label.setWordWrap(True)
+        layout.addWidget(self.summary_label)
+
+        self.tree = QtWidgets.QTreeWidget()
+        self.tree.setColumnCount(5)
+        self.tree.setHeaderLabels(["Stage", "Start, ms", "Duration, ms", "", "Details"])
+        self.tree.setRootIsDecorated(False)
+        self.tree.setAlternatingRowColors(False)
+        font = QtGui.QFont("Consolas")
+        font.setPointSize(10)
+        self.tree.setFont(font)
+        header = self.tree.header()
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(1, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(2, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(3, QtWidgets.QHeaderView.ResizeMode.ResizeToContents)
+        header.setStretchLastSection(True)
+        layout.addWidget(self.tree, 1)
+
+        self.load()
+
+    def load(self):
+        # Сначала trace текущей сессии, затем — из файла (прошлые запуски)
+        traces = get_recent_traces(20)
+        seen = {t.get("trace_id") for t in traces}
+        for t in read_trace_log(20):
+            if t.get("trace_id") not in seen:
+                traces.append(t)
+        self._traces = traces
+
+        self.trace_combo.blockSignals(True)
+        self.trace_combo.clear()
+        for t in traces:
+            started = datetime.fromtimestamp(t.get("started_at", 0)).strftime("%H:%M:%S")
+            query = (t.get("query") or "").replace("\n", " ")
+            if len(query) > 60:
+                query = query[:57] + "..."
+            self.trace_combo.addItem(f"{started}  {t.get('total_ms', 0):.0f} ms  {query}")
+        self.trace_combo.blockSignals(False)
+
+        if traces:
+            self.trace_combo.setCurrentIndex(0)
+            self._show_selected(0)
+        else:
+            self.summary_label.setText("Нет данных: задайте вопрос, чтобы получить разбивку по этапам.")
+            self.tree.clear()
+
+    def _show_selected(self, idx: int):
+        if not (0 <= idx < len(self._traces)):
+            return
+        trace = self._traces[idx]
+        total = float(trace.get("total_ms") or 0.0)
+        branch = (trace.get("attrs") or {}).get("branch", "")
+        self.summary_label.setText(
+            f"<b>{trace.get('query', '')}</b><br>"
+            f"Всего: {total:.1f} ms" + (f" • ветка: {branch}" if branch else "")
+        )
+
+        self.tree.clear()
+        for span in trace.get("spans", []):
+            duration = float(span.get("duration_ms") or 0.0)
+            share = duration / total if total > 0 else 0.0
+            bar = "█" * max(1 if duration > 0 else 0, int(round(share * self._BAR_WIDTH)))
+            attrs = span.get("attrs") or {}
+            details = ", ".join(f"{k}={v}" for k, v in attrs.items()) if attrs else ""
+            item = QtWidgets.QTreeWidgetItem([
+                span.get("name", ""),
+                f"{float(span.get('start_ms') or 0.0):.1f}",
+                f"{duration:.1f}",
+                bar,
+                details,
+            ])
+            item.setTextAlignment(1, QtCore.Qt.AlignmentFlag.AlignRight)
+            item.setTextAlignment(2, QtCore.Qt.AlignmentFlag.AlignRight)
+            item.setToolTip(4, json.dumps(attrs, ensure_ascii=False) if attrs else "")
+            self.tree.addTopLevelItem(item)
+
+    def open_folder(self):
+        folder = os.path.dirname(get_trace_log_path())
+        try:
+            if os.name == "nt":
+                try:
+                    os.startfile(folder)
+                    return
+                except Exception:
+                    pass
+            QtGui.QDesktopServices.openUrl(QtCore.QUrl.fromLocalFile(folder))
+        except Exception as e:
+            QtWidgets.QMessageBox.information(self, "Not found", f"{folder}\nError: {e}")